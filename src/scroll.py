@@ -1,13 +1,26 @@
 import argparse
 from datetime import datetime
+import hashlib
 import json
-import requests
-import urllib.parse
+import os
+import shlex
+import tempfile
+import time
 import sys
-from scroll import Booklet
+from scroll import (Booklet, FragmentCache, MeetingIndex, RenderCache, TomatoClient, UnsupportedUpdate, drain,
+                    fit_to_pages, fold_updates, font_subset_cache, read_plan, render_plan, render_update, write_plan)
+from scroll.compact import compact_pdf
+from scroll.fetch import get_meetings_url
+from scroll.linearize import can_linearize
+from scroll.parallel import PARALLEL_MIN_MEETINGS
+from scroll.render_cache import get_content_hash
+from scroll.service_bodies import ServiceBodyTree, partition_meetings
+from scroll.sources import VALID_INPUT_FORMATS, get_file_hash, read_source
+from scroll.store import MeetingStore
+from scroll.update import get_kept_pages
 
 
-def get_data(args):
+def get_url(args):
     def form_sort_string():
         key_map = {
             'weekday': 'weekday_tinyint',
@@ -19,28 +32,144 @@ def get_data(args):
         ret += ',start_time'
         return ret
 
-    qs = urllib.parse.urlencode({
-        'switcher': 'GetSearchResults',
-        'get_used_formats': '1',
-        'sort_keys': form_sort_string(),
-        'services[]': args.service_body_ids.split(','),
-        'recursive': '1' if args.recursive else '0'
-    }, doseq=True)
-    url = 'https://tomato.na-bmlt.org/main_server/client_interface/json/?' + qs
-
-    headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0 +scroll'}
-    response = requests.get(url, headers=headers)
+    # Otherwise meetings are sorted locally by a MeetingIndex, so the same download can be
+    # used for any combination of header fields
+    sort_keys = form_sort_string() if args.presorted else None
+    return get_meetings_url(args.tomato_url, args.service_body_ids.split(','), args.recursive, sort_keys=sort_keys)
+
+
+_clients = {}
+
+
+def get_client(args):
+    # Clients are kept for the life of the process, so in watch mode the hedging threshold
+    # adapts to the latencies seen in earlier polls
+    options = (args.connect_timeout, args.read_timeout, args.total_timeout, args.retries, args.hedge_after)
+    if options not in _clients:
+        _clients[options] = TomatoClient(
+            connect_timeout=args.connect_timeout,
+            read_timeout=args.read_timeout,
+            total_timeout=args.total_timeout,
+            retries=args.retries,
+            hedge_after=args.hedge_after,
+            log=lambda message: sys.stdout.write(message + '\n')
+        )
+    return _clients[options]
+
+
+def get_data(args):
+    url = get_url(args)
+    response = get_client(args).get(url)
     if response.status_code != 200:
         raise Exception('Bad status code {} from {}'.format(response.status_code, url))
+    before_decode = time.monotonic()
     try:
         data = json.loads(response.content)
     except json.decoder.JSONDecodeError:
         raise Exception('Invalid json returned from {}'.format(url))
+    sys.stdout.write('downloaded {} bytes ({} decoded, content encoding {}), json decoded in {}s\n'.format(
+        response.wire_size, len(response.content), response.headers.get('Content-Encoding', 'identity'),
+        round(time.monotonic() - before_decode, 3)))
 
     return data['meetings'], data['formats']
 
 
-def get_pdf(args, meetings, formats):
+def get_service_body_tree(args):
+    url = args.tomato_url.rstrip('/') + '/client_interface/json/?switcher=GetServiceBodies'
+    response = get_client(args).get(url)
+    if response.status_code != 200:
+        raise Exception('Bad status code {} from {}'.format(response.status_code, url))
+    try:
+        return ServiceBodyTree(json.loads(response.content))
+    except json.decoder.JSONDecodeError:
+        raise Exception('Invalid json returned from {}'.format(url))
+
+
+def get_local_data(args):
+    service_body_ids = None
+    if args.service_body_ids != 'all':
+        service_body_ids = args.service_body_ids.split(',')
+    return read_source(args.input_file, input_format=args.input_format, service_body_ids=service_body_ids)
+
+
+_stores = {}
+
+
+def get_store(path):
+    if path not in _stores:
+        _stores[path] = MeetingStore(path)
+    return _stores[path]
+
+
+_fragment_caches = {}
+
+
+def get_fragment_cache(path):
+    if path not in _fragment_caches:
+        _fragment_caches[path] = FragmentCache(path)
+    return _fragment_caches[path]
+
+
+def flush_fragment_caches():
+    for path, fragment_cache in _fragment_caches.items():
+        fragment_cache.flush()
+        sys.stdout.write('fragment cache {}: {} hits, {} misses\n'.format(
+            path, fragment_cache.hits, fragment_cache.misses))
+
+
+def sync_stores(jobs):
+    # Each store is synced once, with the queries of every job that reads from it
+    store_jobs = {}
+    for args in jobs:
+        if args.store:
+            store_jobs.setdefault(args.store, []).append(args)
+    for path, path_jobs in store_jobs.items():
+        args = path_jobs[0]
+        before_sync = time.monotonic()
+        try:
+            get_store(path).sync(
+                get_client(args),
+                args.tomato_url,
+                [(job.service_body_ids.split(','), job.recursive) for job in path_jobs],
+                log=lambda message: sys.stdout.write(message + '\n')
+            )
+        except Exception as e:
+            # Booklets are still rendered from what the store already holds
+            sys.stderr.write('Error: sync of {}: {}\n'.format(path, str(e)))
+            continue
+        sys.stdout.write('sync of {} completed in {}s\n'.format(path, round(time.monotonic() - before_sync, 3)))
+
+
+def get_store_data(args):
+    order_by = None
+    if args.presorted:
+        order_by = [args.main_header_field]
+        if args.second_header_field:
+            order_by.append(args.second_header_field)
+    return get_store(args.store).get_data(args.service_body_ids.split(','), args.recursive, order_by=order_by)
+
+
+def load_data(args):
+    if args.input_file:
+        return get_local_data(args)
+    if args.store:
+        return get_store_data(args)
+    return get_data(args)
+
+
+def get_input_hash(args, meetings, formats):
+    if isinstance(meetings, list):
+        return get_content_hash(meetings, formats)
+    # Streamed input is hashed from the file itself, so it doesn't have to be read twice
+    if args.input_file == '-':
+        raise Exception('--render-cache cannot be used with ndjson input from stdin')
+    h = hashlib.sha256()
+    h.update(get_file_hash(args.input_file).encode('utf-8'))
+    h.update(args.service_body_ids.encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_booklet_kwargs(args):
     kwargs = {
         'paper_size': args.paper_size,
         'bookletize': args.bookletize,
@@ -82,16 +211,130 @@ def get_pdf(args, meetings, formats):
         kwargs['formats_table_header_font_color'] = args.formats_table_header_font_color
     if args.formats_table_header_fill_color:
         kwargs['formats_table_header_fill_color'] = args.formats_table_header_fill_color
-    booklet = Booklet(meetings, formats, args.output_file, **kwargs)
-    booklet.write_pdf()
+    if args.compact:
+        kwargs['compact'] = args.compact
+    if args.linearize:
+        kwargs['linearize'] = args.linearize
+    if args.fragment_cache:
+        kwargs['fragment_cache'] = get_fragment_cache(args.fragment_cache)
+    if args.workers:
+        kwargs['workers'] = args.workers
+    return kwargs
 
 
-def main():
+def print_layout_stats(stats):
+    sys.stdout.write('pages: {}\n'.format(stats.page_count))
+    sys.stdout.write('continued headers: {}\n'.format(stats.continued_headers))
+    for i, fill_ratio in enumerate(stats.fill_ratios):
+        sys.stdout.write('page {}: {}% full\n'.format(i + 1, round(fill_ratio * 100, 1)))
+
+
+def auto_fit(args, meetings, formats):
+    kwargs, stats = fit_to_pages(
+        meetings,
+        formats,
+        args.auto_fit_pages,
+        log=lambda message: sys.stdout.write(message + '\n'),
+        **get_booklet_kwargs(args)
+    )
+    sys.stdout.write('auto fit chose meeting font size {}, header font size {}, time column width {} and duration '
+                     'column width {} for {} pages\n'.format(
+                         kwargs['meeting_font_size'], kwargs['header_font_size'], kwargs['time_column_width'],
+                         kwargs['duration_column_width'], stats.page_count))
+    return kwargs, stats
+
+
+def get_file_mode(path):
+    # mkstemp creates files only the owner can read, so the temp file gets the mode of the file
+    # it replaces, or the mode a newly created file would have
+    try:
+        return os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def write_atomically(output_file, write):
+    # Write next to the destination and move the finished file into place, so readers of
+    # output_file never see a partially written file
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    fd, tmp_file = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_file)
+        os.chmod(tmp_file, get_file_mode(output_file))
+        os.replace(tmp_file, output_file)
+    except:
+        os.remove(tmp_file)
+        raise
+
+
+def get_pdf(args, meetings, formats, content_hash=None):
+    if args.auto_fit_pages:
+        kwargs, stats = auto_fit(args, meetings, formats)
+    else:
+        kwargs = get_booklet_kwargs(args)
+    if args.render_cache:
+        kwargs['render_cache'] = RenderCache(args.render_cache, max_entries=args.render_cache_max_entries)
+    if content_hash:
+        kwargs['content_hash'] = content_hash
+    booklet = Booklet(meetings, formats, None, **kwargs)
+    if args.write_plan:
+        write_atomically(args.output_file, lambda f: write_plan(booklet.get_plan(), f))
+        return
+    if args.update_plan:
+        update_pdf(args, booklet)
+        return
+    write_atomically(args.output_file, booklet.write_pdf)
+    if booklet.compact_stats:
+        original_size, compact_size = booklet.compact_stats
+        sys.stdout.write('compact output saved {} bytes: {} bytes instead of {} ({}% smaller)\n'.format(
+            original_size - compact_size, compact_size, original_size,
+            round((original_size - compact_size) * 100.0 / original_size, 1)))
+
+
+def update_pdf(args, booklet):
+    plan = booklet.get_plan()
+    try:
+        if not os.path.exists(args.output_file) or not os.path.exists(args.update_plan):
+            raise UnsupportedUpdate('There is no earlier PDF and plan to update')
+        previous_plan = read_plan(args.update_plan)
+        with open(args.output_file, 'rb') as f:
+            previous_pdf = f.read()
+        kept = get_kept_pages(previous_plan, plan)
+        write_atomically(args.output_file, lambda f: render_update(
+            previous_pdf, previous_plan, plan, f, fragment_cache=booklet.fragment_cache))
+        sys.stdout.write('updated {} of {} pages, {} bytes appended\n'.format(
+            kept.count(None), len(kept), os.path.getsize(args.output_file) - len(previous_pdf)))
+    except UnsupportedUpdate as e:
+        sys.stdout.write('rendering every page of {}. {}\n'.format(args.output_file, e))
+        write_atomically(args.output_file, lambda f: render_plan(plan, f, fragment_cache=booklet.fragment_cache))
+    write_atomically(args.update_plan, lambda f: write_plan(plan, f))
+
+
+# Options that only change how data is fetched, not what is rendered
+FETCH_OPTIONS = ('connect_timeout', 'read_timeout', 'total_timeout', 'retries', 'hedge_after', 'store')
+
+
+def get_job_hash(args, content_hash):
+    # Covers everything that affects the rendered output: the job's own arguments and the
+    # meetings and formats tomato returned for it
+    h = hashlib.sha256()
+    excluded = FETCH_OPTIONS + ('output_file', 'render_cache', 'render_cache_max_entries', 'fragment_cache', 'workers')
+    options = sorted((k, v) for k, v in vars(args).items() if k not in excluded)
+    h.update(json.dumps(options).encode('utf-8'))
+    h.update(content_hash.encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_parser():
     parser = argparse.ArgumentParser(prog='scroll')
     parser.add_argument(
         'service_body_ids',
         help='Comma-separated list of service body ids. Scroll will retrieve the meetings for these service bodies '
-             'from tomato'
+             'from tomato. With --input-file, only meetings of these service bodies are used, or all of them if this '
+             'is "all"'
     )
     parser.add_argument(
         'paper_size', choices=Booklet.PAPER_SIZES.keys(),
@@ -220,21 +463,603 @@ def main():
         default=10,
         help='The amount of whitespace to the left and right of the meeting formats legend table'
     )
+    parser.add_argument(
+        '--tomato-url',
+        dest='tomato_url',
+        default='https://tomato.na-bmlt.org/main_server',
+        help='Base url of the tomato server meetings are retrieved from. Defaults to '
+             'https://tomato.na-bmlt.org/main_server'
+    )
+    parser.add_argument(
+        '--input-file',
+        dest='input_file',
+        help='Read meetings from a file instead of tomato, or from stdin if this is -. Either a saved tomato '
+             'GetSearchResults response or ndjson, one meeting per line'
+    )
+    parser.add_argument(
+        '--input-format',
+        dest='input_format',
+        choices=VALID_INPUT_FORMATS,
+        help='Format of --input-file. Defaults to ndjson for .ndjson and .jsonl files and json otherwise'
+    )
+    parser.add_argument(
+        '--presorted',
+        dest='presorted',
+        action='store_true',
+        help='Use meetings in the order tomato or --input-file returns them instead of sorting them locally. '
+             'Lets large ndjson files be streamed without holding all meetings in memory'
+    )
+    parser.add_argument(
+        '--render-cache',
+        dest='render_cache',
+        help='Directory of previously rendered PDFs. When the meetings, formats and options match an earlier run, '
+             'the cached PDF is copied to output_file instead of being rendered again'
+    )
+    parser.add_argument(
+        '--render-cache-max-entries',
+        dest='render_cache_max_entries',
+        type=int,
+        default=100,
+        help='Number of PDFs to keep in --render-cache. The least recently used ones are removed first. '
+             'Defaults to 100'
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        dest='connect_timeout',
+        type=float,
+        default=5,
+        help='Seconds to wait for a connection to tomato. Defaults to 5'
+    )
+    parser.add_argument(
+        '--read-timeout',
+        dest='read_timeout',
+        type=float,
+        default=60,
+        help='Seconds to wait for tomato to send more data. Defaults to 60'
+    )
+    parser.add_argument(
+        '--total-timeout',
+        dest='total_timeout',
+        type=float,
+        default=120,
+        help='Seconds a single request to tomato may take in total. Defaults to 120'
+    )
+    parser.add_argument(
+        '--retries',
+        dest='retries',
+        type=int,
+        default=3,
+        help='Times to retry a request to tomato that failed with a timeout, connection error, 429 or 5xx, waiting '
+             'a random, exponentially growing time in between. Defaults to 3'
+    )
+    parser.add_argument(
+        '--hedge-after',
+        dest='hedge_after',
+        type=float,
+        help='Send a second request to tomato when the first hasn\'t finished after this many seconds, and use '
+             'whichever finishes first. In watch mode the 95th percentile of earlier requests is used instead once '
+             'there are enough of them. Disabled by default'
+    )
+    parser.add_argument(
+        '--dry-run',
+        dest='dry_run',
+        action='store_true',
+        help='Lay the booklet out without writing output_file, and print the page count, how full each page is '
+             'and the number of (Continued) headers'
+    )
+    parser.add_argument(
+        '--auto-fit-pages',
+        dest='auto_fit_pages',
+        type=int,
+        help='Use the largest meeting font size at which the booklet fits in this many pages, scaling the header '
+             'font size and the time and duration columns along with it. Candidates are laid out without being '
+             'written, and only the chosen one is rendered'
+    )
+    parser.add_argument(
+        '--compact',
+        dest='compact',
+        action='store_true',
+        help='Write a smaller PDF 1.5 file: objects packed into compressed object streams with a compressed xref '
+             'stream, identical objects and unused fonts removed, and repeated color and line width changes left '
+             'out. The pages look exactly the same. The size saved is printed'
+    )
+    parser.add_argument(
+        '--linearize',
+        dest='linearize',
+        action='store_true',
+        help='Write a linearized ("fast web view") PDF, which browsers and phones can start showing before the '
+             'whole file is downloaded. Needs pikepdf or the qpdf command'
+    )
+    parser.add_argument(
+        '--store',
+        dest='store',
+        help='Path to a SQLite store of meetings, created if it doesn\'t exist. Meetings are read from the store, '
+             'which is first brought up to date with the meetings changed in tomato since the last sync. The first '
+             'sync of a set of service bodies downloads all of their meetings. If the sync fails, the meetings '
+             'already in the store are used'
+    )
+    parser.add_argument(
+        '--write-plan',
+        dest='write_plan',
+        action='store_true',
+        help='Write the layout plan of the booklet to output_file instead of a PDF: every object on every page with '
+             'its position, and the wrapped lines and height of every meeting. "scroll render" turns it into the '
+             'PDF, e.g. on another machine'
+    )
+    parser.add_argument(
+        '--fragment-cache',
+        dest='fragment_cache',
+        help='Path to a SQLite file, created if it doesn\'t exist, of the heights and drawn content of meetings from '
+             'earlier runs. Meetings that haven\'t changed are neither measured nor drawn again, only moved to where '
+             'they go. Entries not used for 30 days are removed'
+    )
+    parser.add_argument(
+        '--descendants',
+        dest='descendants',
+        action='store_true',
+        help='Render a booklet for each of service_body_ids and for every service body below them, all taken from '
+             'one recursive download of each of service_body_ids. The service body hierarchy is loaded from '
+             'tomato\'s GetServiceBodies. Each booklet holds the meetings of its service body and the ones below it. '
+             'output_file, and the path given to --update, must contain {service_body_id}, which is replaced with '
+             'the id of each booklet\'s service body. Service bodies without meetings are skipped'
+    )
+    parser.add_argument(
+        '--update',
+        dest='update_plan',
+        help='Path to the layout plan output_file was rendered from, written by an earlier --update, or by '
+             '--write-plan for "scroll render". Only the pages that changed since are rendered, and they\'re '
+             'appended to output_file as an incremental update, leaving the rest of the file as it was. The new plan '
+             'is written to the same path. Every page is rendered if either file doesn\'t exist yet or the options '
+             'changed. "scroll fold" folds the updates back in'
+    )
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        type=int,
+        default=1,
+        help='Number of processes to measure meetings in. Each main header section is measured separately, and the '
+             'meetings are then placed in columns using the measured lines. Only used for {} meetings or more, and '
+             'not with --fragment-cache. Defaults to 1'.format(PARALLEL_MIN_MEETINGS)
+    )
+    return parser
 
-    args = parser.parse_args()
-    for id in args.service_body_ids.split(','):
-        try:
-            int(id)
-        except:
-            raise Exception('--service-body-ids is invalid, invalid value: {}'.format(id))
+
+def validate_args(args):
+    if args.service_body_ids == 'all':
+        if not args.input_file:
+            raise Exception('service_body_ids can only be "all" with --input-file')
+    else:
+        for id in args.service_body_ids.split(','):
+            try:
+                int(id)
+            except:
+                raise Exception('--service-body-ids is invalid, invalid value: {}'.format(id))
+    if args.store and args.input_file:
+        raise Exception('--store cannot be used with --input-file')
     if args.main_header_field == args.second_header_field:
         raise Exception('--main-header-field and --second-header-field cannot be the same')
+    if args.auto_fit_pages is not None and args.auto_fit_pages < 4:
+        raise Exception('--auto-fit-pages must be at least 4, booklets always have a multiple of 4 pages')
+    if args.retries < 0:
+        raise Exception('--retries cannot be negative')
+    if args.workers < 1:
+        raise Exception('--workers must be at least 1')
+    if args.render_cache_max_entries < 1:
+        raise Exception('--render-cache-max-entries must be at least 1')
+    if args.linearize and not can_linearize():
+        raise Exception('--linearize needs pikepdf (pip3 install pikepdf) or the qpdf command')
+    if args.write_plan and args.render_cache:
+        raise Exception('--write-plan cannot be used with --render-cache')
+    if args.descendants:
+        for name in ('input_file', 'presorted', 'dry_run'):
+            if getattr(args, name):
+                raise Exception('--descendants cannot be used with --{}'.format(name.replace('_', '-')))
+        for name in ('output_file', 'update_plan'):
+            path = getattr(args, name)
+            if path and '{service_body_id}' not in path:
+                raise Exception('With --descendants, {} must contain {{service_body_id}}'.format(
+                    'output_file' if name == 'output_file' else '--update'))
+    if args.update_plan:
+        for name in ('compact', 'linearize', 'write_plan', 'render_cache'):
+            if getattr(args, name):
+                raise Exception('--update cannot be used with --{}'.format(name.replace('_', '-')))
+    for name in ('connect_timeout', 'read_timeout', 'total_timeout', 'hedge_after'):
+        value = getattr(args, name)
+        if value is not None and value <= 0:
+            raise Exception('--{} must be greater than 0'.format(name.replace('_', '-')))
 
-    start_time = datetime.now()
+
+def get_watch_parser():
+    parser = argparse.ArgumentParser(
+        prog='scroll watch',
+        description='Poll tomato for a set of jobs and regenerate only the PDFs whose meetings or formats changed'
+    )
+    parser.add_argument(
+        'jobs_file',
+        help='File with one job per line, each made of the same arguments accepted by scroll, '
+             'e.g. "762 letter area.pdf --recursive". Blank lines and lines starting with # are ignored'
+    )
+    parser.add_argument(
+        '--interval',
+        dest='interval',
+        type=int,
+        default=3600,
+        help='Seconds to wait between polls. Defaults to 3600'
+    )
+    parser.add_argument(
+        '--state-file',
+        dest='state_file',
+        help='Where the content hash of each job is kept between runs. Defaults to the jobs file with a .state '
+             'extension'
+    )
+    parser.add_argument(
+        '--once',
+        dest='once',
+        action='store_true',
+        help='Poll a single time and exit instead of running until interrupted'
+    )
+    return parser
+
+
+def read_jobs(jobs_file):
+    parser = get_parser()
+    jobs = []
+    with open(jobs_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            # argparse exits on bad arguments, which would stop the watcher for a typo in one job
+            try:
+                args = parser.parse_args(shlex.split(line))
+                validate_args(args)
+                if args.dry_run:
+                    # Polls render every job, so a dry run would write its output file after all
+                    raise Exception('--dry-run cannot be used in watch jobs')
+            except SystemExit:
+                # argparse has already printed what's wrong with it
+                sys.stderr.write('Error: skipping invalid job "{}"\n'.format(line))
+                continue
+            except Exception as e:
+                sys.stderr.write('Error: skipping invalid job "{}": {}\n'.format(line, str(e)))
+                continue
+            jobs.append(args)
+    return jobs
+
+
+def read_watch_state(state_file):
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def write_watch_state(state_file, state):
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(state_file)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.chmod(tmp_file, get_file_mode(state_file))
+    os.replace(tmp_file, state_file)
+
+
+def load_service_body_tree(args, trees):
+    # The hierarchy is loaded once per server and poll, and kept in trees. Returns None if it couldn't be loaded.
+    if args.tomato_url not in trees:
+        try:
+            trees[args.tomato_url] = get_service_body_tree(args)
+        except Exception as e:
+            sys.stderr.write('Error: service bodies from {}: {}\n'.format(args.tomato_url, str(e)))
+            trees[args.tomato_url] = None
+    return trees[args.tomato_url]
+
+
+def expand_descendants(jobs, trees, failed):
+    """
+    Returns jobs with each job that has --descendants replaced by one job per service body it covers: each of its
+    service_body_ids and every service body below them. Each of those is a recursive job for a single service body,
+    whose output paths have {service_body_id} filled in. They are all covered by the recursive queries of the
+    top-level service bodies, so get_sources cuts them out of those downloads.
+
+    A job whose service body hierarchy couldn't be loaded is left out, and its output_file is added to failed.
+    """
+    ret = []
+    for args in jobs:
+        if not args.descendants:
+            ret.append(args)
+            continue
+        tree = load_service_body_tree(args, trees)
+        if tree is None:
+            sys.stderr.write('Error: {}: --descendants needs the service body hierarchy\n'.format(args.output_file))
+            failed.append(args.output_file)
+            continue
+        service_body_ids = tree.get_coverage(args.service_body_ids.split(','), recursive=True)
+        for service_body_id in sorted(service_body_ids, key=int):
+            child = argparse.Namespace(**vars(args))
+            child.service_body_ids = service_body_id
+            child.recursive = True
+            child.descendants = False
+            child.descendant_of = args.service_body_ids
+            child.output_file = args.output_file.format(service_body_id=service_body_id)
+            if args.update_plan:
+                child.update_plan = args.update_plan.format(service_body_id=service_body_id)
+            ret.append(child)
+    return ret
+
+
+def get_sources(jobs, trees):
+    """
+    Works out where the meetings of each job come from. Returns, for each job, the job whose tomato query is
+    downloaded and the ids of the service bodies to keep from its response, or None to keep all of them.
+
+    A job whose service bodies are all covered by another job's query, e.g. an area covered by a recursive query for
+    its region, is cut out of that query's response instead of being downloaded again. Of the queries that cover a
+    job, the one covering the most service bodies is used, so a region and all of its areas cost one download.
+    trees holds the service body hierarchy of each tomato server, see load_service_body_tree.
+    """
+    sources = [(args, None) for args in jobs]
+    # Presorted jobs need tomato's own sort order for their header fields, which a shared download doesn't have
+    candidates = [i for i, args in enumerate(jobs) if not args.input_file and not args.store and not args.presorted]
+    if len(candidates) < 2:
+        return sources
+
+    coverage = {}
+    for i in candidates:
+        args = jobs[i]
+        service_body_ids = args.service_body_ids.split(',')
+        if not args.recursive:
+            coverage[i] = set(service_body_ids)
+            continue
+        # The hierarchy is only needed to know what a recursive query covers
+        tree = load_service_body_tree(args, trees)
+        if tree is not None:
+            coverage[i] = tree.get_coverage(service_body_ids, recursive=True)
+
+    for i, service_body_ids in coverage.items():
+        parents = [
+            j for j in coverage
+            if jobs[j].tomato_url == jobs[i].tomato_url and coverage[j] >= service_body_ids
+        ]
+        parent = max(parents, key=lambda j: (len(coverage[j]), -j))
+        if get_url(jobs[parent]) != get_url(jobs[i]):
+            sources[i] = (jobs[parent], service_body_ids)
+    return sources
+
+
+def load_shared_data(args, subsets):
+    # Downloads args' query once, and returns the data of the query itself and of each of subsets, sets of service
+    # body ids, keyed by their data key in poll. The subsets share the full download's Meeting objects.
     meetings, formats = get_data(args)
+    meetings = list(meetings)
+    subset_hashes = {}
+    for service_body_ids in subsets:
+        subset_meetings, subset_formats = partition_meetings(meetings, formats, service_body_ids)
+        subset_hashes[service_body_ids] = subset_formats, get_content_hash(subset_meetings, subset_formats)
+    content_hash = get_content_hash(meetings, formats)
+    index = MeetingIndex(drain(meetings))
+    url = get_url(args)
+    data = {url: (index, formats, content_hash)}
+    for service_body_ids, (subset_formats, subset_hash) in subset_hashes.items():
+        subset_index = MeetingIndex(m for m in index.meetings if str(m.service_body_id) in service_body_ids)
+        data[(url, service_body_ids)] = subset_index, subset_formats, subset_hash
+        sys.stdout.write('{} meetings of service bodies {} taken from the download of {}\n'.format(
+            len(subset_index), ','.join(sorted(service_body_ids)), args.service_body_ids))
+    return data
+
+
+def poll(jobs, state):
+    # Meetings are sorted locally, so jobs that only differ in their rendering options or header
+    # fields share the same tomato query, and each distinct url is only downloaded once per poll.
+    # Jobs covered by another job's query are cut out of its download, see get_sources.
+    # Returns the state and the output files of the jobs that failed.
+    data = {}
+    # Downloads that failed, so jobs that share them don't try again in the same poll
+    failed_loads = {}
+    failed = []
+    trees = {}
+    jobs = expand_descendants(jobs, trees, failed)
+    sync_stores(jobs)
+    sources = get_sources(jobs, trees)
+    subsets = {}
+    for source_args, service_body_ids in sources:
+        if service_body_ids is not None:
+            subsets.setdefault(get_url(source_args), set()).add(frozenset(service_body_ids))
+    for args, (source_args, service_body_ids) in zip(jobs, sources):
+        try:
+            if args.input_file:
+                data_key = (args.input_file, args.service_body_ids)
+            elif args.store:
+                data_key = (args.store, get_url(args))
+            elif service_body_ids is not None:
+                data_key = (get_url(source_args), frozenset(service_body_ids))
+            else:
+                data_key = get_url(args)
+            if data_key not in data:
+                shared = not args.input_file and not args.store and get_url(source_args) in subsets
+                load_key = get_url(source_args) if shared else data_key
+                if load_key in failed_loads:
+                    raise Exception('{} (failed earlier in this poll)'.format(failed_loads[load_key]))
+                before_get_data = time.monotonic()
+                try:
+                    if shared:
+                        data.update(load_shared_data(source_args, subsets[load_key]))
+                    else:
+                        meetings, formats = load_data(args)
+                        # Jobs may share the data, so streamed input has to be read in full
+                        meetings = list(meetings)
+                        content_hash = get_content_hash(meetings, formats)
+                        data[data_key] = MeetingIndex(drain(meetings)), formats, content_hash
+                except Exception as e:
+                    failed_loads[load_key] = e
+                    raise
+                sys.stdout.write('get_data for {} completed in {}s\n'.format(
+                    source_args.service_body_ids, round(time.monotonic() - before_get_data, 3)))
+            index, formats, content_hash = data[data_key]
+            if getattr(args, 'descendant_of', None) and not len(index):
+                sys.stdout.write('{} skipped, service body {} has no meetings\n'.format(
+                    args.output_file, args.service_body_ids))
+                continue
+            meetings = index.meetings if args.presorted else index
+            job_hash = get_job_hash(args, content_hash)
+            if state.get(args.output_file) == job_hash and os.path.exists(args.output_file):
+                sys.stdout.write('{} unchanged\n'.format(args.output_file))
+                continue
+            before_get_pdf = time.monotonic()
+            get_pdf(args, meetings, formats, content_hash=content_hash)
+            state[args.output_file] = job_hash
+            sys.stdout.write('get_pdf for {} completed in {}s\n'.format(
+                args.output_file, round(time.monotonic() - before_get_pdf, 3)))
+        except Exception as e:
+            # One failing job shouldn't keep the others from being regenerated
+            sys.stderr.write('Error: {}: {}\n'.format(args.output_file, str(e)))
+            failed.append(args.output_file)
+    return state, failed
+
+
+def render_descendants(args):
+    # The booklets of every service body below service_body_ids are rendered the way a poll of watch mode renders
+    # jobs, from the shared download, only without keeping their state
+    start_time = time.monotonic()
+    state, failed = poll([args], {})
+    flush_fragment_caches()
+    sys.stdout.write('rendered {} booklets in {}s\n'.format(len(state), round(time.monotonic() - start_time, 3)))
+    if failed:
+        sys.stderr.write('Error: {} booklets failed: {}\n'.format(len(failed), ', '.join(failed)))
+        return 1
+    return 0
+
+
+def get_render_parser():
+    parser = argparse.ArgumentParser(
+        prog='scroll render',
+        description='Render a layout plan written with --write-plan, without laying the booklet out again'
+    )
+    parser.add_argument(
+        'plan_file',
+        help='The layout plan'
+    )
+    parser.add_argument(
+        'output_file',
+        help='The path to the PDF file generated by scroll'
+    )
+    parser.add_argument(
+        '--fragment-cache',
+        dest='fragment_cache',
+        help='Path to a SQLite file of the drawn content of meetings from earlier runs, see scroll --help'
+    )
+    return parser
+
+
+def render(argv):
+    render_args = get_render_parser().parse_args(argv)
+    start_time = time.monotonic()
+    plan = read_plan(render_args.plan_file)
+    fragment_cache = get_fragment_cache(render_args.fragment_cache) if render_args.fragment_cache else None
+    write_atomically(render_args.output_file, lambda f: render_plan(plan, f, fragment_cache=fragment_cache))
+    flush_fragment_caches()
+    sys.stdout.write('rendered {} pages in {}s\n'.format(len(plan['pages']), round(time.monotonic() - start_time, 3)))
+    return 0
+
+
+def get_fold_parser():
+    parser = argparse.ArgumentParser(
+        prog='scroll fold',
+        description='Fold the incremental updates appended by --update back into a PDF with a single xref table, '
+                    'leaving out the pages and fonts they replaced'
+    )
+    parser.add_argument(
+        'input_file',
+        help='The updated PDF'
+    )
+    parser.add_argument(
+        'output_file',
+        nargs='?',
+        help='Where to write the folded PDF. Defaults to replacing input_file'
+    )
+    parser.add_argument(
+        '--compact',
+        dest='compact',
+        action='store_true',
+        help='Also compact the folded PDF, see scroll --help. A compact PDF can no longer be updated'
+    )
+    return parser
+
+
+def fold(argv):
+    fold_args = get_fold_parser().parse_args(argv)
+    with open(fold_args.input_file, 'rb') as f:
+        data = f.read()
+    folded = fold_updates(data)
+    if fold_args.compact:
+        folded = compact_pdf(folded)
+
+    def write(path):
+        with open(path, 'wb') as f:
+            f.write(folded)
+
+    write_atomically(fold_args.output_file or fold_args.input_file, write)
+    sys.stdout.write('folded {}: {} bytes instead of {}\n'.format(fold_args.input_file, len(folded), len(data)))
+    return 0
+
+
+def watch(argv):
+    watch_args = get_watch_parser().parse_args(argv)
+    state_file = watch_args.state_file or os.path.splitext(watch_args.jobs_file)[0] + '.state'
+    state = read_watch_state(state_file)
+    while True:
+        # Re-read the jobs every poll so jobs can be added or changed without a restart
+        jobs = read_jobs(watch_args.jobs_file)
+        before_poll = time.monotonic()
+        state, failed = poll(jobs, state)
+        write_watch_state(state_file, state)
+        flush_fragment_caches()
+        sys.stdout.write('poll of {} jobs completed in {}s, {} failed, font subset cache: {} hits, {} misses\n'.format(
+            len(jobs), round(time.monotonic() - before_poll, 3), len(failed), font_subset_cache.hits,
+            font_subset_cache.misses))
+        if watch_args.once:
+            # So a poll run from cron can tell it failed
+            return 1 if failed else 0
+        time.sleep(watch_args.interval)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        return watch(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'render':
+        return render(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'fold':
+        return fold(sys.argv[2:])
+
+    args = get_parser().parse_args()
+    validate_args(args)
+    if args.descendants:
+        return render_descendants(args)
+
+    start_time = datetime.now()
+    if args.store:
+        sync_stores([args])
+    meetings, formats = load_data(args)
     after_get_data = datetime.now()
     sys.stdout.write('get_data completed in {}s\n'.format((after_get_data - start_time).total_seconds()))
-    get_pdf(args, meetings, formats)
+    content_hash = get_input_hash(args, meetings, formats) if args.render_cache and not args.dry_run else None
+    if args.presorted and args.auto_fit_pages:
+        # Every auto fit candidate is laid out from the same meetings
+        meetings = list(meetings)
+    elif isinstance(meetings, list):
+        # Hand the meetings over one at a time so each raw dict can be freed once it has been turned into a Meeting
+        meetings = drain(meetings)
+    if not args.presorted:
+        meetings = MeetingIndex(meetings)
+    if args.dry_run:
+        if args.auto_fit_pages:
+            kwargs, stats = auto_fit(args, meetings, formats)
+        else:
+            stats = Booklet(meetings, formats, None, **get_booklet_kwargs(args)).get_layout_stats()
+        print_layout_stats(stats)
+        flush_fragment_caches()
+        sys.stdout.write('dry run completed in {}s\n'.format((datetime.now() - after_get_data).total_seconds()))
+        return 0
+    get_pdf(args, meetings, formats, content_hash=content_hash)
+    flush_fragment_caches()
     after_get_pdf = datetime.now()
     sys.stdout.write('get_pdf completed in {}s\n'.format((after_get_pdf - after_get_data).total_seconds()))
 
@@ -1,10 +1,54 @@
+import collections
+import io
+import itertools
+import json
 import os
-from fpdf import FPDF
 from .bmlt_objects import Format, Meeting
-from .pdf_objects import (PDFColumnEnd, PDFMainSectionHeader, PDFSubSectionHeader, PDFFormatsTable, PDFMeeting,
-                          PDFBlankPage, PDFPhoneList, PDFTwelveSteps, PDFTwelveTraditions)
+from .coalesce import SingleFlight
+from .document import Document, font_subset_cache
+from .fetch import TomatoClient, fetch_meetings
+from .fragment_cache import FragmentCache
+from .grouping import MeetingIndex
+from .linearize import can_linearize
+from .metrics import TextMeasurer, get_font_metrics
+from .parallel import PARALLEL_MIN_MEETINGS, get_wrapped_lines
+from .pdf_objects import (PDFColumnEnd, PDFSectionHeader, PDFMainSectionHeader, PDFSubSectionHeader, PDFFormatsTable,
+                          PDFMeeting, PDFBlankPage, PDFPhoneList, PDFTwelveSteps, PDFTwelveTraditions,
+                          can_measure_in_batches, measure_meetings)
+from .plan import dump_plan, get_plan_options, load_placements, read_plan, write_plan
+from .progress import STAGE_LAYOUT, STAGE_RENDER, CancellationToken, RenderCancelled
+from .render_cache import RenderCache, get_content_hash, get_render_key, get_source_fingerprint
+from .update import UnsupportedUpdate, append_pages, fold_updates, get_kept_pages
 
 
+# The Python API. Everything else is imported from the module that defines it.
+__all__ = [
+    'Booklet',
+    'CancellationToken',
+    'Format',
+    'FragmentCache',
+    'LayoutStats',
+    'Meeting',
+    'MeetingIndex',
+    'RenderCache',
+    'RenderCancelled',
+    'RenderCoordinator',
+    'STAGE_LAYOUT',
+    'STAGE_RENDER',
+    'TomatoClient',
+    'UnsupportedUpdate',
+    'drain',
+    'fetch_meetings',
+    'fit_to_pages',
+    'fold_updates',
+    'font_subset_cache',
+    'read_plan',
+    'render_pdf',
+    'render_plan',
+    'render_update',
+    'write_plan',
+]
+
 weekdays = [
     'Sunday',
     'Monday',
@@ -16,6 +60,18 @@ weekdays = [
 ]
 
 
+# fill_ratios holds, for each booklet page, the fraction of the page's height taken up by its content
+LayoutStats = collections.namedtuple('LayoutStats', ['page_count', 'fill_ratios', 'continued_headers'])
+
+
+def drain(items):
+    """Yields the items of a list, removing each one from the list first so it can be freed as soon as the
+    consumer is done with it."""
+    items.reverse()
+    while items:
+        yield items.pop()
+
+
 class Booklet:
     PAPER_SIZES = {
         'letter': (216, 279),
@@ -32,6 +88,19 @@ class Booklet:
         HEADER_FIELD_WEEKDAY,
         HEADER_FIELD_CITY
     ]
+    FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dejavu-fonts-ttf-2.37/ttf/')
+    FONT_FILES = [
+        ('dejavusans', '', 'DejaVuSansCondensed.ttf'),
+        ('dejavusans', 'B', 'DejaVuSansCondensed-Bold.ttf'),
+        ('dejavusans', 'I', 'DejaVuSansCondensed-Oblique.ttf'),
+        ('dejavusans', 'BI', 'DejaVuSansCondensed-BoldOblique.ttf'),
+        ('dejavuserif', '', 'DejaVuSerifCondensed.ttf'),
+        ('dejavuserif', 'B', 'DejaVuSerifCondensed-Bold.ttf'),
+        ('dejavuserif', 'I', 'DejaVuSerifCondensed-Italic.ttf'),
+        ('dejavuserif', 'BI', 'DejaVuSerifCondensed-BoldItalic.ttf'),
+    ]
+    # How many meetings are read and measured together when numpy is installed
+    MEASURE_BATCH_SIZE = 1024
 
     def __init__(self, meetings, formats, output_file, bookletize=False, paper_size='Letter', time_column_width=None,
                  duration_column_width=None, meeting_font='dejavusans', meeting_font_size=10, header_font='dejavusans',
@@ -40,7 +109,8 @@ class Booklet:
                  formats_table_header_font='dejavusans', formats_table_header_font_size=14,
                  formats_table_key_column_width=10, formats_table_margin_width=5,
                  formats_table_header_font_color='#000000', formats_table_header_fill_color='#FFFFFF',
-                 margin_width=6):
+                 margin_width=6, creation_date=None, compact=False, linearize=False, render_cache=None,
+                 content_hash=None, fragment_cache=None, progress=None, cancellation_token=None, workers=1):
         self._meetings_data = meetings
         self._formats_data = formats
         self.output_file = output_file
@@ -73,34 +143,98 @@ class Booklet:
         self.formats_table_header_font_color = formats_table_header_font_color
         self.formats_table_header_fill_color = formats_table_header_fill_color
         self.margin_width = margin_width
+        self.creation_date = creation_date
+        self.compact = compact
+        # Set by the last write_pdf that rendered a compact PDF, rather than copying it from the render cache
+        self.compact_stats = None
+        if linearize and not can_linearize():
+            raise ValueError('Linearized output needs pikepdf or the qpdf command')
+        self.linearize = linearize
+        self.render_cache = render_cache
+        self.content_hash = content_hash
+        # A FragmentCache keeps meetings measured and drawn by earlier runs. It only changes how long rendering takes,
+        # not the PDF, so it isn't one of the options
+        self.fragment_cache = fragment_cache
+        # Called as progress(stage, done, total) after each meeting is laid out and each PDF page is drawn. total is
+        # None while laying out meetings that are streamed in.
+        self.progress = progress
+        self.cancellation_token = cancellation_token
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        # Only changes how long layout takes, not the PDF, so it isn't one of the options either
+        self.workers = workers
+
+    @property
+    def options(self):
+        # Everything besides the meetings and formats that affects the rendered PDF
+        return {
+            'bookletize': self.bookletize,
+            'paper_size': self.paper_size,
+            'time_column_width': self.time_column_width,
+            'duration_column_width': self.duration_column_width,
+            'meeting_font': self.meeting_font,
+            'meeting_font_size': self.meeting_font_size,
+            'header_font': self.header_font,
+            'header_font_size': self.header_font_size,
+            'main_header_field': self.main_header_field,
+            'second_header_field': self.second_header_field,
+            'meeting_separator_color': self.meeting_separator_color,
+            'formats_table_header_text': self.formats_table_header_text,
+            'formats_table_header_font': self.formats_table_header_font,
+            'formats_table_header_font_size': self.formats_table_header_font_size,
+            'formats_table_key_column_width': self.formats_table_key_column_width,
+            'formats_table_margin_width': self.formats_table_margin_width,
+            'formats_table_header_font_color': self.formats_table_header_font_color,
+            'formats_table_header_fill_color': self.formats_table_header_fill_color,
+            'margin_width': self.margin_width,
+            'creation_date': self.creation_date,
+            'compact': self.compact,
+            'linearize': self.linearize,
+        }
 
-    def _get_scratch_pdf_obj(self):
-        if not hasattr(self, '_scratch_pdf'):
-            self._scratch_pdf = self._get_pdf_obj()
-        return self._scratch_pdf
+    def get_render_key(self):
+        content_hash = self.content_hash
+        if content_hash is None:
+            if not isinstance(self._meetings_data, (list, tuple)):
+                raise ValueError('content_hash is required to use a render cache unless meetings is a list')
+            content_hash = get_content_hash(self._meetings_data, self._formats_data)
+        font_files = tuple(os.path.join(self.FONT_DIR, filename) for family, style, filename in self.FONT_FILES)
+        return get_render_key(content_hash, self.options, get_source_fingerprint(font_files))
 
-    def _get_pdf_obj(self):
+    @property
+    def font_metrics(self):
+        return get_font_metrics(
+            (family, style, os.path.join(self.FONT_DIR, filename)) for family, style, filename in self.FONT_FILES
+        )
+
+    def _get_page(self):
+        # A document without fonts, only used for its page geometry. Nothing draws on it, so
+        # it can be shared by every render of this booklet.
+        if not hasattr(self, '_page'):
+            self._page = self._get_pdf_obj(add_fonts=False)
+        return self._page
+
+    def _get_measure_func(self):
+        # Each layout pass measures with its own TextMeasurer, so several renders can run at
+        # the same time while sharing one copy of the font metrics
+        measurer = TextMeasurer(self.font_metrics, self._get_page())
+        return lambda: measurer
+
+    def _get_pdf_obj(self, add_fonts=True):
         if self.bookletize:
             # The bookletize option is for those who don't have, don't want to use, or don't
             # know how to use the "booklet" option on their printer. It does the hard work of
             # arranging the booklet pages on paper in a landscape orientation.
-            pdf = FPDF(orientation='L', format=self.paper_size)
+            pdf = Document(orientation='L', format=self.paper_size, creation_date=self.creation_date)
         else:
             # This produces booklet pages as single pdf pages. They're designed to be printed
             # using the "booklet" option on a printer, meaning two per page. For this reason,
             # we're dividing the specified paper size by 2.
-            pdf = FPDF(format=(self.paper_size[1] / 2, self.paper_size[0]))
+            pdf = Document(format=(self.paper_size[1] / 2, self.paper_size[0]), creation_date=self.creation_date)
         pdf.set_margins(self.margin_width, self.margin_width)
         pdf.set_auto_page_break(0, 5)
-        base_font_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dejavu-fonts-ttf-2.37/ttf/')
-        pdf.add_font('dejavusans', '', os.path.join(base_font_path, 'DejaVuSansCondensed.ttf'), uni=True)
-        pdf.add_font('dejavusans', 'B', os.path.join(base_font_path, 'DejaVuSansCondensed-Bold.ttf'), uni=True)
-        pdf.add_font('dejavusans', 'I', os.path.join(base_font_path, 'DejaVuSansCondensed-Oblique.ttf'), uni=True)
-        pdf.add_font('dejavusans', 'BI', os.path.join(base_font_path, 'DejaVuSansCondensed-BoldOblique.ttf'), uni=True)
-        pdf.add_font('dejavuserif', '', os.path.join(base_font_path, 'DejaVuSerifCondensed.ttf'), uni=True)
-        pdf.add_font('dejavuserif', 'B', os.path.join(base_font_path, 'DejaVuSerifCondensed-Bold.ttf'), uni=True)
-        pdf.add_font('dejavuserif', 'I', os.path.join(base_font_path, 'DejaVuSerifCondensed-Italic.ttf'), uni=True)
-        pdf.add_font('dejavuserif', 'BI', os.path.join(base_font_path, 'DejaVuSerifCondensed-BoldItalic.ttf'), uni=True)
+        if add_fonts:
+            pdf.add_font_metrics(self.font_metrics)
         return pdf
 
     @property
@@ -112,61 +246,124 @@ class Booklet:
 
     @property
     def effective_page_width(self):
-        pdf = self._get_scratch_pdf_obj()
+        pdf = self._get_page()
         return pdf.w - pdf.l_margin - pdf.r_margin
 
     @property
     def effective_page_height(self):
-        pdf = self._get_scratch_pdf_obj()
+        pdf = self._get_page()
         return pdf.h - pdf.t_margin - pdf.b_margin
 
-    def get_pdf_objects(self):
-        def _append_pdf_objects(l, objs, pos):
-            height = sum([o.height for o in objs])
-            if pos + height > self.effective_page_height:
-                l.append(PDFColumnEnd())
-                if not isinstance(objs[0], PDFMainSectionHeader):
-                    for obj in l[::-1]:
-                        if isinstance(obj, PDFMainSectionHeader):
-                            cont_header = obj.copy()
-                            if not cont_header.text.endswith('(Continued)'):
-                                cont_header.text += ' (Continued)'
-                            height += cont_header.height
-                            l.append(cont_header)
-                            break
-                    if not isinstance(objs[0], PDFSubSectionHeader):
-                        for obj in l[::-1]:
-                            if isinstance(obj, PDFSubSectionHeader):
-                                cont_header = obj.copy()
-                                if not cont_header.text.endswith('(Continued)'):
-                                    cont_header.text += ' (Continued)'
-                                height += cont_header.height
-                                l.append(cont_header)
-                                break
-                pos = 0
-            l.extend(objs)
-            pos += height
-            return pos
-
-        pdf_objects = [
-            PDFBlankPage(self._get_scratch_pdf_obj),
-            PDFColumnEnd()
-        ]
+    def _iter_meetings(self):
+        meetings = self._meetings_data
+        if meetings is None:
+            raise RuntimeError('The meetings iterator passed to Booklet has already been consumed')
+        if isinstance(meetings, MeetingIndex):
+            meetings = meetings.ordered(self.main_header_field, self.second_header_field)
+        elif iter(meetings) is meetings:
+            # A one-shot iterator can only be laid out once, and there's no reason to hold on to it
+            self._meetings_data = None
+        for m in meetings:
+            yield m if isinstance(m, Meeting) else Meeting(m)
+
+    def _check_cancelled(self):
+        if self.cancellation_token is not None:
+            self.cancellation_token.raise_if_cancelled()
+
+    def _report_progress(self, stage, done, total):
+        if self.progress is not None:
+            self.progress(stage, done, total)
+
+    def _get_meeting_count(self):
+        if isinstance(self._meetings_data, MeetingIndex):
+            return len(self._meetings_data.meetings)
+        if isinstance(self._meetings_data, (list, tuple)):
+            return len(self._meetings_data)
+        return None
+
+    def _use_workers(self):
+        # Measuring in other processes needs every meeting up front, which a list or MeetingIndex already has in
+        # memory. Meetings found in a fragment cache aren't measured at all, so they're left to measure themselves.
+        meeting_count = self._get_meeting_count()
+        return (
+            self.workers > 1 and
+            self.fragment_cache is None and
+            meeting_count is not None and
+            meeting_count >= PARALLEL_MIN_MEETINGS
+        )
+
+    def _iter_pdf_meetings(self, pdf_func, meeting_kwargs):
+        if self._use_workers():
+            # Every meeting is measured first, a section at a time, in worker processes, and laying the meetings out
+            # in columns is left with adding up heights
+            meetings = list(self._iter_meetings())
+            self._check_cancelled()
+            wrapped_lines = get_wrapped_lines(
+                meetings,
+                self.main_header_field,
+                self.workers,
+                self.font_metrics.font_files,
+                self._get_page(),
+                self.booklet_page_width,
+                meeting_kwargs,
+                cancellation_token=self.cancellation_token
+            )
+            for m, lines in zip(drain(meetings), wrapped_lines):
+                yield PDFMeeting(m, pdf_func, self.booklet_page_width, wrapped_lines=lines, **meeting_kwargs)
+            return
+        meetings = (
+            PDFMeeting(m, pdf_func, self.booklet_page_width, fragment_cache=self.fragment_cache, **meeting_kwargs)
+            for m in self._iter_meetings()
+        )
+        # Like workers, batches aren't used with a fragment cache, whose hits aren't measured
+        if self.fragment_cache is not None or not can_measure_in_batches(pdf_func()):
+            yield from meetings
+            return
+        # Meetings are still read a batch at a time, so only one batch is held on to before it's laid out
+        while True:
+            batch = list(itertools.islice(meetings, self.MEASURE_BATCH_SIZE))
+            if not batch:
+                return
+            self._check_cancelled()
+            measure_meetings(pdf_func(), batch)
+            yield from batch
+
+    def _get_meeting_kwargs(self):
+        return {
+            'time_column_width': self.time_column_width,
+            'duration_column_width': self.duration_column_width,
+            'font': self.meeting_font,
+            'font_size': self.meeting_font_size,
+            'separator_color': self.meeting_separator_color,
+        }
+
+    def get_pdf_objects(self, pdf_func=None):
+        # This is a generator so that each meeting is turned into a Meeting, measured and placed
+        # before the next one is read. Nothing is held on to besides the objects themselves.
+        if pdf_func is None:
+            pdf_func = self._get_measure_func()
+
+        def _get_continued_header(header):
+            cont_header = header.copy()
+            if not cont_header.text.endswith('(Continued)'):
+                cont_header.text += ' (Continued)'
+            return cont_header
+
+        yield PDFBlankPage(pdf_func)
+        yield PDFColumnEnd()
 
         # Add meetings
+        meeting = None
         prev_main_header = None
         prev_second_header = None
+        last_main_section_header = None
+        last_sub_section_header = None
         current_content_position = 0
-        for m in self._meetings_data:
+        meeting_kwargs = self._get_meeting_kwargs()
+        meeting_count = self._get_meeting_count()
+        for i, meeting in enumerate(self._iter_pdf_meetings(pdf_func, meeting_kwargs)):
+            self._check_cancelled()
             append_objs = []
-            meeting = PDFMeeting(
-                Meeting(m), self._get_scratch_pdf_obj, self.booklet_page_width,
-                time_column_width=self.time_column_width,
-                duration_column_width=self.duration_column_width,
-                font=self.meeting_font,
-                font_size=self.meeting_font_size,
-                separator_color=self.meeting_separator_color
-            )
             new_main_header = getattr(meeting.meeting, self.main_header_field)
             if new_main_header != prev_main_header:
                 if self.main_header_field == self.HEADER_FIELD_WEEKDAY:
@@ -175,7 +372,7 @@ class Booklet:
                     text = new_main_header
                 header = PDFMainSectionHeader(
                     text,
-                    self._get_scratch_pdf_obj,
+                    pdf_func,
                     self.booklet_page_width,
                     font=self.header_font,
                     font_size=self.header_font_size
@@ -192,7 +389,7 @@ class Booklet:
                         text = new_second_header
                     header = PDFSubSectionHeader(
                         text,
-                        self._get_scratch_pdf_obj,
+                        pdf_func,
                         self.booklet_page_width,
                         font=self.header_font,
                         font_size=self.header_font_size
@@ -200,15 +397,38 @@ class Booklet:
                     append_objs.append(header)
                     prev_second_header = new_second_header
             append_objs.append(meeting)
-            current_content_position = _append_pdf_objects(pdf_objects, append_objs, current_content_position)
+
+            height = sum([o.height for o in append_objs])
+            if current_content_position + height > self.effective_page_height:
+                yield PDFColumnEnd()
+                if not isinstance(append_objs[0], PDFMainSectionHeader):
+                    if last_main_section_header:
+                        cont_header = _get_continued_header(last_main_section_header)
+                        height += cont_header.height
+                        last_main_section_header = cont_header
+                        yield cont_header
+                    if not isinstance(append_objs[0], PDFSubSectionHeader) and last_sub_section_header:
+                        cont_header = _get_continued_header(last_sub_section_header)
+                        height += cont_header.height
+                        last_sub_section_header = cont_header
+                        yield cont_header
+                current_content_position = 0
+            for obj in append_objs:
+                if isinstance(obj, PDFMainSectionHeader):
+                    last_main_section_header = obj
+                elif isinstance(obj, PDFSubSectionHeader):
+                    last_sub_section_header = obj
+                yield obj
+            current_content_position += height
+            self._report_progress(STAGE_LAYOUT, i + 1, meeting_count)
 
         # Add formats page
-        if not isinstance(pdf_objects[-1], PDFColumnEnd):
-            pdf_objects.append(PDFColumnEnd())
+        if meeting is not None:
+            yield PDFColumnEnd()
         formats = [Format(f) for f in self._formats_data]
         formats_table = PDFFormatsTable(
             formats,
-            self._get_scratch_pdf_obj,
+            pdf_func,
             self.booklet_page_width,
             font=self.meeting_font,
             font_size=self.meeting_font_size,
@@ -220,29 +440,26 @@ class Booklet:
             header_font_color=self.formats_table_header_font_color,
             header_fill_color=self.formats_table_header_fill_color
         )
-        pdf_objects.append(formats_table)
+        yield formats_table
 
         # Fill in formats page with phone number list
         blank_space = self.effective_page_height - formats_table.height
-        phone_list = PDFPhoneList(self._get_scratch_pdf_obj, self.booklet_page_width, blank_space)
+        phone_list = PDFPhoneList(pdf_func, self.booklet_page_width, blank_space)
         if phone_list.height <= blank_space:
-            pdf_objects.append(phone_list)
-        return pdf_objects
+            yield phone_list
 
     def get_pages(self):
-        pdf_objects = self.get_pdf_objects()
+        pdf_func = self._get_measure_func()
         pages = []
         current_page = []
-        for i in range(len(pdf_objects)):
-            obj = pdf_objects[i]
+        for obj in self.get_pdf_objects(pdf_func):
             if isinstance(obj, PDFColumnEnd):
                 pages.append(current_page)
                 current_page = []
                 continue
             current_page.append(obj)
-            if i == len(pdf_objects) - 1:
-                pages.append(current_page)
-                current_page = []
+        if current_page:
+            pages.append(current_page)
 
         # Make sure the number of pages is a multiple of 4, and fill in the
         # blank pages
@@ -261,7 +478,8 @@ class Booklet:
             for cls in [f for f in available_page_fillers if f not in used_page_fillers]:
                 font_size = 8
                 while True:
-                    instance = cls(self._get_scratch_pdf_obj, self.booklet_page_width, font_size=font_size)
+                    self._check_cancelled()
+                    instance = cls(pdf_func, self.booklet_page_width, font_size=font_size)
                     if instance.height < self.effective_page_height:
                         add_obj = instance
                         add_obj_cls = cls
@@ -274,61 +492,275 @@ class Booklet:
                 used_page_fillers.append(add_obj_cls)
                 pages.insert(len(pages) - 1, [add_obj])
             else:
-                pages.insert(len(pages) - 1, [PDFBlankPage(self._get_scratch_pdf_obj)])
+                pages.insert(len(pages) - 1, [PDFBlankPage(pdf_func)])
         return pages
 
-    def write_pdf(self):
-        pdf = self._get_pdf_obj()
-        booklet_pages = self.get_pages()
+    def get_layout_stats(self):
+        """Lays the booklet out without writing a PDF and returns its LayoutStats."""
+        pages = self.get_pages()
+        fill_ratios = []
+        continued_headers = 0
+        for page in pages:
+            fill_ratios.append(sum(obj.height or 0 for obj in page) / self.effective_page_height)
+            for obj in page:
+                if isinstance(obj, PDFSectionHeader) and obj.text.endswith('(Continued)'):
+                    continued_headers += 1
+        return LayoutStats(len(pages), fill_ratios, continued_headers)
 
-        if self.bookletize:
+    def write_pdf(self, output=None):
+        """Writes the PDF to output, a path or a binary file-like object such as a socket or an HTTP response body.
+        Defaults to output_file."""
+        if output is None:
+            output = self.output_file
+        if self.render_cache:
+            render_key = self.get_render_key()
+            if self.render_cache.get(render_key, output):
+                return
+        pdf = self._get_document()
+        if self.render_cache:
+            with self.render_cache.open_entry(render_key) as f:
+                pdf.write_to(f)
+        pdf.write_to(output)
+
+    def get_pdf_bytes(self):
+        """Returns the PDF as bytes."""
+        output = io.BytesIO()
+        self.write_pdf(output)
+        return output.getvalue()
+
+    def _get_sheets(self, page_count):
+        # Returns the booklet page numbers on each PDF page, in order, as lists of (page number, column) pairs
+        if not self.bookletize:
+            return [[(number, 0)] for number in range(1, page_count + 1)]
+
+        numbers = list(range(1, page_count + 1))
+        sheets = [[(numbers.pop(), 0), (numbers.pop(0), 1)]]
+        total_booklet_length = len(numbers)
+        last_booklet_page_blank = total_booklet_length % 2 != 0
+        if last_booklet_page_blank or total_booklet_length in [3, 4]:
+            sheets.append([(numbers.pop(0), 0)])
+        if total_booklet_length in [3, 4]:
+            sheets.append([(numbers.pop(0), 1)])
+        while numbers:
+            odd_pdf_page = (len(sheets) + 1) % 2 == 1
+            sheet = [(numbers.pop() if odd_pdf_page else numbers.pop(0), 0)]
+            if numbers:
+                sheet.append((numbers.pop(0) if odd_pdf_page else numbers.pop(), 1))
+            sheets.append(sheet)
+        return sheets
+
+    def get_placements(self, pages=None):
+        """
+        Returns where each object of the laid out booklet is drawn: a list with one entry per PDF page, each a list of
+        (booklet page number, object, x, y) tuples. With bookletize, each PDF page holds two booklet pages side by
+        side.
+        """
+        if pages is None:
+            pages = self.get_pages()
+        page = self._get_page()
+        column_width = (self.effective_page_width / 2) - self.margin_width
+        column_xs = [page.l_margin, column_width + page.l_margin + (self.margin_width * 2)]
+        ret = []
+        for sheet in self._get_sheets(len(pages)):
+            placements = []
+            for number, column in sheet:
+                y = page.t_margin
+                for obj in pages[number - 1]:
+                    placements.append((number, obj, column_xs[column], y))
+                    y += obj.advance
+            ret.append(placements)
+        return ret
+
+    def get_plan(self):
+        """Lays the booklet out and returns its layout plan, which render_plan turns into the same PDF, e.g. in another
+        process or on another machine."""
+        paper_size = next(name for name, size in self.PAPER_SIZES.items() if size == self.paper_size)
+        options = dict(self.options, paper_size=paper_size)
+        meeting_kwargs = dict(self._get_meeting_kwargs(), total_width=self.booklet_page_width)
+        return dump_plan(options, meeting_kwargs, self.get_placements())
+
+    def _get_document(self, placements=None):
+        if placements is None:
+            placements = self.get_placements()
+        pdf = self._get_pdf_obj()
+        for i, sheet in enumerate(placements):
+            self._check_cancelled()
             pdf.add_page()
-            effective_page_width = pdf.w - pdf.l_margin - pdf.r_margin
-            column_width = (effective_page_width / 2) - self.margin_width
-
-            last_page = booklet_pages.pop()
-            for obj in last_page:
-                obj.write(pdf)
-
-            first_page = booklet_pages.pop(0)
-            for obj in first_page:
-                obj.write(pdf, x=column_width + pdf.l_margin + (self.margin_width * 2), y=pdf.get_y())
-
-            total_booklet_length = len(booklet_pages)
-            last_booklet_page_blank = total_booklet_length % 2 != 0
-            if last_booklet_page_blank or total_booklet_length in [3, 4]:
-                pdf.add_page()
-                left_page = booklet_pages.pop(0)
-                for obj in left_page:
-                    obj.write(pdf)
-            if total_booklet_length in [3, 4]:
-                pdf.add_page()
-                right_page = booklet_pages.pop(0)
-                last_y = pdf.get_y()
-                for obj in right_page:
-                    obj.write(pdf, x=column_width + pdf.l_margin + (self.margin_width * 2), y=last_y)
-                    last_y = pdf.get_y()
-
-            while booklet_pages:
-                pdf.add_page()
-                odd_pdf_page = pdf.page_no() % 2 == 1
-                original_y = pdf.get_y()
-
-                left_page = booklet_pages.pop() if odd_pdf_page else booklet_pages.pop(0)
-                for obj in left_page:
-                    obj.write(pdf)
-
-                if booklet_pages:
-                    last_y = original_y
-                    right_page = booklet_pages.pop(0) if odd_pdf_page else booklet_pages.pop()
-                    for obj in right_page:
-                        obj.write(pdf, x=column_width + pdf.l_margin + (self.margin_width * 2), y=last_y)
-                        last_y = pdf.get_y()
-        else:
-            for page in booklet_pages:
-                pdf.add_page()
-                for obj in page:
-                    obj.write(pdf)
+            for number, obj, x, y in sheet:
+                obj.write(pdf, x=x, y=y)
+            self._report_progress(STAGE_RENDER, i + 1, len(placements))
+
+        pdf.close()
+        if self.fragment_cache:
+            self.fragment_cache.flush()
+        if self.compact:
+            self.compact_stats = pdf.compact()
+        if self.linearize:
+            pdf.linearize()
+        return pdf
 
-        pdf.output(self.output_file, 'F')
+
+def render_pdf(meetings, formats, output=None, **options):
+    """
+    Renders a booklet and returns it as bytes, or writes it to output, a path or a binary file-like object, if one is
+    given. Nothing touches the filesystem unless output is a path or a render_cache is passed.
+
+    meetings and formats are what tomato's GetSearchResults returns with get_used_formats set: lists of dicts, in any
+    order, since the meetings are sorted here. meetings may also be a MeetingIndex, or any iterable of meeting dicts or
+    Meeting objects already in order. options are Booklet's keyword arguments, e.g. paper_size='letter'.
+    """
+    if isinstance(meetings, (list, tuple)):
+        if options.get('render_cache') and not options.get('content_hash'):
+            # The index can't be hashed, so hash the meetings before they're indexed
+            options['content_hash'] = get_content_hash(meetings, formats)
+        meetings = MeetingIndex(meetings)
+    booklet = Booklet(meetings, formats, None, **options)
+    if output is None:
+        return booklet.get_pdf_bytes()
+    booklet.write_pdf(output)
+
+
+def render_plan(plan, output=None, fragment_cache=None, progress=None, cancellation_token=None):
+    """
+    Renders a layout plan, as returned by Booklet.get_plan, and returns the PDF as bytes, or writes it to output, a
+    path or a binary file-like object, if one is given. Nothing is laid out or measured again.
+    """
+    booklet = Booklet(None, None, None, fragment_cache=fragment_cache, progress=progress,
+                      cancellation_token=cancellation_token, **get_plan_options(plan))
+    placements = load_placements(plan, booklet._get_measure_func(), fragment_cache=fragment_cache)
+    pdf = booklet._get_document(placements)
+    if output is None:
+        output = io.BytesIO()
+        pdf.write_to(output)
+        return output.getvalue()
+    pdf.write_to(output)
+
+
+def render_update(previous_pdf, previous_plan, plan, output=None, fragment_cache=None, progress=None,
+                  cancellation_token=None):
+    """
+    Renders a layout plan as an update of previous_pdf, the bytes of the PDF rendered from previous_plan, and returns
+    the updated PDF as bytes, or writes it to output, a path or a binary file-like object, if one is given.
+
+    Only the PDF pages that aren't drawn exactly the same in both plans are rendered. They're appended to
+    previous_pdf as an incremental update, see append_pages, so previous_pdf itself is left as it is at the start of
+    the file. Raises UnsupportedUpdate if that can't be done, e.g. because the plans have different options, in which
+    case the plan has to be rendered in full with render_plan.
+    """
+    kept = get_kept_pages(previous_plan, plan)
+    rendered = None
+    if None in kept:
+        booklet = Booklet(None, None, None, fragment_cache=fragment_cache, progress=progress,
+                          cancellation_token=cancellation_token, **get_plan_options(plan))
+        placements = load_placements(plan, booklet._get_measure_func(), fragment_cache=fragment_cache)
+        rendered = io.BytesIO()
+        booklet._get_document([sheet for sheet, i in zip(placements, kept) if i is None]).write_to(rendered)
+        rendered = rendered.getvalue()
+    data = append_pages(previous_pdf, kept, rendered)
+    if output is None:
+        return data
+    if not hasattr(output, 'write'):
+        with open(output, 'wb') as f:
+            f.write(data)
         return
+    output.write(data)
+
+
+class RenderCoordinator:
+    """
+    Renders booklets for many threads at once, e.g. the request handlers of a web server, without repeating work for
+    identical requests that arrive together.
+
+    fetch is called as fetch(service_body_ids, recursive) and returns the meetings and formats to render, e.g.
+    lambda ids, recursive: fetch_meetings(client, tomato_url, ids, recursive). A render is identified by its service
+    body ids, the recursive flag and every Booklet option that affects the PDF. Requests for a render that is already
+    in flight wait for it and get the same bytes, and requests for the same service bodies share one fetch even when
+    their options differ. Nothing is kept once a render finishes, pass a render_cache for that.
+
+    renders and fetches are the SingleFlight instances that coalesce them, which count hits, misses and wait times.
+    A progress callback in options belongs to whichever request starts the render. A cancellation_token only belongs
+    to its own request: cancelling it makes that request raise RenderCancelled, and the render itself is only
+    cancelled once every request waiting for it has been cancelled.
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.renders = SingleFlight()
+        self.fetches = SingleFlight()
+
+    @staticmethod
+    def get_service_body_key(service_body_ids):
+        return tuple(sorted(set(str(i).strip() for i in service_body_ids)))
+
+    @staticmethod
+    def get_render_key(service_body_ids, recursive, options):
+        # Booklet fills in defaults and normalizes e.g. the paper size, so options that render the same PDF match
+        booklet_options = Booklet(None, None, None, **options).options
+        return (
+            RenderCoordinator.get_service_body_key(service_body_ids),
+            bool(recursive),
+            json.dumps(booklet_options, sort_keys=True, default=str)
+        )
+
+    def _fetch(self, service_body_ids, recursive):
+        def fetch():
+            meetings, formats = self.fetch(list(service_body_ids), recursive)
+            meetings = list(meetings)
+            # The index is only read while laying out, so every render of these service bodies can share it
+            return MeetingIndex(meetings), formats, get_content_hash(meetings, formats)
+        return self.fetches.do((service_body_ids, bool(recursive)), fetch)
+
+    def render(self, service_body_ids, recursive=False, **options):
+        """Returns the PDF of service_body_ids as bytes. options are Booklet's keyword arguments."""
+        cancellation_token = options.pop('cancellation_token', None)
+        key = self.get_render_key(service_body_ids, recursive, options)
+
+        def render(shared_token):
+            index, formats, content_hash = self._fetch(key[0], recursive)
+            options.update(content_hash=content_hash, cancellation_token=shared_token)
+            return render_pdf(index, formats, **options)
+        return self.renders.do_cancellable(key, render, cancellation_token)
+
+
+def get_scaled_options(options, meeting_font_size):
+    """Returns a copy of options with the given meeting font size, and the header font size and the time and duration
+    columns scaled by the same amount."""
+    scale = meeting_font_size / options.get('meeting_font_size', 10)
+    time_column_width = options.get('time_column_width') or PDFMeeting.DEFAULT_TIME_COLUMN_WIDTH
+    duration_column_width = options.get('duration_column_width') or PDFMeeting.DEFAULT_DURATION_COLUMN_WIDTH
+    return dict(
+        options,
+        meeting_font_size=meeting_font_size,
+        header_font_size=round(options.get('header_font_size', 10) * scale * 2) / 2,
+        time_column_width=round(time_column_width * scale, 1),
+        duration_column_width=round(duration_column_width * scale, 1)
+    )
+
+
+def fit_to_pages(meetings, formats, pages, min_font_size=6, max_font_size=20, log=None, **options):
+    """
+    Finds the largest meeting font size, in steps of half a point, at which the booklet takes up at most pages pages,
+    and returns the options to render it with along with their LayoutStats. The header font size and the time and
+    duration columns are scaled along with the meeting font size, see get_scaled_options.
+
+    Every candidate is only laid out, not written, so meetings must be a list or a MeetingIndex that can be laid out
+    more than once. The search is a binary search, which assumes a larger font never takes up fewer pages.
+    """
+    font_sizes = [size / 2 for size in range(int(min_font_size * 2), int(max_font_size * 2) + 1)]
+    best = None
+    low, high = 0, len(font_sizes) - 1
+    while low <= high:
+        mid = (low + high) // 2
+        candidate = get_scaled_options(options, font_sizes[mid])
+        stats = Booklet(meetings, formats, None, **candidate).get_layout_stats()
+        if log:
+            log('meeting font size {}: {} pages'.format(font_sizes[mid], stats.page_count))
+        if stats.page_count <= pages:
+            best = candidate, stats
+            low = mid + 1
+        else:
+            high = mid - 1
+    if best is None:
+        raise Exception('The meetings do not fit in {} pages, even with a meeting font size of {}'.format(
+            pages, min_font_size))
+    return best
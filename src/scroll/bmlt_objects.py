@@ -93,6 +93,23 @@ class Format:
 
 
 class Meeting:
+    # Every field read below. Fetches ask tomato for only these, so keep them in sync
+    FIELDS = [
+        'meeting_name',
+        'start_time',
+        'duration_time',
+        'weekday_tinyint',
+        'location_text',
+        'location_street',
+        'location_municipality',
+        'location_province',
+        'location_postal_code_1',
+        'nation',
+        'formats',
+        'format_shared_id_list',
+        'service_body_bigint',
+    ]
+
     def __init__(self, bmlt_object):
         self.name = get_required_str(bmlt_object, 'meeting_name')
         self.start_time = get_time(bmlt_object, 'start_time')
@@ -106,6 +123,7 @@ class Meeting:
         self.nation = bmlt_object.get('nation')
         self.formats = bmlt_object.get('formats', '')
         self.format_ids = get_int_list(bmlt_object, 'format_shared_id_list')
+        self.service_body_id = bmlt_object.get('service_body_bigint')
 
     @property
     def location(self):
@@ -0,0 +1,119 @@
+import concurrent.futures
+import threading
+import time
+from .progress import CancellationToken
+
+
+# Seconds between checks of a waiting caller's own cancellation token
+CANCEL_POLL_INTERVAL = 0.05
+
+
+class Flight:
+    # A call in flight: the future its callers wait on, the cancellation token it runs with and how many callers
+    # are still waiting for it
+    def __init__(self):
+        self.future = concurrent.futures.Future()
+        self.token = CancellationToken()
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs a function at most once at a time for each key. A caller asking for a key that is already being worked on
+    waits for that call instead of starting its own, and gets the same result, or the same exception.
+
+    Results aren't kept once the call finishes, so this only coalesces calls that overlap. hits counts the callers
+    that joined a call in flight, misses the calls actually made, and wait_time and max_wait how long the callers
+    that joined waited, in seconds.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def _join(self, key):
+        # Returns the flight for key and whether the caller has to start it. A flight every caller has given up on
+        # is left to wind down on its own, and a new caller starts a fresh one.
+        with self._lock:
+            flight = self._in_flight.get(key)
+            if flight is None or flight.token.cancelled:
+                flight = Flight()
+                self._in_flight[key] = flight
+                self.misses += 1
+                leader = True
+            else:
+                self.hits += 1
+                leader = False
+            flight.waiters += 1
+            return flight, leader
+
+    def _run(self, key, flight, func, *args):
+        try:
+            result = func(*args)
+        except BaseException as e:
+            flight.future.set_exception(e)
+            raise
+        else:
+            flight.future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                if self._in_flight.get(key) is flight:
+                    del self._in_flight[key]
+
+    def _record_wait(self, started):
+        waited = time.monotonic() - started
+        with self._lock:
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def do(self, key, func):
+        flight, leader = self._join(key)
+        if leader:
+            return self._run(key, flight, func)
+        started = time.monotonic()
+        try:
+            return flight.future.result()
+        finally:
+            self._record_wait(started)
+
+    def do_cancellable(self, key, func, cancellation_token=None):
+        """
+        Like do, for a func that takes a CancellationToken and stops once it's cancelled. func runs in a thread of its
+        own, with a token shared by every caller of key, so each caller can give up on its own: once a caller's
+        cancellation_token is cancelled it stops waiting and raises RenderCancelled, while the others keep waiting.
+        The shared token is only cancelled when every caller waiting for the call has given up.
+        """
+        flight, leader = self._join(key)
+        if leader:
+            # Errors reach the callers through the future, so the thread itself has nothing to report
+            def run():
+                try:
+                    self._run(key, flight, func, flight.token)
+                except BaseException:
+                    pass
+            threading.Thread(target=run, daemon=True).start()
+        started = time.monotonic()
+        try:
+            while True:
+                if cancellation_token is not None and cancellation_token.cancelled:
+                    with self._lock:
+                        flight.waiters -= 1
+                        if flight.waiters == 0:
+                            flight.token.cancel()
+                    cancellation_token.raise_if_cancelled()
+                try:
+                    return flight.future.result(timeout=CANCEL_POLL_INTERVAL if cancellation_token else None)
+                except concurrent.futures.TimeoutError:
+                    pass
+        finally:
+            if not leader:
+                self._record_wait(started)
@@ -0,0 +1,432 @@
+"""
+Rewrites the PDF FPDF produces into a smaller PDF 1.5 file that draws exactly the same pages.
+
+FPDF writes PDF 1.3: every object is stored on its own behind a classic xref table, every face registered with the
+document is embedded whether it was used or not, each font carries its own copy of the same ToUnicode CMap, and
+state like the separator color is set again before every line drawn. compact_pdf() keeps the drawing itself as it is
+and only changes how it's stored:
+
+- faces no page uses are dropped from the resources, along with everything they reference
+- byte-identical objects, like the per-font CMaps and CIDSystemInfo dictionaries, are stored once and shared
+- colors, line widths and fonts that are set to the value they already have are left out of the page contents, so a
+  page's separators share one stroke color and line width
+- streams are compressed with zlib's best compression, and the ones FPDF leaves uncompressed are compressed too
+- every object without a stream is packed into compressed object streams, indexed by a compressed xref stream
+"""
+import collections
+import re
+import zlib
+
+
+# Objects per object stream. Viewers decompress a whole object stream to read any object in it.
+OBJECTS_PER_STREAM = 100
+
+CompactStats = collections.namedtuple('CompactStats', ['original_size', 'compact_size'])
+
+PDFObject = collections.namedtuple('PDFObject', ['dictionary', 'stream'])
+
+REFERENCE_RE = re.compile(rb'\((?:\\.|[^\\()])*\)|(\d+) 0 R', re.S)
+XREF_ENTRY_RE = re.compile(rb'(\d{10}) (\d{5}) ([nf])')
+CONTENT_TOKEN_RE = re.compile(
+    rb'\((?:\\.|[^\\()])*\)|<<|>>|<[0-9A-Fa-f\s]*>|[\[\]]|/[^\s/\[\]()<>{}%]*|[^\s/\[\]()<>{}%]+|%[^\r\n]*',
+    re.S
+)
+# First bytes of the tokens that aren't operators: numbers, names, strings, arrays and dictionaries
+OPERAND_START_BYTES = frozenset(b'0123456789+-./([]<>')
+OPERAND_KEYWORDS = frozenset((b'true', b'false', b'null'))
+COMMENT_START_BYTE = ord('%')
+
+# Operators that set a part of the graphics state to the values of their operands
+STATE_OPERATORS = {
+    b'w': 'line_width',
+    b'J': 'line_cap',
+    b'j': 'line_join',
+    b'G': 'stroke_color',
+    b'RG': 'stroke_color',
+    b'K': 'stroke_color',
+    b'g': 'fill_color',
+    b'rg': 'fill_color',
+    b'k': 'fill_color',
+    b'Tf': 'font',
+}
+
+# Operators that change parts of the graphics state in ways that aren't tracked
+RESET_OPERATORS = {
+    b'CS': ('stroke_color',),
+    b'SC': ('stroke_color',),
+    b'SCN': ('stroke_color',),
+    b'cs': ('fill_color',),
+    b'sc': ('fill_color',),
+    b'scn': ('fill_color',),
+    b'gs': tuple(set(STATE_OPERATORS.values())),
+}
+
+
+class UnsupportedPDF(Exception):
+    pass
+
+
+def find_dictionary_end(data, start):
+    """Returns the offset just past the dictionary starting at start, skipping strings, which may hold brackets."""
+    depth = 0
+    i = start
+    length = len(data)
+    while i < length:
+        c = data[i:i + 1]
+        if c == b'(':
+            # Literal strings may contain balanced parentheses and escapes
+            nesting = 0
+            while i < length:
+                c = data[i:i + 1]
+                if c == b'\\':
+                    i += 2
+                    continue
+                if c == b'(':
+                    nesting += 1
+                elif c == b')':
+                    nesting -= 1
+                    if nesting == 0:
+                        break
+                i += 1
+        elif data.startswith(b'<<', i):
+            depth += 1
+            i += 1
+        elif data.startswith(b'>>', i):
+            depth -= 1
+            i += 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    raise UnsupportedPDF('Unterminated dictionary at {}'.format(start))
+
+
+def parse_pdf(data):
+    """Returns the objects of a PDF written with classic xref tables, by number, and its trailer dictionary. Sections
+    appended as incremental updates are followed back through their /Prev offsets, and only the latest version of
+    each object is returned, along with the latest trailer."""
+    startxref = data.rindex(b'startxref')
+    xref_offset = int(data[startxref + len(b'startxref'):].split()[0])
+    offsets = {}
+    trailer = None
+    seen = set()
+    while xref_offset is not None:
+        if xref_offset in seen:
+            raise UnsupportedPDF('The xref sections of the PDF refer back to each other')
+        seen.add(xref_offset)
+        if not data.startswith(b'xref', xref_offset):
+            raise UnsupportedPDF('Only PDFs with classic xref tables are supported')
+        trailer_offset = data.index(b'trailer', xref_offset)
+        number = None
+        for line in data[xref_offset:trailer_offset].split(b'\n')[1:]:
+            fields = line.split()
+            if len(fields) == 2:
+                number = int(fields[0])
+                continue
+            match = XREF_ENTRY_RE.match(line)
+            if match:
+                # Sections are read newest first, so an object already seen has been replaced or freed since
+                offsets.setdefault(number, int(match.group(1)) if match.group(3) == b'n' else None)
+                number += 1
+        dictionary_start = data.index(b'<<', trailer_offset)
+        section_trailer = data[dictionary_start:find_dictionary_end(data, dictionary_start)]
+        if trailer is None:
+            trailer = section_trailer
+        previous = re.search(rb'/Prev\s+(\d+)', section_trailer)
+        xref_offset = int(previous.group(1)) if previous else None
+    objects = {}
+    for number, offset in sorted(offsets.items()):
+        if offset is not None:
+            objects[number] = parse_object(data, offset, number)
+    return objects, trailer
+
+
+def parse_object(data, offset, number):
+    header = '{} 0 obj'.format(number).encode('latin-1')
+    if not data.startswith(header, offset):
+        raise UnsupportedPDF('Object {} is not at its xref offset'.format(number))
+    start = offset + len(header)
+    while data[start:start + 1].isspace():
+        start += 1
+    if not data.startswith(b'<<', start):
+        end = data.index(b'endobj', start)
+        return PDFObject(data[start:end].strip(), None)
+    end = find_dictionary_end(data, start)
+    dictionary = data[start:end]
+    stream_start = end
+    while data[stream_start:stream_start + 1].isspace():
+        stream_start += 1
+    if not data.startswith(b'stream', stream_start):
+        return PDFObject(dictionary, None)
+    stream_start += len(b'stream')
+    if data.startswith(b'\r\n', stream_start):
+        stream_start += 2
+    else:
+        stream_start += 1
+    length = re.search(rb'/Length (\d+)\b(?!\s+\d+\s+R)', dictionary)
+    if length is None:
+        raise UnsupportedPDF('Object {} has no direct /Length'.format(number))
+    stream = data[stream_start:stream_start + int(length.group(1))]
+    return PDFObject(dictionary, stream)
+
+
+def get_references(text):
+    return [int(m.group(1)) for m in REFERENCE_RE.finditer(text) if m.group(1)]
+
+
+def rewrite_references(text, numbers):
+    def replace(match):
+        if match.group(1) is None:
+            return match.group(0)
+        return b'%d 0 R' % numbers[int(match.group(1))]
+    return REFERENCE_RE.sub(replace, text)
+
+
+def get_trailer_reference(trailer, key):
+    match = re.search(rb'/' + key + rb'\s+(\d+) 0 R', trailer)
+    return int(match.group(1)) if match else None
+
+
+def is_flate(dictionary):
+    return re.search(rb'/Filter\s*/FlateDecode', dictionary) is not None
+
+
+def decode_stream(obj):
+    return zlib.decompress(obj.stream) if is_flate(obj.dictionary) else obj.stream
+
+
+def set_stream(obj, data):
+    """Returns obj holding data, compressed as well as zlib can. /Length is the only key that changes, besides a
+    /Filter added to streams that had none."""
+    compressed = zlib.compress(data, 9)
+    dictionary = re.sub(rb'/Length \d+', b'/Length %d' % len(compressed), obj.dictionary, count=1)
+    if not is_flate(dictionary):
+        if re.search(rb'/Filter', dictionary):
+            raise UnsupportedPDF('Unsupported stream filter')
+        dictionary = dictionary[:-2].rstrip() + b'\n/Filter /FlateDecode>>'
+    return PDFObject(dictionary, compressed)
+
+
+def optimize_content(content):
+    """Returns content without the operators that set a part of the graphics state to the value it already has.
+    Returns None if the content uses something that isn't understood well enough to do that safely."""
+    state = {}
+    stack = []
+    removed = []
+    operands = []
+    kept_since_text_start = None
+    text_start = None
+    removed_in_text = 0
+    for match in CONTENT_TOKEN_RE.finditer(content):
+        token = match.group(0)
+        first = token[0]
+        if first in OPERAND_START_BYTES or token in OPERAND_KEYWORDS:
+            operands.append(match)
+            continue
+        if first == COMMENT_START_BYTE:
+            continue
+        operator = token
+        start = operands[0].start() if operands else match.start()
+        values = operands
+        operands = []
+        if operator in (b'BI', b'ID', b'EI'):
+            # Inline image data isn't tokenized
+            return None
+        if operator == b'q':
+            stack.append(dict(state))
+        elif operator == b'Q':
+            if not stack:
+                return None
+            state = stack.pop()
+        elif operator in STATE_OPERATORS:
+            key = STATE_OPERATORS[operator]
+            value = (operator,) + tuple(m.group(0) for m in values)
+            if state.get(key) == value:
+                removed.append((start, match.end()))
+                if text_start is not None:
+                    removed_in_text += 1
+                continue
+            state[key] = value
+        elif operator in RESET_OPERATORS:
+            for key in RESET_OPERATORS[operator]:
+                state.pop(key, None)
+        elif operator == b'BT':
+            text_start = start
+            kept_since_text_start = 0
+            removed_in_text = 0
+            continue
+        elif operator == b'ET' and text_start is not None:
+            if kept_since_text_start == 0:
+                # Nothing is left between BT and ET, so the text object can go as a whole
+                del removed[len(removed) - removed_in_text:]
+                removed.append((text_start, match.end()))
+            text_start = None
+            continue
+        if text_start is not None:
+            kept_since_text_start += 1
+    if stack or text_start is not None:
+        return None
+
+    ret = []
+    position = 0
+    for start, end in removed:
+        ret.append(content[position:start])
+        position = end
+        # Take the whitespace separating the removed operator from the next one with it
+        if content[position:position + 1].isspace():
+            position += 1
+    ret.append(content[position:])
+    return b''.join(ret)
+
+
+def get_page_contents(objects):
+    """Returns the numbers of the content streams of every page."""
+    ret = []
+    for obj in objects.values():
+        if obj.stream is None and re.search(rb'/Type\s*/Page\b(?!s)', obj.dictionary):
+            match = re.search(rb'/Contents\s+(\d+) 0 R', obj.dictionary)
+            if match:
+                ret.append(int(match.group(1)))
+            elif b'/Contents' in obj.dictionary:
+                raise UnsupportedPDF('Only pages with a single content stream are supported')
+    return ret
+
+
+def remove_unused_fonts(objects, contents):
+    # Font resource names used by Tf anywhere in the document
+    used = set()
+    for content in contents.values():
+        used.update(re.findall(rb'(/[^\s/\[\]()<>{}%]+)\s+[\d.]+\s+Tf', content))
+
+    def remove_unused(match):
+        entries = re.findall(rb'(/[^\s/\[\]()<>{}%]+)\s+(\d+ 0 R)', match.group(1))
+        return b'/Font <<' + b''.join(b'\n' + name + b' ' + ref for name, ref in entries if name in used) + b'\n>>'
+
+    for number, obj in list(objects.items()):
+        if obj.stream is None and b'/Font' in obj.dictionary:
+            dictionary = re.sub(rb'/Font\s*<<([^<>]*)>>', remove_unused, obj.dictionary)
+            objects[number] = obj._replace(dictionary=dictionary)
+
+
+def merge_duplicates(objects, roots):
+    """Stores byte-identical objects once. Merging some objects can make others identical, e.g. two fonts that only
+    differed in which copy of a CMap they referenced, so this repeats until nothing changes."""
+    while True:
+        first = {}
+        numbers = {}
+        for number in sorted(objects):
+            obj = objects[number]
+            key = (obj.dictionary, obj.stream)
+            numbers[number] = first.setdefault(key, number)
+        if all(number == merged for number, merged in numbers.items()):
+            return roots
+        objects_by_number = {}
+        for number, merged in numbers.items():
+            if number == merged:
+                obj = objects[number]
+                objects_by_number[number] = obj._replace(dictionary=rewrite_references(obj.dictionary, numbers))
+        objects.clear()
+        objects.update(objects_by_number)
+        roots = [numbers.get(root, root) for root in roots]
+
+
+def get_reachable(objects, roots):
+    reachable = set()
+    pending = [root for root in roots if root is not None]
+    while pending:
+        number = pending.pop()
+        if number in reachable or number not in objects:
+            continue
+        reachable.add(number)
+        pending.extend(get_references(objects[number].dictionary))
+    return reachable
+
+
+def serialize(objects, root, info):
+    """Writes objects as a PDF 1.5 file, objects without a stream packed into object streams."""
+    order = sorted(objects)
+    numbers = {old: new for new, old in enumerate(order, start=1)}
+    plain = [numbers[n] for n in order if objects[n].stream is None]
+    streams = [numbers[n] for n in order if objects[n].stream is not None]
+    by_new_number = {numbers[n]: objects[n] for n in order}
+
+    out = bytearray(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+    # xref entries: (type, field 2, field 3) by object number
+    entries = {0: (0, 0, 65535)}
+    for number in streams:
+        obj = by_new_number[number]
+        entries[number] = (1, len(out), 0)
+        out += b'%d 0 obj\n' % number
+        out += rewrite_references(obj.dictionary, numbers)
+        out += b'\nstream\n' + obj.stream + b'\nendstream\nendobj\n'
+
+    next_number = len(order) + 1
+    for i in range(0, len(plain), OBJECTS_PER_STREAM):
+        batch = plain[i:i + OBJECTS_PER_STREAM]
+        stream_number = next_number
+        next_number += 1
+        header = []
+        body = bytearray()
+        for index, number in enumerate(batch):
+            entries[number] = (2, stream_number, index)
+            header.append(b'%d %d' % (number, len(body)))
+            body += rewrite_references(by_new_number[number].dictionary, numbers) + b'\n'
+        header = b' '.join(header) + b'\n'
+        data = zlib.compress(header + bytes(body), 9)
+        entries[stream_number] = (1, len(out), 0)
+        out += b'%d 0 obj\n' % stream_number
+        out += b'<</Type /ObjStm /N %d /First %d /Filter /FlateDecode /Length %d>>' % (len(batch), len(header), len(data))
+        out += b'\nstream\n' + data + b'\nendstream\nendobj\n'
+
+    xref_number = next_number
+    entries[xref_number] = (1, len(out), 0)
+    offset_size = max(1, (max(entry[1] for entry in entries.values()).bit_length() + 7) // 8)
+    rows = bytearray()
+    for number in range(xref_number + 1):
+        kind, field2, field3 = entries[number]
+        rows += bytes([kind]) + field2.to_bytes(offset_size, 'big') + field3.to_bytes(2, 'big')
+    data = zlib.compress(bytes(rows), 9)
+    trailer = b'/Root %d 0 R' % numbers[root]
+    if info is not None:
+        trailer += b' /Info %d 0 R' % numbers[info]
+    xref_offset = len(out)
+    out += b'%d 0 obj\n' % xref_number
+    out += b'<</Type /XRef /Size %d /W [1 %d 2] %s /Filter /FlateDecode /Length %d>>' % (
+        xref_number + 1, offset_size, trailer, len(data))
+    out += b'\nstream\n' + data + b'\nendstream\nendobj\n'
+    out += b'startxref\n%d\n%%%%EOF\n' % xref_offset
+    return bytes(out)
+
+
+def compact_pdf(data):
+    """Returns data, a PDF written by FPDF, rewritten as a smaller PDF 1.5 file that draws the same pages."""
+    objects, trailer = parse_pdf(data)
+    root = get_trailer_reference(trailer, b'Root')
+    info = get_trailer_reference(trailer, b'Info')
+    if root is None or b'/Encrypt' in trailer:
+        raise UnsupportedPDF('Only unencrypted PDFs with a /Root can be compacted')
+
+    contents = {}
+    for number in get_page_contents(objects):
+        if number in contents:
+            continue
+        content = decode_stream(objects[number])
+        optimized = optimize_content(content)
+        contents[number] = content if optimized is None else optimized
+    remove_unused_fonts(objects, contents)
+
+    for number, obj in list(objects.items()):
+        if number in contents:
+            objects[number] = set_stream(obj, contents[number])
+        elif obj.stream is not None and not re.search(rb'/Filter', obj.dictionary):
+            objects[number] = set_stream(obj, obj.stream)
+        elif obj.stream is not None and is_flate(obj.dictionary) and not re.search(rb'/DecodeParms', obj.dictionary):
+            recompressed = set_stream(obj, zlib.decompress(obj.stream))
+            if len(recompressed.stream) < len(obj.stream):
+                objects[number] = recompressed
+
+    root, info = merge_duplicates(objects, [root, info])
+    reachable = get_reachable(objects, [root, info])
+    for number in list(objects):
+        if number not in reachable:
+            del objects[number]
+    return serialize(objects, root, info)
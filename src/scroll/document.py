@@ -0,0 +1,299 @@
+import collections
+import threading
+import zlib
+from fpdf import FPDF, FPDF_VERSION
+from fpdf.ttfonts import TTFontFile
+from .compact import CompactStats, compact_pdf
+from .fragment_cache import Fragment
+from .linearize import linearize_pdf
+from .ttf import SubsetFontFile
+
+
+FontSubset = collections.namedtuple('FontSubset', ['fontstream', 'ttfontsize', 'widths', 'cidtogidmap'])
+
+
+class FontSubsetCache:
+    """
+    Keeps the compressed font streams FPDF embeds for TrueType fonts, keyed by font file and glyph set.
+
+    Subsetting a font means parsing the whole TTF and compressing the result, for every face of every document. Booklets
+    rendered in the same process mostly use the same characters, so the finished streams can be reused as they are.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, make_subset):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        subset = make_subset()
+        with self._lock:
+            self._entries[key] = subset
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return subset
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+font_subset_cache = FontSubsetCache()
+
+
+class Document(FPDF):
+    """FPDF writer whose output only depends on what was drawn, so identical inputs give byte-identical files."""
+
+    def __init__(self, *args, creation_date=None, font_subset_cache=font_subset_cache, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.creation_date = creation_date
+        self.font_subset_cache = font_subset_cache
+
+    def add_font_metrics(self, metrics):
+        """Registers every face of a shared FontMetrics, like add_font but without loading anything. The widths are
+        shared with the metrics. Only the subset of characters used is kept per document."""
+        for family, style, path in metrics:
+            fontkey = family.lower() + style.upper()
+            if fontkey in self.fonts:
+                continue
+            font = metrics.get_font(fontkey)
+            self.fonts[fontkey] = {
+                'i': len(self.fonts) + 1,
+                'type': font['type'],
+                'name': font['name'],
+                'desc': font['desc'],
+                'up': font['up'],
+                'ut': font['ut'],
+                'cw': font['cw'],
+                'ttffile': font['ttffile'],
+                'ttf': font['ttf'],
+                'fontkey': fontkey,
+                'subset': list(range(0, 32)),
+                'unifilename': None,
+            }
+            self.font_files[fontkey] = {'length1': font['originalsize'], 'type': 'TTF', 'ttffile': font['ttffile']}
+            self.font_files[path] = {'type': 'TTF'}
+
+    def get_graphics_state(self):
+        """Returns the state that decides which operators drawing text and lines emits: FPDF only sets the font when
+        it changes, wraps text in its own color only when that differs from the fill color, and refers to fonts by
+        the order they were added in."""
+        fonts = tuple(sorted((fontkey, font['i']) for fontkey, font in self.fonts.items()))
+        return (self.font_family, self.font_style, self.font_size_pt, self.underline, self.text_color,
+                self.fill_color, self.draw_color, self.line_width, self.ws, self.k, fonts)
+
+    def record_fragment(self, x, y, draw):
+        """Calls draw, which draws at x, y, and returns what it drew as a Fragment, or None if it didn't stay on the
+        current page or added a font."""
+        page = self.page
+        start = len(self.pages[page])
+        subset_lengths = {fontkey: len(font['subset']) for fontkey, font in self.fonts.items()}
+        draw()
+        if self.page != page or len(self.fonts) != len(subset_lengths):
+            return None
+        chars = {}
+        for fontkey, font in self.fonts.items():
+            added = font['subset'][subset_lengths[fontkey]:]
+            if added:
+                chars[fontkey] = sorted(set(added))
+        return Fragment(self.pages[page][start:], x, y, self.h, self.x - x, self.y - y, self.lasth,
+                        self.get_graphics_state(), chars)
+
+    def place_fragment(self, fragment, x, y):
+        """Draws a recorded Fragment again at x, y, and leaves the graphics state the way drawing it did."""
+        dx = (x - fragment.x) * self.k
+        dy = ((self.h - y) - (fragment.page_height - fragment.y)) * self.k
+        self._out('q 1 0 0 1 %.4f %.4f cm' % (dx, dy))
+        self.pages[self.page] += fragment.content
+        self._out('Q')
+        for fontkey, chars in fragment.chars.items():
+            self.fonts[fontkey]['subset'].extend(chars)
+        # Q undid whatever the fragment set. Of that, only the font and the stroking color last beyond it, the text
+        # color is set around each cell that uses it.
+        family, style, size, underline, text_color, fill_color, draw_color = fragment.end_state[:7]
+        if draw_color != self.draw_color:
+            self.draw_color = draw_color
+            self._out(draw_color)
+        self.set_font(family, style + ('U' if underline else ''), size)
+        self.text_color = text_color
+        self.fill_color = fill_color
+        self.color_flag = text_color != fill_color
+        self.x = x + fragment.end_x
+        self.y = y + fragment.end_y
+        self.lasth = fragment.lasth
+
+    def write_to(self, output, chunk_size=1024 * 1024):
+        """Writes the finished PDF to output, a path or a binary file-like object. FPDF holds the document as a str,
+        which is encoded a chunk at a time so there's never a second full copy of it in memory."""
+        if self.state < 3:
+            self.close()
+        if not hasattr(output, 'write'):
+            with open(output, 'wb') as f:
+                return self.write_to(f, chunk_size=chunk_size)
+        buffer = self.buffer
+        for i in range(0, len(buffer), chunk_size):
+            # FPDF keeps binary data in the str as latin-1
+            output.write(buffer[i:i + chunk_size].encode('latin-1'))
+
+    def compact(self):
+        """Rewrites the finished PDF as a smaller PDF 1.5 file that draws the same pages, see compact_pdf. Returns
+        CompactStats with the size before and after."""
+        if self.state < 3:
+            self.close()
+        data = self.buffer.encode('latin-1')
+        self.buffer = ''
+        compact = compact_pdf(data)
+        self.buffer = compact.decode('latin-1')
+        return CompactStats(len(data), len(compact))
+
+    def linearize(self):
+        """Rewrites the finished PDF as a linearized PDF, see linearize_pdf."""
+        if self.state < 3:
+            self.close()
+        data = self.buffer.encode('latin-1')
+        self.buffer = ''
+        self.buffer = linearize_pdf(data).decode('latin-1')
+
+    def _putinfo(self):
+        # FPDF stamps every document with the current time. Only write a creation date
+        # when one was given explicitly.
+        self._out('/Producer ' + self._textstring('PyFPDF ' + FPDF_VERSION + ' http://pyfpdf.googlecode.com/'))
+        if self.creation_date is not None:
+            self._out('/CreationDate ' + self._textstring('D:' + self.creation_date.strftime('%Y%m%d%H%M%S')))
+
+    def _make_font_subset(self, font, subset):
+        # Fonts registered from FontMetrics come with a TrueTypeFont, which lets the subsetter skip parsing the tables
+        # it doesn't need
+        ttf = SubsetFontFile(font['ttf']) if font.get('ttf') else TTFontFile()
+        ttfontstream = ttf.makeSubset(font['ttffile'], subset)
+
+        # _putTTfontwidths writes straight to the document, so capture what it writes
+        buffer = self.buffer
+        self.buffer = ''
+        self._putTTfontwidths(dict(font, subset=set(subset)), ttf.maxUni)
+        widths = self.buffer
+        self.buffer = buffer
+
+        cidtogidmap = bytearray(256 * 256 * 2)
+        for cc, glyph in ttf.codeToGlyph.items():
+            cidtogidmap[cc * 2] = glyph >> 8
+            cidtogidmap[cc * 2 + 1] = glyph & 0xFF
+        return FontSubset(zlib.compress(ttfontstream), len(ttfontstream), widths, zlib.compress(bytes(cidtogidmap)))
+
+    def _putfonts(self):
+        if self.diffs or self.font_subset_cache is None or \
+                any(font['type'] != 'TTF' for font in self.fonts.values()):
+            return super()._putfonts()
+
+        # The same objects FPDF writes for TTF fonts, but with the subset itself coming from
+        # the font subset cache
+        for font in sorted(self.fonts.values(), key=lambda f: f['i']):
+            font['n'] = self.n + 1
+            fontname = 'MPDFAA' + '+' + font['name']
+            # FPDF appends every character drawn to the subset, duplicates included. The subset
+            # only depends on the distinct characters, which makes them usable as a cache key.
+            subset = sorted(set(font['subset'][1:]))
+            font_subset = self.font_subset_cache.get(
+                (font['ttffile'], tuple(subset)),
+                lambda: self._make_font_subset(font, subset)
+            )
+
+            # Type0 Font
+            self._newobj()
+            self._out('<</Type /Font')
+            self._out('/Subtype /Type0')
+            self._out('/BaseFont /' + fontname + '')
+            self._out('/Encoding /Identity-H')
+            self._out('/DescendantFonts [' + str(self.n + 1) + ' 0 R]')
+            self._out('/ToUnicode ' + str(self.n + 2) + ' 0 R')
+            self._out('>>')
+            self._out('endobj')
+
+            # CIDFontType2
+            self._newobj()
+            self._out('<</Type /Font')
+            self._out('/Subtype /CIDFontType2')
+            self._out('/BaseFont /' + fontname + '')
+            self._out('/CIDSystemInfo ' + str(self.n + 2) + ' 0 R')
+            self._out('/FontDescriptor ' + str(self.n + 3) + ' 0 R')
+            if font['desc'].get('MissingWidth'):
+                self._out('/DW %d' % font['desc']['MissingWidth'])
+            self.buffer += font_subset.widths
+            self._out('/CIDToGIDMap ' + str(self.n + 4) + ' 0 R')
+            self._out('>>')
+            self._out('endobj')
+
+            # ToUnicode
+            self._newobj()
+            to_unicode = "/CIDInit /ProcSet findresource begin\n" \
+                         "12 dict begin\n" \
+                         "begincmap\n" \
+                         "/CIDSystemInfo\n" \
+                         "<</Registry (Adobe)\n" \
+                         "/Ordering (UCS)\n" \
+                         "/Supplement 0\n" \
+                         ">> def\n" \
+                         "/CMapName /Adobe-Identity-UCS def\n" \
+                         "/CMapType 2 def\n" \
+                         "1 begincodespacerange\n" \
+                         "<0000> <FFFF>\n" \
+                         "endcodespacerange\n" \
+                         "1 beginbfrange\n" \
+                         "<0000> <FFFF> <0000>\n" \
+                         "endbfrange\n" \
+                         "endcmap\n" \
+                         "CMapName currentdict /CMap defineresource pop\n" \
+                         "end\n" \
+                         "end"
+            self._out('<</Length ' + str(len(to_unicode)) + '>>')
+            self._putstream(to_unicode)
+            self._out('endobj')
+
+            # CIDSystemInfo dictionary
+            self._newobj()
+            self._out('<</Registry (Adobe)')
+            self._out('/Ordering (UCS)')
+            self._out('/Supplement 0')
+            self._out('>>')
+            self._out('endobj')
+
+            # Font descriptor
+            self._newobj()
+            self._out('<</Type /FontDescriptor')
+            self._out('/FontName /' + fontname)
+            for kd in ('Ascent', 'Descent', 'CapHeight', 'Flags', 'FontBBox', 'ItalicAngle', 'StemV', 'MissingWidth'):
+                v = font['desc'][kd]
+                if kd == 'Flags':
+                    v = v | 4
+                    v = v & ~32  # SYMBOLIC font flag
+                self._out(' /%s %s' % (kd, v))
+            self._out('/FontFile2 ' + str(self.n + 2) + ' 0 R')
+            self._out('>>')
+            self._out('endobj')
+
+            # CIDToGIDMap
+            self._newobj()
+            self._out('<</Length ' + str(len(font_subset.cidtogidmap)) + '')
+            self._out('/Filter /FlateDecode')
+            self._out('>>')
+            self._putstream(font_subset.cidtogidmap)
+            self._out('endobj')
+
+            # Font file
+            self._newobj()
+            self._out('<</Length ' + str(len(font_subset.fontstream)))
+            self._out('/Filter /FlateDecode')
+            self._out('/Length1 ' + str(font_subset.ttfontsize))
+            self._out('>>')
+            self._putstream(font_subset.fontstream)
+            self._out('endobj')
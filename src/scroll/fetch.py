@@ -0,0 +1,197 @@
+import collections
+import concurrent.futures
+import json
+import random
+import threading
+import time
+import urllib.parse
+import requests
+from .bmlt_objects import Meeting
+
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0 +scroll'
+ACCEPT_ENCODING = 'gzip, deflate'
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+CHUNK_SIZE = 64 * 1024
+
+
+# wire_size is the size of the body as it was transferred, before any Content-Encoding was decoded
+FetchResult = collections.namedtuple(
+    'FetchResult',
+    ['content', 'status_code', 'headers', 'elapsed', 'attempts', 'wire_size']
+)
+
+
+class RetryableError(Exception):
+    pass
+
+
+class LatencyTracker:
+    """Remembers how long recent successful requests took, to work out when a request is slow enough to hedge."""
+
+    def __init__(self, max_samples=100):
+        self._samples = collections.deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, elapsed):
+        with self._lock:
+            self._samples.append(elapsed)
+
+    def percentile(self, percentile):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        i = min(len(samples) - 1, int(round(percentile / 100.0 * (len(samples) - 1))))
+        return samples[i]
+
+
+class TomatoClient:
+    """
+    Fetches urls from tomato with timeouts, retries and, optionally, hedged requests.
+
+    Every attempt has a connect timeout, a timeout between reads and a deadline for the whole response, so a stalled
+    server can't hold up a render indefinitely. Connection errors, timeouts and 429 and 5xx responses are retried up
+    to retries times, waiting a random time of up to backoff * 2 ** attempt seconds (capped at max_backoff) between
+    attempts so that clients retrying at the same time spread out.
+
+    If hedge_after is given, an attempt that hasn't finished after that many seconds gets a second, identical request,
+    and whichever finishes first is used. Once min_hedge_samples requests have succeeded, the hedge_percentile of
+    their latencies is used as the threshold instead, so a long running process hedges only its slowest requests.
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=60, total_timeout=120, retries=3, backoff=0.5, max_backoff=10,
+                 hedge_after=None, hedge_percentile=95, min_hedge_samples=20, headers=None, log=None, rand=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_samples = min_hedge_samples
+        self.headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': ACCEPT_ENCODING}
+        if headers:
+            self.headers.update(headers)
+        self.log = log
+        self.random = rand or random.Random()
+        self.latencies = LatencyTracker()
+
+    def _log(self, message):
+        if self.log:
+            self.log(message)
+
+    def get_hedge_threshold(self):
+        if self.hedge_after is None:
+            return None
+        if len(self.latencies) >= self.min_hedge_samples:
+            return self.latencies.percentile(self.hedge_percentile)
+        return self.hedge_after
+
+    def get_backoff(self, attempt):
+        return self.random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _request(self, url, label):
+        start = time.monotonic()
+        try:
+            response = requests.get(
+                url,
+                headers=self.headers,
+                timeout=(self.connect_timeout, self.read_timeout),
+                stream=True
+            )
+            try:
+                chunks = []
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    chunks.append(chunk)
+                    if self.total_timeout and time.monotonic() - start > self.total_timeout:
+                        raise requests.exceptions.Timeout('Response took longer than {}s'.format(self.total_timeout))
+                wire_size = response.raw.tell()
+            finally:
+                response.close()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            elapsed = time.monotonic() - start
+            self._log('{} failed after {}s: {}'.format(label, round(elapsed, 3), e.__class__.__name__))
+            raise RetryableError('{}: {}'.format(e.__class__.__name__, e))
+        elapsed = time.monotonic() - start
+        self._log('{} returned {} in {}s'.format(label, response.status_code, round(elapsed, 3)))
+        if response.status_code in RETRY_STATUS_CODES:
+            raise RetryableError('Bad status code {}'.format(response.status_code))
+        return FetchResult(b''.join(chunks), response.status_code, response.headers, elapsed, None, wire_size)
+
+    def _attempt(self, url, attempt):
+        label = 'attempt {} of {}'.format(attempt + 1, url)
+        threshold = self.get_hedge_threshold()
+        if threshold is None:
+            return self._request(url, label)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        try:
+            pending = {executor.submit(self._request, url, label)}
+            done, pending = concurrent.futures.wait(pending, timeout=threshold)
+            if not done:
+                self._log('{} is slower than {}s, sending a hedged request'.format(label, round(threshold, 3)))
+                pending.add(executor.submit(self._request, url, 'hedged ' + label))
+            error = None
+            while True:
+                for future in done:
+                    try:
+                        return future.result()
+                    except RetryableError as e:
+                        error = e
+                if not pending:
+                    raise error
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        finally:
+            # Don't wait for the slower request, its timeouts bound how long it can keep running
+            executor.shutdown(wait=False)
+
+    def get(self, url):
+        """Returns a FetchResult for url, raising an exception once every attempt has failed."""
+        start = time.monotonic()
+        for attempt in range(self.retries + 1):
+            try:
+                result = self._attempt(url, attempt)
+            except RetryableError as e:
+                if attempt == self.retries:
+                    raise Exception('Giving up on {} after {} attempts: {}'.format(url, attempt + 1, e))
+                delay = self.get_backoff(attempt)
+                self._log('retrying {} in {}s'.format(url, round(delay, 3)))
+                time.sleep(delay)
+                continue
+            self.latencies.add(result.elapsed)
+            return result._replace(elapsed=time.monotonic() - start, attempts=attempt + 1)
+
+
+def get_meetings_url(tomato_url, service_body_ids, recursive=False, sort_keys=None):
+    """Returns the GetSearchResults url for the meetings of service_body_ids, with their formats and only the fields
+    Meeting reads."""
+    query = {
+        'switcher': 'GetSearchResults',
+        'get_used_formats': '1',
+        'services[]': list(service_body_ids),
+        'recursive': '1' if recursive else '0',
+        # Only the fields Meeting reads, which is a small fraction of what tomato returns by default
+        'data_field_key': ','.join(Meeting.FIELDS)
+    }
+    if sort_keys:
+        query['sort_keys'] = sort_keys
+    qs = urllib.parse.urlencode(query, doseq=True)
+    return tomato_url.rstrip('/') + '/client_interface/json/?' + qs
+
+
+def fetch_meetings(client, tomato_url, service_body_ids, recursive=False):
+    """Downloads the meetings and formats of service_body_ids from tomato with client, a TomatoClient."""
+    url = get_meetings_url(tomato_url, service_body_ids, recursive)
+    response = client.get(url)
+    if response.status_code != 200:
+        raise Exception('Bad status code {} from {}'.format(response.status_code, url))
+    try:
+        data = json.loads(response.content)
+    except json.decoder.JSONDecodeError:
+        raise Exception('Invalid json returned from {}'.format(url))
+    return data['meetings'], data['formats']
@@ -0,0 +1,137 @@
+import collections
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+from .render_cache import get_source_fingerprint
+
+
+# What a meeting drew, recorded where it was first drawn: the content stream operators, the position it was drawn at
+# and the page height, which together give the offset that moves it anywhere else, where drawing it left the cursor,
+# relative to that position, the graphics state it left behind and the characters it added to the subset of each font
+Fragment = collections.namedtuple(
+    'Fragment', ['content', 'x', 'y', 'page_height', 'end_x', 'end_y', 'lasth', 'end_state', 'chars']
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS heights (
+    key TEXT PRIMARY KEY,
+    height REAL NOT NULL,
+    used INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fragments (
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    data TEXT NOT NULL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (key, state)
+);
+"""
+
+
+def get_today():
+    return datetime.date.today().toordinal()
+
+
+class FragmentCache:
+    """
+    Remembers the height and the drawn content of each meeting across runs, in a SQLite file.
+
+    Meetings are keyed by the texts they show and everything else that changes how they're laid out, so a meeting
+    that hasn't changed since the last run is neither measured nor drawn again: its content is copied in and moved to
+    its new position. Content also depends on the font and colors already set when the meeting is drawn, so a meeting
+    can have one fragment for each of those. Entries not used for max_age_days are removed.
+
+    Changes are kept in memory until flush(), which Booklet calls once per render.
+    """
+
+    def __init__(self, path, max_age_days=30):
+        self.path = path
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._fingerprint = get_source_fingerprint(())
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._heights = {}
+        self._fragments = {}
+        self._used_heights = set()
+        self._used_fragments = set()
+
+    def get_key(self, *values):
+        h = hashlib.sha256()
+        h.update(self._fingerprint.encode('utf-8'))
+        h.update(json.dumps(values).encode('utf-8'))
+        return h.hexdigest()
+
+    def get_height(self, key):
+        with self._lock:
+            if key in self._heights:
+                return self._heights[key]
+            row = self._connection.execute('SELECT height, used FROM heights WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] != get_today():
+                self._used_heights.add(key)
+            return row[0]
+
+    def put_height(self, key, height):
+        with self._lock:
+            self._heights[key] = height
+
+    def get_fragment(self, key, state):
+        state = json.dumps(state)
+        with self._lock:
+            if (key, state) in self._fragments:
+                self.hits += 1
+                return self._fragments[(key, state)]
+            row = self._connection.execute(
+                'SELECT data, used FROM fragments WHERE key = ? AND state = ?', (key, state)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if row[1] != get_today():
+                self._used_fragments.add((key, state))
+            return Fragment(**json.loads(row[0]))
+
+    def put_fragment(self, key, state, fragment):
+        with self._lock:
+            self._fragments[(key, json.dumps(state))] = fragment
+
+    def flush(self):
+        """Writes new entries to disk, marks the ones used as used today and removes the ones not used for
+        max_age_days."""
+        today = get_today()
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO heights (key, height, used) VALUES (?, ?, ?)',
+                    [(key, height, today) for key, height in self._heights.items()]
+                )
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO fragments (key, state, data, used) VALUES (?, ?, ?, ?)',
+                    [(key, state, json.dumps(fragment._asdict()), today)
+                     for (key, state), fragment in self._fragments.items()]
+                )
+                self._connection.executemany(
+                    'UPDATE heights SET used = ? WHERE key = ?', [(today, key) for key in self._used_heights]
+                )
+                self._connection.executemany(
+                    'UPDATE fragments SET used = ? WHERE key = ? AND state = ?',
+                    [(today, key, state) for key, state in self._used_fragments]
+                )
+                if self.max_age_days:
+                    self._connection.execute('DELETE FROM heights WHERE used < ?', (today - self.max_age_days,))
+                    self._connection.execute('DELETE FROM fragments WHERE used < ?', (today - self.max_age_days,))
+            self._heights.clear()
+            self._fragments.clear()
+            self._used_heights.clear()
+            self._used_fragments.clear()
+
+    def close(self):
+        self.flush()
+        self._connection.close()
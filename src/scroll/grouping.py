@@ -0,0 +1,64 @@
+from .bmlt_objects import Meeting
+
+
+class MeetingIndex:
+    """
+    Groups meetings by weekday, city and start time so they can be put in the order needed for any combination of
+    main and second header fields without asking tomato to sort them again.
+
+    The sort keys and groups are computed once when the index is built. After that, ordered() walks the prebuilt groups
+    in O(n) for every header combination, so one index can be shared by several booklets made from the same data.
+    """
+
+    def __init__(self, meetings):
+        self.meetings = []
+        self._by_weekday = {}
+        self._by_city = {}
+        self._by_weekday_city = {}
+
+        start_times = []
+        for m in meetings:
+            meeting = m if isinstance(m, Meeting) else Meeting(m)
+            start_times.append(meeting.start_time)
+            self.meetings.append(meeting)
+
+        # Sort once by start time. Every group below is filled in this order, so each one ends up sorted by start
+        # time without sorting it separately. The sort is stable, so ties keep their original order.
+        order = sorted(range(len(self.meetings)), key=start_times.__getitem__)
+        for i in order:
+            meeting = self.meetings[i]
+            city = meeting.city or ''
+            self._by_weekday.setdefault(meeting.weekday, []).append(meeting)
+            self._by_city.setdefault(city, []).append(meeting)
+            self._by_weekday_city.setdefault(meeting.weekday, {}).setdefault(city, []).append(meeting)
+        self._weekdays = sorted(self._by_weekday.keys())
+        self._cities = sorted(self._by_city.keys(), key=lambda c: (c.casefold(), c))
+        city_order = {city: i for i, city in enumerate(self._cities)}
+        self._weekday_cities = {
+            weekday: sorted(cities.keys(), key=city_order.__getitem__)
+            for weekday, cities in self._by_weekday_city.items()
+        }
+
+    def __len__(self):
+        return len(self.meetings)
+
+    def ordered(self, main_header_field, second_header_field=None):
+        """Returns the meetings sorted by main_header_field, then second_header_field, then start time."""
+        fields = (main_header_field, second_header_field)
+        if fields == ('weekday', None):
+            return [m for weekday in self._weekdays for m in self._by_weekday[weekday]]
+        if fields == ('city', None):
+            return [m for city in self._cities for m in self._by_city[city]]
+        if fields == ('weekday', 'city'):
+            ret = []
+            for weekday in self._weekdays:
+                for city in self._weekday_cities[weekday]:
+                    ret.extend(self._by_weekday_city[weekday][city])
+            return ret
+        if fields == ('city', 'weekday'):
+            ret = []
+            for city in self._cities:
+                for weekday in self._weekdays:
+                    ret.extend(self._by_weekday_city[weekday].get(city, []))
+            return ret
+        raise ValueError('Invalid header fields: {}, {}'.format(main_header_field, second_header_field))
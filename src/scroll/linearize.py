@@ -0,0 +1,58 @@
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+HAVE_PIKEPDF = pikepdf is not None
+
+
+def get_qpdf_path():
+    return shutil.which('qpdf')
+
+
+def can_linearize():
+    """Linearizing needs pikepdf, or else the qpdf command line tool."""
+    return HAVE_PIKEPDF or get_qpdf_path() is not None
+
+
+def linearize_pdf(data):
+    """
+    Returns data, a complete PDF, rewritten as a linearized ("fast web view") PDF that draws the same pages: the
+    objects of the first page come first, followed by hint tables that tell a viewer where every other page is, so it
+    can show the first page right away and fetch the rest by byte range.
+
+    Linearization is done by qpdf, through pikepdf if it's installed and the qpdf command otherwise. Object streams
+    are kept as they are, so a compact PDF stays compact. The file ID is derived from the contents, so the same PDF
+    always linearizes to the same bytes.
+    """
+    if HAVE_PIKEPDF:
+        output = io.BytesIO()
+        with pikepdf.open(io.BytesIO(data)) as pdf:
+            pdf.save(output, linearize=True, deterministic_id=True,
+                     object_stream_mode=pikepdf.ObjectStreamMode.preserve)
+        return output.getvalue()
+
+    qpdf = get_qpdf_path()
+    if qpdf is None:
+        raise Exception('Linearized output needs pikepdf (pip3 install pikepdf) or the qpdf command')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = os.path.join(tmp_dir, 'input.pdf')
+        output_file = os.path.join(tmp_dir, 'output.pdf')
+        with open(input_file, 'wb') as f:
+            f.write(data)
+        result = subprocess.run(
+            [qpdf, '--linearize', '--deterministic-id', '--object-streams=preserve', input_file, output_file],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        # qpdf exits with 3 when it succeeded with warnings
+        if result.returncode not in (0, 3):
+            raise Exception('qpdf failed to linearize the PDF: {}'.format(result.stderr.decode('utf-8', 'replace')))
+        with open(output_file, 'rb') as f:
+            return f.read()
@@ -0,0 +1,182 @@
+import re
+import threading
+from .ttf import CHAR_WIDTHS_LENGTH, TrueTypeFont
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HAVE_NUMPY = numpy is not None
+
+
+class FontMetrics:
+    """
+    Character widths and descriptors of a set of TrueType faces, loaded once and never modified afterwards.
+
+    One instance can be shared by any number of documents and TextMeasurers, including ones used from different
+    threads. Fonts are looked up by FPDF's font key, the family followed by the style, e.g. 'dejavusansB'.
+    """
+
+    def __init__(self, font_files):
+        self.font_files = tuple(font_files)
+        self._fonts = {}
+        for family, style, path in self.font_files:
+            # Nothing past the table directory is read until it's needed, and widths are read one character at a time
+            ttf = TrueTypeFont(path)
+            fontkey = family.lower() + style.upper()
+            descriptor = ttf.descriptor
+            self._fonts[fontkey] = {
+                'type': 'TTF',
+                'name': re.sub('[ ()]', '', ttf.full_name),
+                'desc': descriptor['desc'],
+                'up': descriptor['up'],
+                'ut': descriptor['ut'],
+                'cw': ttf.char_widths,
+                'ttffile': path,
+                'ttf': ttf,
+                'originalsize': ttf.size,
+            }
+        self._width_tables = {}
+        self._width_tables_lock = threading.Lock()
+
+    def __iter__(self):
+        return iter(self.font_files)
+
+    def get_font(self, fontkey):
+        try:
+            return self._fonts[fontkey]
+        except KeyError:
+            raise RuntimeError('Undefined font: {}'.format(fontkey))
+
+    def get_width_table(self, fontkey):
+        """Returns the character widths of a font as a numpy array indexed by code point, with one more entry at the
+        end for the characters past it. Only used when numpy is installed."""
+        with self._width_tables_lock:
+            if fontkey not in self._width_tables:
+                font = self.get_font(fontkey)
+                cw = font['cw']
+                table = numpy.zeros(CHAR_WIDTHS_LENGTH + 1, dtype=numpy.int64)
+                # Characters the cmap doesn't map have a width of 0, so only the mapped ones need to be read
+                for char in font['ttf'].iter_chars():
+                    if char < CHAR_WIDTHS_LENGTH:
+                        table[char] = cw[char]
+                # Like cw[0], the number of characters with a width, without reading them all a second time
+                table[0] = numpy.count_nonzero(table[1:CHAR_WIDTHS_LENGTH])
+                table[CHAR_WIDTHS_LENGTH] = font['desc']['MissingWidth'] or 500
+                self._width_tables[fontkey] = table
+            return self._width_tables[fontkey]
+
+
+def get_string_units(font, s):
+    """Returns the width of s in thousandths of the font size, the integer FPDF's get_string_width scales by the font
+    size."""
+    cw = font['cw']
+    missing_width = font['desc']['MissingWidth'] or 500
+    cw_len = len(cw)
+    w = 0
+    for char in s:
+        char = ord(char)
+        if char < cw_len:
+            w += cw[char]
+        else:
+            w += missing_width
+    return w
+
+
+def get_words_units(metrics, fontkey, words):
+    """Returns get_string_units for each of words."""
+    font = metrics.get_font(fontkey)
+    return [get_string_units(font, word) for word in words]
+
+
+def get_chars_units(metrics, fontkey, s):
+    """Returns the width of each character of s, in thousandths of the font size, as a numpy array. Needs numpy."""
+    table = metrics.get_width_table(fontkey)
+    codes = numpy.frombuffer(s.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+    return table[numpy.minimum(codes, CHAR_WIDTHS_LENGTH)]
+
+
+_font_metrics = {}
+_font_metrics_lock = threading.Lock()
+
+
+def get_font_metrics(font_files):
+    """Returns the shared FontMetrics for font_files, a sequence of (family, style, path) tuples, loading it the first
+    time it's asked for."""
+    font_files = tuple(font_files)
+    with _font_metrics_lock:
+        if font_files not in _font_metrics:
+            _font_metrics[font_files] = FontMetrics(font_files)
+        return _font_metrics[font_files]
+
+
+class TextMeasurer:
+    """
+    Measures text the way FPDF does, for laying out a booklet without an FPDF document.
+
+    It has the FPDF attributes and methods PDFObjects use to measure themselves. Like FPDF it remembers the current
+    font, so every render needs its own TextMeasurer, but the widths themselves come from a shared FontMetrics.
+    """
+
+    def __init__(self, metrics, page):
+        self.metrics = metrics
+        # Page geometry, copied from an FPDF document set up like the one being rendered
+        self.k = page.k
+        self.w = page.w
+        self.h = page.h
+        self.l_margin = page.l_margin
+        self.r_margin = page.r_margin
+        self.t_margin = page.t_margin
+        self.b_margin = page.b_margin
+        self.c_margin = page.c_margin
+        self.line_width = page.line_width
+        self.font_family = ''
+        self.font_style = ''
+        self.font_size_pt = 12
+        self.font_size = self.font_size_pt / self.k
+        self.underline = 0
+        self.current_font = None
+        self.current_fontkey = None
+        self._words_units = {}
+
+    def set_font(self, family, style='', size=0):
+        family = family.lower() or self.font_family
+        style = style.upper()
+        if 'U' in style:
+            self.underline = 1
+            style = style.replace('U', '')
+        else:
+            self.underline = 0
+        if style == 'IB':
+            style = 'BI'
+        if size == 0:
+            size = self.font_size_pt
+        if self.font_family == family and self.font_style == style and self.font_size_pt == size:
+            return
+        self.current_font = self.metrics.get_font(family + style)
+        self.current_fontkey = family + style
+        self.font_family = family
+        self.font_style = style
+        self.font_size_pt = size
+        self.font_size = size / self.k
+
+    def get_string_width(self, s):
+        return get_string_units(self.current_font, s) * self.font_size / 1000.0
+
+    def get_words_units(self, words):
+        """Returns the width of each of words in the current font, in thousandths of the font size. Widths don't depend
+        on the font size, so they're remembered per font for the life of the measurer and each word is only measured
+        once."""
+        known = self._words_units.setdefault(self.current_fontkey, {})
+        try:
+            return [known[word] for word in words]
+        except KeyError:
+            unknown = [word for word in set(words) if word not in known]
+            known.update(zip(unknown, get_words_units(self.metrics, self.current_fontkey, unknown)))
+            return [known[word] for word in words]
+
+    def get_chars_units(self, s):
+        """Returns the width of each character of s in the current font, in thousandths of the font size, as a numpy
+        array. Needs numpy."""
+        return get_chars_units(self.metrics, self.current_fontkey, s)
@@ -0,0 +1,95 @@
+import concurrent.futures
+import itertools
+import multiprocessing
+import threading
+import types
+from .metrics import TextMeasurer, get_font_metrics
+from .pdf_objects import PDFMeeting, can_measure_in_batches, measure_meetings
+
+
+# Below this many meetings, starting work in other processes costs more than it saves
+PARALLEL_MIN_MEETINGS = 1000
+
+# Page attributes a TextMeasurer copies from the document it measures for
+PAGE_ATTRIBUTES = ('k', 'w', 'h', 'l_margin', 'r_margin', 't_margin', 'b_margin', 'c_margin', 'line_width')
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_mp_context():
+    # Workers are never forked from the process that asked for them, which may be running other threads, e.g. those
+    # of a RenderCoordinator, whose locks a forked child would inherit in whatever state they were in
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def get_executor(workers):
+    # Pools are kept for the life of the process, so repeated renders, e.g. in watch mode, don't pay for starting
+    # the worker processes every time
+    with _executors_lock:
+        executor = _executors.get(workers)
+        # A pool whose worker died can't be used again
+        if executor is None or getattr(executor, '_broken', False):
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=get_mp_context())
+            _executors[workers] = executor
+        return executor
+
+
+def get_page_geometry(page):
+    """Returns the page attributes TextMeasurer uses, in a form that can be sent to another process."""
+    return types.SimpleNamespace(**{name: getattr(page, name) for name in PAGE_ATTRIBUTES})
+
+
+def measure_section(font_files, page, total_width, meeting_kwargs, meetings):
+    """Returns the wrapped lines of each of meetings laid out as a PDFMeeting. Runs in a worker process."""
+    measurer = TextMeasurer(get_font_metrics(font_files), page)
+    pdf_meetings = [PDFMeeting(m, lambda: measurer, total_width, **meeting_kwargs) for m in meetings]
+    if can_measure_in_batches(measurer):
+        measure_meetings(measurer, pdf_meetings)
+    return [meeting.get_wrapped_lines() for meeting in pdf_meetings]
+
+
+def get_sections(meetings, section_field, max_section_length):
+    """Splits meetings into runs with the same section_field, e.g. weekday, and splits runs longer than
+    max_section_length further, so that no single section holds up the others."""
+    sections = []
+    for key, section in itertools.groupby(meetings, key=lambda m: getattr(m, section_field)):
+        section = list(section)
+        for i in range(0, len(section), max_section_length):
+            sections.append(section[i:i + max_section_length])
+    return sections
+
+
+def get_wrapped_lines(meetings, section_field, workers, font_files, page, total_width, meeting_kwargs,
+                      cancellation_token=None):
+    """
+    Measures meetings, a list of Meeting objects, in worker processes and returns the wrapped lines of each of them,
+    in the same order.
+
+    The meetings are split into sections, by section_field, and each section is measured in whichever worker is free.
+    How a meeting wraps doesn't depend on where it ends up on the page, so placing the meetings in columns afterwards
+    only needs the lines.
+    """
+    max_section_length = max(1, -(-len(meetings) // (workers * 4)))
+    sections = get_sections(meetings, section_field, max_section_length)
+    page = get_page_geometry(page)
+    font_files = tuple(font_files)
+    executor = get_executor(workers)
+    futures = [
+        executor.submit(measure_section, font_files, page, total_width, meeting_kwargs, section)
+        for section in sections
+    ]
+    try:
+        wrapped_lines = []
+        for future in futures:
+            if cancellation_token is not None:
+                cancellation_token.raise_if_cancelled()
+            wrapped_lines.extend(future.result())
+        return wrapped_lines
+    finally:
+        # Sections nobody is waiting for any more aren't measured
+        for future in futures:
+            future.cancel()
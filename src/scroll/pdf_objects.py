@@ -1,7 +1,12 @@
+import functools
 import re
 from html.parser import HTMLParser
 from fpdf.html import hex2dec
 from .bmlt_objects import Format, Meeting
+from .metrics import HAVE_NUMPY, get_string_units
+
+if HAVE_NUMPY:
+    import numpy
 
 
 class StyledString:
@@ -39,82 +44,221 @@ class StyledStringParser(HTMLParser):
             self.tags.pop()
 
     def handle_data(self, data):
-        style = ''.join(set(self.tags))
+        style = ''.join(sorted(set(self.tags)))
         self.output.append(StyledString(data, style=style))
 
 
+def get_words_units(pdf, words):
+    # Measurers remember word widths, a plain FPDF document measures them every time
+    if hasattr(pdf, 'get_words_units'):
+        return pdf.get_words_units(words)
+    return [get_string_units(pdf.current_font, word) for word in words]
+
+
 def get_multi_cell_lines(pdf, text, max_line_length):
+    # Breaks lines exactly where measuring each proposed line with get_string_width would, but every word is only
+    # measured once. Line widths are kept as integer font units, which add up exactly like get_string_width's sums.
     lines = []
     current_line = ''
+    current_units = 0
     parts = re.split(r' ', text)
+    parts_units = get_words_units(pdf, parts + [' '])
+    space_units = parts_units.pop()
+    font_size = pdf.font_size
+    cell_margin = 2 * pdf.c_margin
+    if '' not in parts:
+        # Without empty parts every proposed line is a prefix of text, so text that fits is a single line
+        text_units = sum(parts_units) + space_units * (len(parts) - 1)
+        if text_units * font_size / 1000.0 + cell_margin <= max_line_length:
+            return [text]
     for i in range(len(parts)):
         part = parts[i]
-        proposed_line = current_line + ' ' + part if current_line else current_line + part
-        if pdf.get_string_width(proposed_line) + 2 * pdf.c_margin > max_line_length:
+        part_units = parts_units[i]
+        if current_line:
+            proposed_line = current_line + ' ' + part
+            proposed_units = current_units + space_units + part_units
+        else:
+            proposed_line = part
+            proposed_units = part_units
+        if proposed_units * font_size / 1000.0 + cell_margin > max_line_length:
             lines.append(current_line)
             current_line = part
+            current_units = part_units
         else:
             current_line = proposed_line
+            current_units = proposed_units
 
-        if pdf.get_string_width(current_line) + 2 * pdf.c_margin > max_line_length:
+        if current_units * font_size / 1000.0 + cell_margin > max_line_length:
             lines.append(current_line)
             current_line = ''
+            current_units = 0
         elif i == len(parts) - 1:
             lines.append(current_line)
     return lines
 
 
-def get_styled_line_cells(pdf, text, max_line_length, font, font_style, font_size):
+def can_measure_in_batches(pdf):
+    # Batches are measured with numpy, by a TextMeasurer
+    return HAVE_NUMPY and hasattr(pdf, 'get_chars_units')
+
+
+def get_multi_cell_lines_batch(pdf, texts, max_line_length):
+    """Returns get_multi_cell_lines for each of texts, in the current font. Needs can_measure_in_batches(pdf).
+
+    Text made of words that each fit on a line, separated by single spaces, is broken into lines the way
+    get_multi_cell_lines breaks it: each line takes as many words as fit. All of that text is measured together and
+    the lines of every text are found at once, one line per round. Anything else is left to get_multi_cell_lines."""
+    font_size = pdf.font_size
+    cell_margin = 2 * pdf.c_margin
+
+    def fits(units):
+        return units * font_size / 1000.0 + cell_margin <= max_line_length
+
+    # The widest line that fits, in font units. Widths are exact integers, so comparing them to it decides the same
+    # as the float comparison get_multi_cell_lines makes for each line.
+    max_units = max(int((max_line_length - cell_margin) * 1000.0 / font_size), 0)
+    while fits(max_units + 1):
+        max_units += 1
+    while max_units >= 0 and not fits(max_units):
+        max_units -= 1
+
+    ret = [None] * len(texts)
+    batch = [
+        i for i, text in enumerate(texts)
+        if text and text[0] != ' ' and text[-1] != ' ' and '  ' not in text
+    ] if max_units >= 0 else []
+    if batch:
+        # Joined with single spaces, every word in the batch is a run of characters between two spaces
+        joined = ' '.join(texts[i] for i in batch)
+        chars_units = pdf.get_chars_units(joined)
+        units = numpy.zeros(len(chars_units) + 1, dtype=numpy.int64)
+        numpy.cumsum(chars_units, out=units[1:])
+        spaces = numpy.flatnonzero(numpy.frombuffer(joined.encode('utf-32-le', 'surrogatepass'), dtype='<u4') == 32)
+        word_starts = numpy.concatenate(([0], spaces + 1))
+        word_ends = numpy.concatenate((spaces, [len(joined)]))
+        text_word_counts = numpy.array([texts[i].count(' ') + 1 for i in batch], dtype=numpy.int64)
+        text_word_ends = numpy.cumsum(text_word_counts)
+        text_word_starts = text_word_ends - text_word_counts
+        start_units = units[word_starts]
+        end_units = units[word_ends]
+        text_fits = numpy.maximum.reduceat(end_units - start_units, text_word_starts) <= max_units
+
+        # Each round ends a line of every text that isn't done, after the last word that still fits on it
+        rounds_indexes = []
+        rounds_ends = []
+        text_indexes = numpy.flatnonzero(text_fits)
+        line_starts = text_word_starts[text_indexes]
+        while len(text_indexes):
+            ends = numpy.searchsorted(end_units, start_units[line_starts] + max_units, side='right')
+            ends = numpy.minimum(ends, text_word_ends[text_indexes])
+            rounds_indexes.append(text_indexes)
+            rounds_ends.append(ends)
+            not_done = ends < text_word_ends[text_indexes]
+            text_indexes = text_indexes[not_done]
+            line_starts = ends[not_done]
+
+        if rounds_indexes:
+            # The lines of each text in order, and the words each of them starts and ends with
+            line_indexes = numpy.concatenate(rounds_indexes)
+            order = numpy.argsort(line_indexes, kind='stable')
+            line_indexes = line_indexes[order]
+            line_ends = numpy.concatenate(rounds_ends)[order]
+            line_starts = numpy.empty_like(line_ends)
+            line_starts[1:] = line_ends[:-1]
+            first_lines = numpy.ones(len(line_indexes), dtype=bool)
+            first_lines[1:] = line_indexes[1:] != line_indexes[:-1]
+            line_starts[first_lines] = text_word_starts[line_indexes[first_lines]]
+            lines = [
+                joined[start:end]
+                for start, end in zip(word_starts[line_starts].tolist(), word_ends[line_ends - 1].tolist())
+            ]
+            line_counts = numpy.bincount(line_indexes, minlength=len(batch)).tolist()
+            first_line = 0
+            for i, line_count in zip(batch, line_counts):
+                if line_count:
+                    ret[i] = lines[first_line:first_line + line_count]
+                    first_line += line_count
+
+    for i, text in enumerate(texts):
+        if ret[i] is None:
+            ret[i] = get_multi_cell_lines(pdf, text, max_line_length)
+    return ret
+
+
+def measure_meetings(pdf, meetings):
+    """Sets the wrapped lines of every one of meetings, measuring the texts of all the meetings set in the same fonts
+    and width together with get_multi_cell_lines_batch. Needs can_measure_in_batches(pdf)."""
+    batches = {}
+    for meeting in meetings:
+        styles, texts = zip(*meeting.get_measured_texts())
+        batches.setdefault((meeting.font, meeting.font_size, meeting.meeting_column_width, styles), []).append(
+            (meeting, texts))
+    for (font, font_size, max_line_length, styles), batch in batches.items():
+        # One column of texts for each of the measured texts, which all meetings in the batch set in the same style
+        columns_lines = []
+        for style, texts in zip(styles, zip(*(texts for _, texts in batch))):
+            pdf.set_font(font, style, font_size)
+            columns_lines.append(get_multi_cell_lines_batch(pdf, texts, max_line_length))
+        for (meeting, _), wrapped_lines in zip(batch, zip(*columns_lines)):
+            meeting.wrapped_lines = list(wrapped_lines)
+
+
+@functools.lru_cache(maxsize=256)
+def get_styled_runs(text):
+    """Parses text with b/i/u tags into a tuple of (style, words) runs. Results are cached per input string."""
     parser = StyledStringParser()
     parser.feed(text)
-    parts = []
-    for part in parser.output:
-        if isinstance(part, StyledString):
-            parts.extend([StyledString(p, style=part.style) for p in re.split(r' ', part.value)])
-        else:
-            parts.extend(part)
+    parser.close()
+    return tuple((part.style, tuple(re.split(r' ', part.value))) for part in parser.output)
+
 
+def get_styled_line_cells(pdf, text, max_line_length, font, font_style, font_size):
+    cell_margin = 2 * pdf.c_margin
+    word_widths = {}
+
+    def get_width(style, word):
+        key = (style, word)
+        if key not in word_widths:
+            pdf.set_font(font, style, font_size)
+            word_widths[key] = pdf.get_string_width(word)
+        return word_widths[key]
+
+    def to_cells(line):
+        return [StyledString(' '.join(words), style=style) for style, words in line]
+
+    words = [(style, word) for style, run_words in get_styled_runs(text) for word in run_words]
     lines = []
+    # Each run in current_line is a (style, words) pair, and current_width is the sum of the run widths, so
+    # a word is measured once when it is appended instead of the whole line being measured for every word.
     current_line = []
-    for i in range(len(parts)):
-        part = parts[i]
-        proposed_line = current_line.copy()
-        if proposed_line:
-            if isinstance(proposed_line[-1], StyledString) and isinstance(part, StyledString):
-                if proposed_line[-1].style == part.style:
-                    proposed_line[-1] = StyledString(str(proposed_line[-1]) + ' ' + str(part), style=part.style)
-                else:
-                    proposed_line.append(part)
-            elif isinstance(proposed_line[-1], str) and isinstance(part, str):
-                proposed_line[-1] = proposed_line[-1] + ' ' + part
-            else:
-                proposed_line.append(part)
+    current_width = 0
+    for i in range(len(words)):
+        style, word = words[i]
+        extends_run = bool(current_line) and current_line[-1][0] == style
+        if extends_run:
+            proposed_width = current_width + get_width(style, ' ') + get_width(style, word)
+            proposed_runs = len(current_line)
         else:
-            proposed_line.append(part)
-
-        def get_width(line):
-            w = 0
-            for s in line:
-                if isinstance(s, StyledString):
-                    pdf.set_font(font, s.style, font_size)
-                else:
-                    pdf.set_font(font, font_style, font_size)
-                w += pdf.get_string_width(str(s))
-            return w
-
-        width = get_width(proposed_line)
-        if width + len(proposed_line) * 2 * pdf.c_margin > max_line_length:
-            lines.append(current_line)
-            current_line = [part]
+            proposed_width = current_width + get_width(style, word)
+            proposed_runs = len(current_line) + 1
+
+        if proposed_width + proposed_runs * cell_margin > max_line_length:
+            lines.append(to_cells(current_line))
+            current_line = [(style, [word])]
+            current_width = get_width(style, word)
         else:
-            current_line = proposed_line
+            if extends_run:
+                current_line[-1][1].append(word)
+            else:
+                current_line.append((style, [word]))
+            current_width = proposed_width
 
-        width = get_width(current_line)
-        if width + len(proposed_line) * 2 * pdf.c_margin > max_line_length:
-            lines.append(current_line)
+        if current_width + proposed_runs * cell_margin > max_line_length:
+            lines.append(to_cells(current_line))
             current_line = []
-        elif i == len(parts) - 1:
-            lines.append(current_line)
+            current_width = 0
+        elif i == len(words) - 1:
+            lines.append(to_cells(current_line))
     return lines
 
 
@@ -130,6 +274,11 @@ class PDFObject:
     def height(self):
         raise NotImplementedError()
 
+    @property
+    def advance(self):
+        # How far below where it starts writing the object leaves the cursor, which is where the next object goes
+        return self.height or 0
+
     def write(self, pdf, x=None, y=None):
         raise NotImplementedError()
 
@@ -273,10 +422,9 @@ class PDFFormatsTable(PDFObject):
             elif not left:
                 other = self.formats[i - 1]
             if other:
-                while format.height < other.height:
-                    format.format.name += ' '
+                format.pad_to_height(other.height)
             if not left or i >= len(self.formats) - 1:
-                height += format.height
+                height += max(format.height, other.height) if other else format.height
         return height
 
     def write(self, pdf, x=None, y=None):
@@ -316,9 +464,9 @@ class PDFFormatsTable(PDFObject):
             elif not left:
                 other = self.formats[i - 1]
             if other:
-                while format.height < other.height:
-                    format.format.name += ' '
-            format.write(pdf, x=current_x, y=current_y, border=border)
+                format.pad_to_height(other.height)
+            format.write(pdf, x=current_x, y=current_y, border=border,
+                         row_height=max(format.height, other.height) if other else None)
             current_y = before_y if left else before_y + max(format.height, other.height)
 
         pdf.set_xy(x, pdf.get_y())
@@ -337,20 +485,36 @@ class PDFFormat(PDFObject):
         self.font_size = font_size
         self.text_line_padding = text_line_padding
 
+    def get_lines(self):
+        pdf = self.pdf_func()
+        pdf.set_font(self.font, '', self.font_size)
+        return get_multi_cell_lines(pdf, self.format.name, self.name_column_width)
+
     @property
     def height(self):
         pdf = self.pdf_func()
 
-        pdf.set_font(self.font, '', self.font_size)
-        lines = get_multi_cell_lines(pdf, self.format.name, self.name_column_width)
+        lines = self.get_lines()
         text_height = pdf.font_size
         padding = len(lines) * self.text_line_padding
         height = (text_height * len(lines)) + padding
         return height
 
-    def write(self, pdf, x=None, y=None, border='LTRB'):
+    def pad_to_height(self, height):
+        # Trailing spaces wrap the name onto more lines, so it's as tall as the other name in its row. They only ever
+        # add one line: once they've wrapped onto a line of their own, more of them stay on it. Padding stops there,
+        # and write draws the rest of the row's height as an empty cell.
+        while self.height < height:
+            if self.format.name.endswith(' ') and self.get_lines()[-1] == '':
+                break
+            self.format.name += ' '
+
+    def write(self, pdf, x=None, y=None, border='LTRB', row_height=None):
         if x is not None and y is not None:
             pdf.set_xy(x, y)
+        height = self.height
+        if row_height is None:
+            row_height = height
         pdf.set_text_color(0, 0, 0)
         pdf.set_draw_color(*hex2dec('#000000'))
         key_cell_border = 0
@@ -359,26 +523,43 @@ class PDFFormat(PDFObject):
             key_cell_border = border
             name_cell_border = border.replace('L', '')
         pdf.set_font(self.font, 'B', self.font_size)
-        pdf.cell(self.key_column_width, h=max(pdf.font_size + self.text_line_padding, self.height), txt=self.format.key, ln=0, align='L', border=key_cell_border)
+        pdf.cell(self.key_column_width, h=max(pdf.font_size + self.text_line_padding, row_height), txt=self.format.key, ln=0, align='L', border=key_cell_border)
         pdf.set_font(self.font, '', self.font_size)
+        empty_cell_border = 0
+        if row_height > height and name_cell_border:
+            # The rest of the row is an empty cell below the name, and the bottom border goes below that
+            name_cell_border, empty_cell_border = name_cell_border.replace('B', ''), name_cell_border.replace('T', '')
+        name_x = pdf.get_x()
         pdf.multi_cell(self.name_column_width, h=pdf.font_size + self.text_line_padding, txt=self.format.name, border=name_cell_border)
+        if row_height > height:
+            pdf.set_x(name_x)
+            pdf.cell(self.name_column_width, h=row_height - height, ln=2, border=empty_cell_border)
 
 
 class PDFMeeting(PDFObject):
+    DEFAULT_TIME_COLUMN_WIDTH = 15
+    DEFAULT_DURATION_COLUMN_WIDTH = 15
+
     def __init__(self, meeting, pdf_func, total_width, time_column_width=None, duration_column_width=None,
-                 font='dejavusans', font_size=12, separator_color='#D3D3D3'):
+                 font='dejavusans', font_size=12, separator_color='#D3D3D3', height=None, fragment_cache=None,
+                 wrapped_lines=None):
         if not isinstance(meeting, Meeting):
             raise TypeError('Expected Meeting object')
         super().__init__(pdf_func)
         self.meeting = meeting
-        self.time_column_width = time_column_width if time_column_width else 15
-        self.duration_column_width = duration_column_width if duration_column_width else 15
+        self.time_column_width = time_column_width if time_column_width else self.DEFAULT_TIME_COLUMN_WIDTH
+        self.duration_column_width = \
+            duration_column_width if duration_column_width else self.DEFAULT_DURATION_COLUMN_WIDTH
         self.font = font
         self.font_size = font_size
         self.total_width = total_width
         self.separator_color = separator_color
         if not self.separator_color.startswith('#'):
             self.separator_color = '#' + self.separator_color
+        # A height or wrapped lines that are already known, e.g. from a plan, save measuring the meeting again
+        self._height = height
+        self.fragment_cache = fragment_cache
+        self.wrapped_lines = wrapped_lines
 
     def get_time(self):
         ampm = 'AM'
@@ -406,44 +587,94 @@ class PDFMeeting(PDFObject):
             return '(' + self.meeting.formats + ')'
         return ''
 
+    def get_name_and_formats(self):
+        text = self.get_name()
+        meeting_formats = self.get_formats()
+        if meeting_formats:
+            text += ' ' + meeting_formats
+        return text
+
+    def get_measured_texts(self):
+        """Returns the (font style, text) pairs whose wrapped lines make up the height of the meeting."""
+        return ('B', self.get_name_and_formats()), ('', self.get_location())
+
     @property
     def meeting_column_width(self):
         return self.total_width - self.time_column_width - self.duration_column_width
 
+    def get_cache_key(self, pdf):
+        # Everything that changes how the meeting is measured or drawn, besides where it's drawn
+        return self.fragment_cache.get_key(
+            self.get_time(), self.get_duration(), self.get_name_and_formats(), self.get_location(), self.font,
+            self.font_size, self.total_width, self.time_column_width, self.duration_column_width,
+            self.separator_color, pdf.k, pdf.c_margin, pdf.line_width
+        )
+
     @property
     def height(self):
-        pdf = self.pdf_func()
+        # Layout asks for the height of every meeting more than once, and nothing it depends on changes
+        if self._height is None:
+            if self.fragment_cache is None or self.wrapped_lines is not None:
+                self._height = self._get_height()
+            else:
+                key = self.get_cache_key(self.pdf_func())
+                self._height = self.fragment_cache.get_height(key)
+                if self._height is None:
+                    self._height = self._get_height()
+                    self.fragment_cache.put_height(key, self._height)
+        return self._height
 
-        pdf.set_font(self.font, 'B', self.font_size)
-        meeting_name = self.get_name()
-        meeting_formats = self.get_formats()
-        if meeting_formats:
-            meeting_name += ' ' + meeting_formats
-        lines = get_multi_cell_lines(pdf, meeting_name, self.meeting_column_width)
-        text_height = pdf.font_size
-        height = (text_height * len(lines))
+    @property
+    def advance(self):
+        # The separator line is part of the height, but the cursor ends up above it
+        return self.height - self.pdf_func().line_width
+
+    def get_wrapped_lines(self):
+        """Returns the lines each of the measured texts is wrapped into. They're only measured once."""
+        if self.wrapped_lines is None:
+            pdf = self.pdf_func()
+            ret = []
+            for style, text in self.get_measured_texts():
+                pdf.set_font(self.font, style, self.font_size)
+                ret.append(get_multi_cell_lines(pdf, text, self.meeting_column_width))
+            self.wrapped_lines = ret
+        return self.wrapped_lines
+
+    def _get_height(self):
+        pdf = self.pdf_func()
 
-        pdf.set_font(self.font, '', self.font_size)
-        meeting_location = self.get_location()
-        lines = get_multi_cell_lines(pdf, meeting_location, self.meeting_column_width)
-        text_height = pdf.font_size
-        height += (text_height * len(lines))
+        height = 0
+        for lines in self.get_wrapped_lines():
+            # What pdf.font_size is after set_font, which lines that were already known didn't need
+            text_height = self.font_size / pdf.k
+            height += (text_height * len(lines))
         return height + pdf.line_width + 2  # 1mm line break before and after line
 
     def write(self, pdf, x=None, y=None):
         if x is None or y is None:
             x = pdf.get_x()
             y = pdf.get_y()
+        if self.fragment_cache is None or not hasattr(pdf, 'record_fragment'):
+            return self._write(pdf, x, y)
+        # An unchanged meeting drawn after the same font and colors were set is copied from an earlier run
+        key = self.get_cache_key(pdf)
+        state = pdf.get_graphics_state()
+        fragment = self.fragment_cache.get_fragment(key, state)
+        if fragment is not None:
+            pdf.place_fragment(fragment, x, y)
+            return
+        fragment = pdf.record_fragment(x, y, lambda: self._write(pdf, x, y))
+        if fragment is not None:
+            self.fragment_cache.put_fragment(key, state, fragment)
+
+    def _write(self, pdf, x, y):
         pdf.set_xy(x, y)
         pdf.set_text_color(0, 0, 0)
         pdf.set_font(self.font, 'B', self.font_size)
         pdf.cell(self.time_column_width, h=pdf.font_size, txt=self.get_time(), ln=0, align='C')
         pdf.cell(self.duration_column_width, h=pdf.font_size, txt=self.get_duration(), ln=0, align='C')
 
-        text = self.get_name()
-        meeting_formats = self.get_formats()
-        if meeting_formats:
-            text += ' ' + meeting_formats
+        text = self.get_name_and_formats()
         pdf.multi_cell(self.meeting_column_width, h=pdf.font_size, txt=text, border=0, align='L')
 
         pdf.set_xy(x + self.duration_column_width + self.time_column_width, pdf.get_y())
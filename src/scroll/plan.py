@@ -0,0 +1,155 @@
+import datetime
+import json
+from .bmlt_objects import Format, Meeting
+from .pdf_objects import (PDFBlankPage, PDFFormatsTable, PDFMainSectionHeader, PDFMeeting, PDFPhoneList,
+                          PDFSectionHeader, PDFSubSectionHeader, PDFTwelveSteps, PDFTwelveTraditions)
+
+
+# Bumped whenever a plan written by an older version can't be rendered the same way any more
+PLAN_VERSION = 1
+
+HEADER_FIELDS = ['text', 'cell_width', 'line_padding', 'font', 'font_size']
+PAGE_FILLER_FIELDS = ['total_width', 'font', 'font_size', 'font_color', 'header_text', 'header_font',
+                      'header_font_size', 'header_font_color', 'header_fill_color', 'header_top_margin', 'line_padding']
+
+# The type name of each object in a plan, and the attributes stored for it, which are also the keyword arguments it is
+# created with. Meetings and the formats table are stored separately.
+PLAN_OBJECTS = {
+    PDFBlankPage: ('blank', []),
+    PDFSectionHeader: ('header', HEADER_FIELDS + ['font_color', 'fill_color']),
+    PDFMainSectionHeader: ('main_header', HEADER_FIELDS),
+    PDFSubSectionHeader: ('sub_header', HEADER_FIELDS),
+    PDFPhoneList: ('phone_list', PAGE_FILLER_FIELDS + ['total_height', 'number_column_width']),
+    PDFTwelveSteps: ('twelve_steps', PAGE_FILLER_FIELDS + ['number_column_width']),
+    PDFTwelveTraditions: ('twelve_traditions', PAGE_FILLER_FIELDS + ['number_column_width']),
+}
+PLAN_TYPES = {name: (cls, fields) for cls, (name, fields) in PLAN_OBJECTS.items()}
+
+FORMATS_TABLE_FIELDS = ['total_width', 'margin_width', 'font', 'font_size', 'key_column_width', 'table_header_text',
+                        'header_font', 'header_font_size', 'header_font_color', 'header_fill_color']
+
+
+def dump_meeting(meeting):
+    """Returns meeting as the dict tomato returns for it, with the fields Meeting reads."""
+    duration_minutes = int(meeting.duration.total_seconds()) // 60
+    ret = {
+        'meeting_name': meeting.name,
+        'start_time': meeting.start_time.strftime('%H:%M:%S'),
+        'duration_time': '{}:{:02d}:00'.format(duration_minutes // 60, duration_minutes % 60),
+        'weekday_tinyint': str(meeting.weekday),
+        'location_text': meeting.facility,
+        'location_street': meeting.street,
+        'location_municipality': meeting.city,
+        'location_province': meeting.province,
+        'location_postal_code_1': meeting.postal_code,
+        'nation': meeting.nation,
+        'formats': meeting.formats,
+        'format_shared_id_list': '' if meeting.format_ids == -1 else ','.join(str(i) for i in meeting.format_ids),
+        'service_body_bigint': meeting.service_body_id,
+    }
+    return {key: value for key, value in ret.items() if value is not None}
+
+
+def dump_format(format):
+    return {'id': str(format.id), 'key_string': format.key, 'name_string': format.name,
+            'description': format.description}
+
+
+def dump_object(obj):
+    """Returns the plan entry of a PDFObject, without its position."""
+    if isinstance(obj, PDFMeeting):
+        return {'type': 'meeting', 'meeting': dump_meeting(obj.meeting), 'height': obj.height,
+                'lines': obj.get_wrapped_lines()}
+    if isinstance(obj, PDFFormatsTable):
+        ret = {'type': 'formats_table'}
+        ret.update((field, getattr(obj, field)) for field in FORMATS_TABLE_FIELDS)
+        # Names are stored the way the table padded them to line up the rows. The blank cell that evens out the
+        # last row is added back when the table is created again.
+        ret['formats'] = [dump_format(f.format) for f in obj.formats if f.format.id != -1]
+        return ret
+    if type(obj) not in PLAN_OBJECTS:
+        raise ValueError('{} can not be stored in a layout plan'.format(type(obj).__name__))
+    name, fields = PLAN_OBJECTS[type(obj)]
+    ret = {'type': name}
+    ret.update((field, getattr(obj, field)) for field in fields)
+    return ret
+
+
+def load_object(entry, pdf_func, meeting_kwargs):
+    """Creates the PDFObject of a plan entry again. meeting_kwargs are the plan's meeting options."""
+    kwargs = {key: value for key, value in entry.items() if key not in ('type', 'page', 'x', 'y')}
+    if entry['type'] == 'meeting':
+        return PDFMeeting(Meeting(entry['meeting']), pdf_func, height=entry['height'], wrapped_lines=entry['lines'],
+                          **meeting_kwargs)
+    if entry['type'] == 'formats_table':
+        kwargs['formats'] = [Format(f) for f in kwargs['formats']]
+        return PDFFormatsTable(pdf_func=pdf_func, **kwargs)
+    if entry['type'] not in PLAN_TYPES:
+        raise Exception('Unknown layout plan object type {}'.format(entry['type']))
+    cls, fields = PLAN_TYPES[entry['type']]
+    if 'number_column_width' in kwargs and issubclass(cls, PDFTwelveSteps):
+        kwargs['number_colulmn_width'] = kwargs.pop('number_column_width')
+    return cls(pdf_func=pdf_func, **kwargs)
+
+
+def dump_plan(options, meeting_kwargs, placements):
+    """
+    Returns the plan of a laid out booklet: a dict that can be stored as JSON, holding the booklet's options, the
+    options of its meetings and every object on every PDF page along with where it is drawn. Meetings also hold their
+    height and wrapped lines, which layout already measured, and load_placements gives both back to them, so nothing
+    measures a meeting between laying it out and drawing it.
+    """
+    options = dict(options)
+    if options.get('creation_date') is not None:
+        options['creation_date'] = options['creation_date'].isoformat()
+    pages = []
+    for sheet in placements:
+        objects = []
+        for number, obj, x, y in sheet:
+            entry = dump_object(obj)
+            entry['page'] = number
+            entry['x'] = x
+            entry['y'] = y
+            objects.append(entry)
+        pages.append(objects)
+    return {'version': PLAN_VERSION, 'options': options, 'meeting': meeting_kwargs, 'pages': pages}
+
+
+def get_plan_options(plan):
+    """Returns the Booklet options of a plan."""
+    if plan.get('version') != PLAN_VERSION:
+        raise Exception('Unsupported layout plan version {}, expected {}'.format(plan.get('version'), PLAN_VERSION))
+    options = dict(plan['options'])
+    if options.get('creation_date') is not None:
+        options['creation_date'] = datetime.datetime.fromisoformat(options['creation_date'])
+    return options
+
+
+def load_placements(plan, pdf_func, fragment_cache=None):
+    """Returns the objects of a plan and where they are drawn, the way Booklet.get_placements does."""
+    meeting_kwargs = dict(plan['meeting'], fragment_cache=fragment_cache)
+    placements = []
+    for objects in plan['pages']:
+        placements.append([
+            (entry['page'], load_object(entry, pdf_func, meeting_kwargs), entry['x'], entry['y'])
+            for entry in objects
+        ])
+    return placements
+
+
+def write_plan(plan, output):
+    """Writes plan as compact JSON to output, a path or a binary file-like object."""
+    data = json.dumps(plan, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    if hasattr(output, 'write'):
+        output.write(data)
+        return
+    with open(output, 'wb') as f:
+        f.write(data)
+
+
+def read_plan(path):
+    with open(path, 'rb') as f:
+        try:
+            return json.loads(f.read())
+        except json.decoder.JSONDecodeError:
+            raise Exception('Invalid layout plan {}'.format(path))
@@ -0,0 +1,32 @@
+import threading
+
+
+# The stages Booklet reports progress for: meetings laid out, and PDF pages drawn
+STAGE_LAYOUT = 'layout'
+STAGE_RENDER = 'render'
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    """
+    Lets one thread, e.g. a web server giving up on a request, stop a render running in another. Booklet checks the
+    token between meetings, between page filler attempts and between PDF pages, and raises RenderCancelled once it has
+    been cancelled.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise RenderCancelled('The render was cancelled')
@@ -0,0 +1,100 @@
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import fpdf
+
+
+@functools.lru_cache()
+def get_source_fingerprint(font_files):
+    """Hashes everything besides the booklet inputs that changes the rendered bytes: the fpdf version, scroll's own
+    source and the font files."""
+    h = hashlib.sha256()
+    h.update(fpdf.FPDF_VERSION.encode('utf-8'))
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(package_dir)):
+        if name.endswith('.py'):
+            with open(os.path.join(package_dir, name), 'rb') as f:
+                h.update(name.encode('utf-8'))
+                h.update(f.read())
+    for path in font_files:
+        stat = os.stat(path)
+        h.update('{}:{}:{}'.format(os.path.basename(path), stat.st_size, int(stat.st_mtime)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_content_hash(meetings, formats):
+    h = hashlib.sha256()
+    for meeting in meetings:
+        h.update(json.dumps(meeting, sort_keys=True).encode('utf-8'))
+    h.update(json.dumps(formats, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_render_key(content_hash, options, fingerprint):
+    h = hashlib.sha256()
+    h.update(fingerprint.encode('utf-8'))
+    h.update(json.dumps(options, sort_keys=True, default=str).encode('utf-8'))
+    h.update(content_hash.encode('utf-8'))
+    return h.hexdigest()
+
+
+class RenderCache:
+    """A directory of rendered PDFs named by their render key."""
+
+    def __init__(self, cache_dir, max_entries=None):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.pdf')
+
+    def get(self, key, output_file):
+        """Copies the cached PDF for key to output_file, a path or a binary file-like object. Returns False if there is
+        no cached PDF."""
+        path = self._get_path(key)
+        try:
+            if hasattr(output_file, 'write'):
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, output_file)
+            else:
+                shutil.copyfile(path, output_file)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        # Touch the entry so pruning removes the least recently used PDFs first
+        os.utime(path)
+        self.hits += 1
+        return True
+
+    @contextlib.contextmanager
+    def open_entry(self, key):
+        """Opens a binary file to write the PDF for key to. It only becomes visible in the cache once the with block
+        finishes without an exception."""
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            os.replace(tmp_file, self._get_path(key))
+        except:
+            os.remove(tmp_file)
+            raise
+        if self.max_entries:
+            self.prune()
+
+    def prune(self):
+        entries = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.pdf')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda path: os.stat(path).st_mtime)
+        for path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
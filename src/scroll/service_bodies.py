@@ -0,0 +1,57 @@
+from .bmlt_objects import get_key
+from .sources import filter_service_bodies
+
+
+class ServiceBodyTree:
+    """
+    The service body hierarchy, as returned by tomato's GetServiceBodies.
+
+    Ids are kept as strings, the way tomato returns them. A service body that isn't in the tree has no known children,
+    so it only covers itself.
+    """
+
+    def __init__(self, service_bodies):
+        self._children = {}
+        for service_body in service_bodies:
+            service_body_id = str(get_key(service_body, 'id'))
+            parent_id = str(service_body.get('parent_id') or '0')
+            self._children.setdefault(parent_id, []).append(service_body_id)
+
+    def get_descendants(self, service_body_id):
+        """Returns the ids of service_body_id and every service body below it."""
+        ret = set()
+        pending = [str(service_body_id)]
+        while pending:
+            service_body_id = pending.pop()
+            if service_body_id in ret:
+                continue
+            ret.add(service_body_id)
+            pending.extend(self._children.get(service_body_id, []))
+        return ret
+
+    def get_coverage(self, service_body_ids, recursive=False):
+        """Returns the ids of the service bodies whose meetings a query for service_body_ids returns."""
+        if not recursive:
+            return set(str(i) for i in service_body_ids)
+        ret = set()
+        for service_body_id in service_body_ids:
+            ret.update(self.get_descendants(service_body_id))
+        return ret
+
+
+def get_used_formats(meetings, formats):
+    """Returns the formats used by meetings, in their original order, the same ones tomato returns for a query for
+    just those meetings with get_used_formats."""
+    used = set()
+    for meeting in meetings:
+        format_ids = meeting.get('format_shared_id_list')
+        if format_ids:
+            used.update(i.strip() for i in format_ids.split(','))
+    return [f for f in formats if str(f.get('id')) in used]
+
+
+def partition_meetings(meetings, formats, service_body_ids):
+    """Returns the meetings and formats a query for exactly service_body_ids would have returned, taken from the
+    response to a query that covers them, e.g. a recursive query for one of their ancestors."""
+    meetings = list(filter_service_bodies(meetings, service_body_ids))
+    return meetings, get_used_formats(meetings, formats)
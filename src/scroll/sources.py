@@ -0,0 +1,119 @@
+import hashlib
+import json
+import mmap
+import os
+import sys
+
+
+INPUT_FORMAT_JSON = 'json'
+INPUT_FORMAT_NDJSON = 'ndjson'
+VALID_INPUT_FORMATS = [
+    INPUT_FORMAT_JSON,
+    INPUT_FORMAT_NDJSON
+]
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+
+
+def get_input_format(path, input_format=None):
+    if input_format:
+        if input_format not in VALID_INPUT_FORMATS:
+            raise ValueError("Invalid input format, valid choices are: {}".format(', '.join(VALID_INPUT_FORMATS)))
+        return input_format
+    if path != '-' and path.lower().endswith(NDJSON_EXTENSIONS):
+        return INPUT_FORMAT_NDJSON
+    return INPUT_FORMAT_JSON
+
+
+def iter_lines(path):
+    """Yields the non-blank lines of a file as bytes. Files are memory-mapped, so only the pages around the current
+    line need to be resident no matter how large the file is. A path of - reads stdin."""
+    if path == '-':
+        for line in sys.stdin.buffer:
+            if line.strip():
+                yield line
+        return
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            size = len(m)
+            start = 0
+            while start < size:
+                end = m.find(b'\n', start)
+                if end == -1:
+                    end = size
+                line = m[start:end]
+                start = end + 1
+                if line.strip():
+                    yield line
+
+
+def is_format(record):
+    return 'key_string' in record and 'meeting_name' not in record
+
+
+def read_ndjson(path, formats):
+    """Yields the meetings in an NDJSON file, one JSON object per line. Lines holding a format (an object with a
+    key_string) are appended to formats instead, so formats is only complete once the meetings have been consumed.
+    Booklet reads formats after the last meeting, so the list can be handed to it right away."""
+    for line in iter_lines(path):
+        try:
+            record = json.loads(line)
+        except json.decoder.JSONDecodeError:
+            raise Exception('Invalid json in {}: {}'.format(path, line[:80]))
+        if is_format(record):
+            formats.append(record)
+        else:
+            yield record
+
+
+def read_json(path):
+    """Reads a saved tomato GetSearchResults response with get_used_formats set."""
+    try:
+        if path == '-':
+            data = json.load(sys.stdin)
+        else:
+            with open(path, 'rb') as f:
+                data = json.load(f)
+    except json.decoder.JSONDecodeError:
+        raise Exception('Invalid json in {}'.format(path))
+    if isinstance(data, list):
+        # A response fetched without get_used_formats is just the list of meetings
+        return data, []
+    if 'meetings' not in data:
+        raise Exception('No meetings in {}'.format(path))
+    return data['meetings'], data.get('formats', [])
+
+
+def filter_service_bodies(meetings, service_body_ids):
+    service_body_ids = set(str(i) for i in service_body_ids)
+    for meeting in meetings:
+        if str(meeting.get('service_body_bigint')) in service_body_ids:
+            yield meeting
+
+
+def read_source(path, input_format=None, service_body_ids=None):
+    """Returns the meetings and formats held in a local file, or stdin if path is -. For NDJSON the meetings are an
+    iterator that streams the file, otherwise they're a list. If service_body_ids is given, only meetings belonging to
+    those service bodies are returned."""
+    if get_input_format(path, input_format) == INPUT_FORMAT_NDJSON:
+        formats = []
+        meetings = read_ndjson(path, formats)
+    else:
+        meetings, formats = read_json(path)
+    if service_body_ids is not None:
+        if isinstance(meetings, list):
+            meetings = list(filter_service_bodies(meetings, service_body_ids))
+        else:
+            meetings = filter_service_bodies(meetings, service_body_ids)
+    return meetings, formats
+
+
+def get_file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
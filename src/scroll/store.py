@@ -0,0 +1,283 @@
+import datetime
+import json
+import sqlite3
+import urllib.parse
+from .bmlt_objects import Meeting, get_key
+from .service_bodies import ServiceBodyTree, get_used_formats
+
+
+# Meetings are stored by id, which Meeting itself has no use for
+STORE_FIELDS = ['id_bigint'] + Meeting.FIELDS
+
+# Changed meetings are fetched by id, this many per request, to keep urls short
+FETCH_BATCH_SIZE = 100
+
+# GetChanges only takes a date. Changes are asked for starting this many days before the date of the last sync, so
+# that a difference between our clock and tomato's can't lose any. Fetching a meeting again does no harm.
+CHANGES_OVERLAP_DAYS = 1
+
+# How tomato sorts meetings for each header field
+ORDER_BY_COLUMNS = {
+    'weekday': 'weekday',
+    'city': 'city COLLATE NOCASE',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meetings (
+    id INTEGER PRIMARY KEY,
+    service_body_id TEXT NOT NULL,
+    weekday INTEGER,
+    city TEXT,
+    start_time TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS meetings_service_body ON meetings (service_body_id, weekday, city);
+CREATE INDEX IF NOT EXISTS meetings_weekday ON meetings (weekday, city);
+CREATE INDEX IF NOT EXISTS meetings_city ON meetings (city COLLATE NOCASE, weekday);
+CREATE TABLE IF NOT EXISTS formats (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS service_bodies (
+    id TEXT PRIMARY KEY,
+    parent_id TEXT
+);
+CREATE TABLE IF NOT EXISTS synced_queries (
+    service_body_ids TEXT NOT NULL,
+    recursive INTEGER NOT NULL,
+    PRIMARY KEY (service_body_ids, recursive)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def get_query_key(service_body_ids):
+    return ','.join(sorted(str(i) for i in service_body_ids))
+
+
+class MeetingStore:
+    """
+    A local SQLite copy of the meetings, formats and service bodies of one tomato server.
+
+    The store only holds the meetings of the queries, lists of service body ids fetched recursively or not, it has
+    been synced for. The first sync of a query downloads all of its meetings. After that, sync() asks tomato's
+    GetChanges for the meetings changed since the last sync and downloads only those, so keeping many service bodies
+    current doesn't mean downloading all of them every time, and booklets can be rendered from the store without
+    waiting for the network.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def _get_state(self, key):
+        row = self._connection.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        self._connection.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+
+    @property
+    def tomato_url(self):
+        return self._get_state('tomato_url')
+
+    @property
+    def last_sync(self):
+        """The UTC date of the last successful sync, or None if the store has never been synced."""
+        value = self._get_state('last_sync')
+        return datetime.date.fromisoformat(value) if value else None
+
+    def get_service_body_tree(self):
+        rows = self._connection.execute('SELECT id, parent_id FROM service_bodies')
+        return ServiceBodyTree({'id': row[0], 'parent_id': row[1]} for row in rows)
+
+    def get_synced_queries(self):
+        rows = self._connection.execute('SELECT service_body_ids, recursive FROM synced_queries')
+        return [(service_body_ids.split(','), bool(recursive)) for service_body_ids, recursive in rows]
+
+    def get_coverage(self, tree=None):
+        """Returns the ids of the service bodies whose meetings the store holds."""
+        tree = tree or self.get_service_body_tree()
+        ret = set()
+        for service_body_ids, recursive in self.get_synced_queries():
+            ret.update(tree.get_coverage(service_body_ids, recursive))
+        return ret
+
+    def put_meetings(self, meetings):
+        rows = []
+        for meeting in meetings:
+            rows.append((
+                int(get_key(meeting, 'id_bigint')),
+                str(get_key(meeting, 'service_body_bigint')),
+                int(get_key(meeting, 'weekday_tinyint')),
+                meeting.get('location_municipality') or '',
+                meeting.get('start_time'),
+                json.dumps(meeting, sort_keys=True),
+            ))
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO meetings (id, service_body_id, weekday, city, start_time, data) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            rows
+        )
+
+    def delete_meetings(self, meeting_ids):
+        self._connection.executemany('DELETE FROM meetings WHERE id = ?', [(int(i),) for i in meeting_ids])
+
+    def put_formats(self, formats):
+        self._connection.execute('DELETE FROM formats')
+        self._connection.executemany(
+            'INSERT INTO formats (id, position, data) VALUES (?, ?, ?)',
+            [(str(get_key(f, 'id')), i, json.dumps(f, sort_keys=True)) for i, f in enumerate(formats)]
+        )
+
+    def put_service_bodies(self, service_bodies):
+        self._connection.execute('DELETE FROM service_bodies')
+        self._connection.executemany(
+            'INSERT INTO service_bodies (id, parent_id) VALUES (?, ?)',
+            [(str(get_key(sb, 'id')), str(sb.get('parent_id') or '0')) for sb in service_bodies]
+        )
+
+    def add_synced_query(self, service_body_ids, recursive=False):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO synced_queries (service_body_ids, recursive) VALUES (?, ?)',
+            (get_query_key(service_body_ids), int(recursive))
+        )
+
+    def has_meeting(self, meeting_id):
+        row = self._connection.execute('SELECT 1 FROM meetings WHERE id = ?', (int(meeting_id),)).fetchone()
+        return row is not None
+
+    def get_meeting_ids(self, service_body_ids):
+        ret = set()
+        for service_body_id in service_body_ids:
+            rows = self._connection.execute('SELECT id FROM meetings WHERE service_body_id = ?', (service_body_id,))
+            ret.update(row[0] for row in rows)
+        return ret
+
+    def get_data(self, service_body_ids, recursive=False, order_by=None):
+        """
+        Returns the meetings and formats tomato would return for a query for service_body_ids, from the store. The
+        meetings are ordered by id, or by the header fields in order_by and then start time, the way tomato sorts
+        them with sort_keys.
+        """
+        tree = self.get_service_body_tree()
+        coverage = tree.get_coverage(service_body_ids, recursive)
+        missing = coverage - self.get_coverage(tree)
+        if missing:
+            raise Exception('The store has not been synced for service bodies {}'.format(','.join(sorted(missing))))
+        query = 'SELECT data FROM meetings WHERE service_body_id IN ({})'.format(','.join('?' * len(coverage)))
+        if order_by:
+            query += ' ORDER BY {}, start_time, id'.format(', '.join(ORDER_BY_COLUMNS[field] for field in order_by))
+        else:
+            query += ' ORDER BY id'
+        meetings = [json.loads(row[0]) for row in self._connection.execute(query, sorted(coverage))]
+        rows = self._connection.execute('SELECT data FROM formats ORDER BY position')
+        formats = [json.loads(row[0]) for row in rows]
+        return meetings, get_used_formats(meetings, formats)
+
+    def sync(self, client, tomato_url, queries, log=None):
+        """
+        Brings the store up to date with tomato for queries, a list of (service_body_ids, recursive) tuples. Queries
+        the store hasn't seen before are downloaded in full, the rest are updated from GetChanges. Nothing is
+        changed unless the whole sync succeeds.
+        """
+        syncer = StoreSyncer(self, client, tomato_url, log=log)
+        try:
+            syncer.sync(queries)
+        except:
+            self._connection.rollback()
+            raise
+        self._connection.commit()
+
+
+class StoreSyncer:
+    def __init__(self, store, client, tomato_url, log=None):
+        self.store = store
+        self.client = client
+        self.tomato_url = tomato_url.rstrip('/')
+        self.log = log
+
+    def _log(self, message):
+        if self.log:
+            self.log(message)
+
+    def get_json(self, query):
+        url = self.tomato_url + '/client_interface/json/?' + urllib.parse.urlencode(query, doseq=True)
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise Exception('Bad status code {} from {}'.format(response.status_code, url))
+        try:
+            return json.loads(response.content)
+        except json.decoder.JSONDecodeError:
+            raise Exception('Invalid json returned from {}'.format(url))
+
+    def get_meetings(self, query):
+        query = dict(query, switcher='GetSearchResults', data_field_key=','.join(STORE_FIELDS))
+        return self.get_json(query)
+
+    def sync(self, queries):
+        store = self.store
+        if store.tomato_url is None:
+            store.set_state('tomato_url', self.tomato_url)
+        elif store.tomato_url != self.tomato_url:
+            raise Exception('{} holds meetings from {}, not {}'.format(store.path, store.tomato_url, self.tomato_url))
+        started = datetime.datetime.now(datetime.timezone.utc).date()
+
+        store.put_service_bodies(self.get_json({'switcher': 'GetServiceBodies'}))
+        store.put_formats(self.get_json({'switcher': 'GetFormats'}))
+        tree = store.get_service_body_tree()
+
+        if store.last_sync is not None and store.get_synced_queries():
+            self.apply_changes(store.last_sync - datetime.timedelta(days=CHANGES_OVERLAP_DAYS), tree)
+
+        for service_body_ids, recursive in queries:
+            # A query covered by the ones already synced, e.g. an area of a region synced recursively, is up to date
+            if not tree.get_coverage(service_body_ids, recursive) <= store.get_coverage(tree):
+                self.download(service_body_ids, recursive, tree)
+
+        store.set_state('last_sync', started.isoformat())
+
+    def download(self, service_body_ids, recursive, tree):
+        meetings = self.get_meetings({'services[]': list(service_body_ids), 'recursive': '1' if recursive else '0'})
+        # Meetings the store has for these service bodies that tomato no longer returns were deleted or unpublished
+        stale = self.store.get_meeting_ids(tree.get_coverage(service_body_ids, recursive))
+        stale.difference_update(int(m['id_bigint']) for m in meetings)
+        self.store.put_meetings(meetings)
+        self.store.delete_meetings(stale)
+        self.store.add_synced_query(service_body_ids, recursive)
+        self._log('downloaded {} meetings of service bodies {}{}'.format(
+            len(meetings), ','.join(service_body_ids), ' and their children' if recursive else ''))
+
+    def apply_changes(self, start_date, tree):
+        changes = self.get_json({'switcher': 'GetChanges', 'start_date': start_date.isoformat()})
+        coverage = self.store.get_coverage(tree)
+        changed_ids = set()
+        for change in changes:
+            meeting_id = change.get('meeting_id')
+            if not meeting_id:
+                continue
+            # A meeting moved out of the store's service bodies is still in the store, and has to be removed
+            if str(change.get('service_body_id')) in coverage or self.store.has_meeting(meeting_id):
+                changed_ids.add(int(meeting_id))
+
+        changed_ids = sorted(changed_ids)
+        found = set()
+        for i in range(0, len(changed_ids), FETCH_BATCH_SIZE):
+            batch = changed_ids[i:i + FETCH_BATCH_SIZE]
+            meetings = self.get_meetings({'meeting_ids[]': batch})
+            meetings = [m for m in meetings if str(m.get('service_body_bigint')) in coverage]
+            self.store.put_meetings(meetings)
+            found.update(int(m['id_bigint']) for m in meetings)
+        # Changed meetings tomato doesn't return any more were deleted, unpublished or moved elsewhere
+        removed = [i for i in changed_ids if i not in found]
+        self.store.delete_meetings(removed)
+        self._log('{} changes since {}: {} meetings updated, {} removed'.format(
+            len(changes), start_date.isoformat(), len(found), len(removed)))
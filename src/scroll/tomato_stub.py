@@ -0,0 +1,261 @@
+"""
+A local stand-in for tomato's client_interface/json endpoint.
+
+In record mode each request is forwarded to a real server and the response is saved as a fixture. Otherwise
+requests are answered from the saved fixtures, optionally slowed down or failed on purpose, which makes it possible
+to exercise scroll end to end without network access:
+
+    python3 -m scroll.tomato_stub fixtures/ --record https://tomato.na-bmlt.org/main_server
+    python3 -m scroll.tomato_stub fixtures/ --latency 0.5 --throughput 200000 --failure-rate 0.1
+    python3 scroll.py 762 letter out.pdf --tomato-url http://localhost:8000
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .fetch import TomatoClient
+
+
+ENDPOINT_PATH = '/client_interface/json/'
+
+
+def get_fixture_key(query_string):
+    # Parameter order doesn't matter to tomato, so it shouldn't matter to the fixture lookup either
+    query = sorted(urllib.parse.parse_qsl(query_string, keep_blank_values=True))
+    return hashlib.sha256(urllib.parse.urlencode(query).encode('utf-8')).hexdigest()
+
+
+class FixtureStore:
+    def __init__(self, fixtures_dir):
+        self.fixtures_dir = fixtures_dir
+        os.makedirs(self.fixtures_dir, exist_ok=True)
+
+    def _get_path(self, query_string):
+        return os.path.join(self.fixtures_dir, get_fixture_key(query_string) + '.json')
+
+    def get(self, query_string):
+        path = self._get_path(query_string)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            fixture = json.load(f)
+        return fixture['status'], fixture['content_type'], fixture['body'].encode('utf-8')
+
+    def put(self, query_string, status, content_type, body):
+        fixture = {
+            'query': query_string,
+            'status': status,
+            'content_type': content_type,
+            'body': body.decode('utf-8'),
+        }
+        fd, tmp_file = tempfile.mkstemp(dir=self.fixtures_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(fixture, f)
+        os.replace(tmp_file, self._get_path(query_string))
+
+
+class StubStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.recorded = 0
+        self.replayed = 0
+        self.missing = 0
+        self.failed = 0
+
+    def increment(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'recorded': self.recorded,
+                'replayed': self.replayed,
+                'missing': self.missing,
+                'failed': self.failed,
+            }
+
+
+class TomatoStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.stats.increment('requests')
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/stats':
+            self._send(200, 'application/json', json.dumps(server.stats.as_dict()).encode('utf-8'))
+            return
+        if not url.path.endswith(ENDPOINT_PATH):
+            self._send(404, 'text/plain', b'Not found')
+            return
+
+        if server.failure_rate and server.random.random() < server.failure_rate:
+            server.stats.increment('failed')
+            self._send(server.failure_status, 'text/plain', b'Injected failure')
+            return
+
+        response = server.fixtures.get(url.query)
+        if response is None and server.upstream_url:
+            response = server.record(url.query)
+            if response[0] == 200:
+                server.stats.increment('recorded')
+        elif response is not None:
+            server.stats.increment('replayed')
+        if response is None:
+            server.stats.increment('missing')
+            self._send(404, 'text/plain', b'No fixture recorded for this query')
+            return
+
+        if server.latency:
+            time.sleep(server.latency)
+        self._send(*response, compress=server.compress)
+
+    def _send(self, status, content_type, body, compress=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        throughput = self.server.throughput
+        if not throughput:
+            self.wfile.write(body)
+            return
+        # Trickle the body out in chunks to simulate a slow link
+        chunk_size = max(1, int(throughput / 10))
+        for i in range(0, len(body), chunk_size):
+            self.wfile.write(body[i:i + chunk_size])
+            self.wfile.flush()
+            time.sleep(chunk_size / throughput)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class TomatoStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixtures_dir, host='127.0.0.1', port=8000, upstream_url=None, latency=0, throughput=None,
+                 failure_rate=0, failure_status=503, seed=None, compress=True, verbose=False):
+        super().__init__((host, port), TomatoStubHandler)
+        self.fixtures = FixtureStore(fixtures_dir)
+        self.upstream_url = upstream_url.rstrip('/') if upstream_url else None
+        self.latency = latency
+        self.throughput = throughput
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.random = random.Random(seed)
+        self.compress = compress
+        self.verbose = verbose
+        self.stats = StubStats()
+        # Only used to record, with the same timeouts and retries as scroll itself
+        self.client = TomatoClient()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def record(self, query_string):
+        """Forwards a query to the upstream server and returns its response. Only successful responses are saved, so
+        an error page is never replayed as if it were tomato's answer."""
+        url = self.upstream_url + ENDPOINT_PATH + '?' + query_string
+        try:
+            response = self.client.get(url)
+        except Exception as e:
+            return 502, 'text/plain', str(e).encode('utf-8')
+        content_type = response.headers.get('Content-Type', 'application/json')
+        if response.status_code == 200:
+            self.fixtures.put(query_string, response.status_code, content_type, response.content)
+        return response.status_code, content_type, response.content
+
+    def start(self):
+        """Serves requests from a background thread, e.g. from a test or benchmark. Call shutdown() to stop."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='scroll.tomato_stub')
+    parser.add_argument('fixtures_dir', help='Directory the recorded responses are saved to and replayed from')
+    parser.add_argument('--host', dest='host', default='127.0.0.1', help='Address to listen on. Defaults to 127.0.0.1')
+    parser.add_argument('--port', dest='port', type=int, default=8000, help='Port to listen on. Defaults to 8000')
+    parser.add_argument(
+        '--record',
+        dest='upstream_url',
+        help='Base url of a real tomato server, e.g. https://tomato.na-bmlt.org/main_server. Queries without a '
+             'fixture are forwarded to it and the responses are saved'
+    )
+    parser.add_argument(
+        '--latency',
+        dest='latency',
+        type=float,
+        default=0,
+        help='Seconds to wait before answering each request. Defaults to 0'
+    )
+    parser.add_argument(
+        '--throughput',
+        dest='throughput',
+        type=int,
+        help='Bytes per second responses are sent at. Defaults to unlimited'
+    )
+    parser.add_argument(
+        '--failure-rate',
+        dest='failure_rate',
+        type=float,
+        default=0,
+        help='Fraction of requests, between 0 and 1, that are answered with --failure-status. Defaults to 0'
+    )
+    parser.add_argument(
+        '--failure-status',
+        dest='failure_status',
+        type=int,
+        default=503,
+        help='Status code of injected failures. Defaults to 503'
+    )
+    parser.add_argument('--seed', dest='seed', type=int, help='Seed for failure injection, for repeatable runs')
+    parser.add_argument(
+        '--no-compression',
+        dest='compress',
+        action='store_false',
+        help='Send responses uncompressed even when the client accepts gzip'
+    )
+    parser.add_argument('--verbose', dest='verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    server = TomatoStubServer(
+        args.fixtures_dir,
+        host=args.host,
+        port=args.port,
+        upstream_url=args.upstream_url,
+        latency=args.latency,
+        throughput=args.throughput,
+        failure_rate=args.failure_rate,
+        failure_status=args.failure_status,
+        seed=args.seed,
+        compress=args.compress,
+        verbose=args.verbose
+    )
+    sys.stdout.write('Serving tomato fixtures from {} at {}\n'.format(args.fixtures_dir, server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.stdout.write(json.dumps(server.stats.as_dict()) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
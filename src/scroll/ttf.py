@@ -0,0 +1,339 @@
+import bisect
+import functools
+import mmap
+import os
+import re
+import struct
+from fpdf.ttfonts import TTFontFile
+
+
+CHAR_WIDTHS_LENGTH = 256 * 256
+
+
+class TrueTypeFont:
+    """
+    Read-only access to a TrueType font file that only parses what is asked for.
+
+    The file is memory-mapped and each table is read the first time something needs it. Character widths are looked
+    up glyph by glyph through the cmap and hmtx tables instead of being expanded for every character in the font, so
+    only the pages of the file holding the characters actually used are ever read. The values match the ones FPDF's
+    TTFontFile computes when it parses the whole file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        version, = struct.unpack_from('>L', self._data, 0)
+        if version == 0x4F54544F:
+            raise Exception('Postscript outlines are not supported: {}'.format(path))
+        if version not in (0x00010000, 0x74727565):
+            raise Exception('Not a TrueType font: {}'.format(path))
+        num_tables, = struct.unpack_from('>H', self._data, 4)
+        self.tables = {}
+        for i in range(num_tables):
+            tag, checksum, offset, length = struct.unpack_from('>4sLLL', self._data, 12 + i * 16)
+            self.tables[tag.decode('latin-1')] = (offset, length)
+
+    def close(self):
+        self._data.close()
+
+    def _get_table_offset(self, tag):
+        try:
+            return self.tables[tag][0]
+        except KeyError:
+            raise Exception('Table {} not found in {}'.format(tag, self.path))
+
+    def _unpack(self, fmt, offset):
+        return struct.unpack_from(fmt, self._data, offset)
+
+    @functools.cached_property
+    def names(self):
+        offset = self._get_table_offset('name')
+        name_format, num_records, string_offset = self._unpack('>HHH', offset)
+        if name_format != 0:
+            raise Exception('Unknown name table format {} in {}'.format(name_format, self.path))
+        string_offset += offset
+        names = {1: '', 2: '', 3: '', 4: '', 6: ''}
+        for i in range(num_records):
+            platform_id, encoding_id, language_id, name_id, length, name_offset = \
+                self._unpack('>HHHHHH', offset + 6 + i * 12)
+            if name_id not in names or names[name_id]:
+                continue
+            start = string_offset + name_offset
+            if platform_id == 3 and encoding_id == 1 and language_id == 0x409:
+                names[name_id] = self._data[start:start + length].decode('utf-16-be')
+            elif platform_id == 1 and encoding_id == 0 and language_id == 0:
+                names[name_id] = self._data[start:start + length].decode('latin-1')
+        return names
+
+    @property
+    def full_name(self):
+        names = self.names
+        ps_name = names[6] or re.sub(' ', '-', names[4] or names[1])
+        if not ps_name:
+            raise Exception('Could not find PostScript font name in {}'.format(self.path))
+        return names[6] or names[4] or ps_name
+
+    @functools.cached_property
+    def units_per_em(self):
+        return self._unpack('>H', self._get_table_offset('head') + 18)[0]
+
+    @property
+    def scale(self):
+        return 1000 / float(self.units_per_em)
+
+    @functools.cached_property
+    def bbox(self):
+        x_min, y_min, x_max, y_max = self._unpack('>hhhh', self._get_table_offset('head') + 36)
+        return x_min * self.scale, y_min * self.scale, x_max * self.scale, y_max * self.scale
+
+    @functools.cached_property
+    def index_to_loc_format(self):
+        return self._unpack('>H', self._get_table_offset('head') + 50)[0]
+
+    @functools.cached_property
+    def number_of_hmetrics(self):
+        number_of_hmetrics, = self._unpack('>H', self._get_table_offset('hhea') + 34)
+        if number_of_hmetrics == 0:
+            raise Exception('Number of horizontal metrics is 0 in {}'.format(self.path))
+        return number_of_hmetrics
+
+    @functools.cached_property
+    def num_glyphs(self):
+        return self._unpack('>H', self._get_table_offset('maxp') + 4)[0]
+
+    @functools.cached_property
+    def descriptor(self):
+        """Returns the values FPDF puts in a font's descriptor and font dict, computed the way TTFontFile does."""
+        scale = self.scale
+        ascent = descent = 0
+        if 'hhea' in self.tables:
+            hhea_ascender, hhea_descender = self._unpack('>hh', self._get_table_offset('hhea') + 4)
+            ascent = hhea_ascender * scale
+            descent = hhea_descender * scale
+
+        if 'OS/2' in self.tables:
+            offset = self._get_table_offset('OS/2')
+            version, = self._unpack('>H', offset)
+            weight_class, = self._unpack('>H', offset + 4)
+            fs_type, = self._unpack('>H', offset + 8)
+            if fs_type == 0x0002 or (fs_type & 0x0300) != 0:
+                raise Exception('Font file {} cannot be embedded due to copyright restrictions'.format(self.path))
+            typo_ascender, typo_descender = self._unpack('>hh', offset + 68)
+            if not ascent:
+                ascent = typo_ascender * scale
+            if not descent:
+                descent = typo_descender * scale
+            if version > 1:
+                cap_height = self._unpack('>h', offset + 88)[0] * scale
+            else:
+                cap_height = ascent
+        else:
+            weight_class = 500
+            if not ascent:
+                ascent = self.bbox[3]
+            if not descent:
+                descent = self.bbox[1]
+            cap_height = ascent
+
+        offset = self._get_table_offset('post')
+        italic_angle_whole, italic_angle_fraction, underline_position, underline_thickness, is_fixed_pitch = \
+            self._unpack('>hHhhL', offset + 4)
+        italic_angle = italic_angle_whole + italic_angle_fraction / 65536.0
+
+        flags = 4
+        if italic_angle != 0:
+            flags |= 64
+        if weight_class >= 600:
+            flags |= 262144
+        if is_fixed_pitch:
+            flags |= 1
+
+        return {
+            'desc': {
+                'Ascent': int(round(ascent, 0)),
+                'Descent': int(round(descent, 0)),
+                'CapHeight': int(round(cap_height, 0)),
+                'Flags': flags,
+                'FontBBox': '[%s %s %s %s]' % tuple(int(round(v, 0)) for v in self.bbox),
+                'ItalicAngle': int(italic_angle),
+                'StemV': int(round(50 + int(pow((weight_class / 65.0), 2)), 0)),
+                'MissingWidth': int(round(scale * self.get_advance_width(0), 0)),
+            },
+            'up': round(underline_position * scale),
+            'ut': round(underline_thickness * scale),
+        }
+
+    @functools.cached_property
+    def _cmap(self):
+        # The same subtable TTFontFile picks: the first Unicode format 4 table, or a UCS-4 format 12 table if that
+        # comes first
+        cmap_offset = self._get_table_offset('cmap')
+        table_count, = self._unpack('>H', cmap_offset + 2)
+        for i in range(table_count):
+            platform_id, encoding_id, offset = self._unpack('>HHL', cmap_offset + 4 + i * 8)
+            offset += cmap_offset
+            subtable_format, = self._unpack('>H', offset)
+            if platform_id == 3 and encoding_id == 10 and subtable_format == 12:
+                return self._read_cmap12(offset)
+            if ((platform_id == 3 and encoding_id == 1) or platform_id == 0) and subtable_format == 4:
+                return self._read_cmap4(offset)
+        raise Exception('Font {} does not have a cmap for Unicode'.format(self.path))
+
+    def _read_cmap4(self, offset):
+        length, = self._unpack('>H', offset + 2)
+        seg_count = self._unpack('>H', offset + 6)[0] // 2
+        end_counts = offset + 14
+        start_counts = end_counts + seg_count * 2 + 2
+        id_deltas = start_counts + seg_count * 2
+        id_range_offsets = id_deltas + seg_count * 2
+        return 4, (
+            self._unpack('>%dH' % seg_count, end_counts),
+            self._unpack('>%dH' % seg_count, start_counts),
+            self._unpack('>%dh' % seg_count, id_deltas),
+            self._unpack('>%dH' % seg_count, id_range_offsets),
+            id_range_offsets,
+            offset + length,
+        )
+
+    def _read_cmap12(self, offset):
+        group_count, = self._unpack('>L', offset + 12)
+        groups = self._unpack('>%dL' % (group_count * 3), offset + 16)
+        return 12, (groups[1::3], groups[0::3], groups[2::3])
+
+    def get_glyph(self, char):
+        """Returns the glyph index of char, 0 if the cmap maps it to the missing glyph, or None if it isn't covered by
+        the cmap at all."""
+        cmap_format, cmap = self._cmap
+        if cmap_format == 4:
+            end_counts, start_counts, id_deltas, id_range_offsets, id_range_offsets_start, limit = cmap
+            n = bisect.bisect_left(end_counts, char)
+            if n == len(end_counts) or start_counts[n] > char:
+                return None
+            if id_range_offsets[n] == 0:
+                return (char + id_deltas[n]) & 0xFFFF
+            offset = id_range_offsets_start + 2 * n + (char - start_counts[n]) * 2 + id_range_offsets[n]
+            if offset >= limit:
+                return 0
+            glyph, = self._unpack('>H', offset)
+            if glyph != 0:
+                glyph = (glyph + id_deltas[n]) & 0xFFFF
+            return glyph
+        end_codes, start_codes, start_glyphs = cmap
+        n = bisect.bisect_left(end_codes, char)
+        if n == len(end_codes) or start_codes[n] > char:
+            return None
+        return start_glyphs[n] + char - start_codes[n]
+
+    def iter_chars(self):
+        """Yields every character covered by the cmap."""
+        cmap_format, cmap = self._cmap
+        for end, start in zip(cmap[0], cmap[1]):
+            yield from range(start, end + 1)
+
+    def get_advance_width(self, glyph):
+        """Returns the advance width of glyph in font units. Like TTFontFile, glyphs past the last long metric get the
+        advance width of the last long metric, and negative widths count as 0."""
+        offset = self._get_table_offset('hmtx')
+        advance_width, = self._unpack('>H', offset + min(glyph, self.number_of_hmetrics - 1) * 4)
+        if advance_width >= (1 << 15):
+            return 0
+        return advance_width
+
+    def get_char_width(self, char):
+        """Returns the width of char in thousandths of the font size as TTFontFile reports it: 0 for characters without
+        a glyph and 65535 for glyphs with no width."""
+        if char == 0 or char == 65535:
+            return 0
+        glyph = self.get_glyph(char)
+        if not glyph or glyph >= self.num_glyphs:
+            return 0
+        return int(round(self.scale * self.get_advance_width(glyph) + 0.001)) or 65535
+
+    @functools.cached_property
+    def char_widths(self):
+        return CharWidths(self)
+
+    @functools.cached_property
+    def glyph_offsets(self):
+        return GlyphOffsets(self)
+
+
+class CharWidths(dict):
+    """
+    Character widths of a TrueType font, indexed by code point like the 65536 entry list TTFontFile builds.
+
+    Widths are read from the font the first time a character is looked up and kept afterwards. Because it's a dict,
+    looking up a character seen before costs no more than indexing the list would.
+    """
+
+    def __init__(self, font):
+        super().__init__()
+        self.font = font
+
+    def __len__(self):
+        return CHAR_WIDTHS_LENGTH
+
+    def __missing__(self, char):
+        if not 0 <= char < CHAR_WIDTHS_LENGTH:
+            raise IndexError('Character out of range: {}'.format(char))
+        if char == 0:
+            # TTFontFile keeps the number of characters with a width in the first entry
+            width = sum(1 for c in self.font.iter_chars() if c < CHAR_WIDTHS_LENGTH and self.font.get_char_width(c))
+        else:
+            width = self.font.get_char_width(char)
+        self[char] = width
+        return width
+
+
+class GlyphOffsets:
+    """The glyph offsets of a font's loca table, read on demand. Like the list TTFontFile builds, it has no entry for
+    the end of the last glyph."""
+
+    def __init__(self, font):
+        self.font = font
+
+    def __len__(self):
+        return self.font.num_glyphs
+
+    def __getitem__(self, glyph):
+        if not 0 <= glyph < self.font.num_glyphs:
+            raise IndexError('Glyph out of range: {}'.format(glyph))
+        offset = self.font._get_table_offset('loca')
+        if self.font.index_to_loc_format == 0:
+            return self.font._unpack('>H', offset + glyph * 2)[0] * 2
+        return self.font._unpack('>L', offset + glyph * 4)[0]
+
+
+class SubsetFontFile(TTFontFile):
+    """
+    FPDF's font subsetter, looking characters up in a TrueTypeFont instead of parsing the whole cmap, hmtx and loca
+    tables first. Only the glyphs of the subset are read from the font file.
+    """
+
+    def __init__(self, font):
+        super().__init__()
+        self.font = font
+        self._subset = ()
+
+    def makeSubset(self, file, subset):
+        self._subset = subset
+        return super().makeSubset(file, subset)
+
+    def getCMAP4(self, unicode_cmap_offset, glyphToChar, charToGlyph):
+        for char in self._subset:
+            glyph = self.font.get_glyph(char)
+            if glyph is not None:
+                charToGlyph[char] = glyph
+                glyphToChar.setdefault(glyph, []).append(char)
+
+    getCMAP12 = getCMAP4
+
+    def getHMTX(self, numberOfHMetrics, numGlyphs, glyphToChar, scale):
+        # The subsetter only needs the metrics of the glyphs it keeps, which it reads one by one with getHMetric
+        pass
+
+    def getLOCA(self, indexToLocFormat, numGlyphs):
+        self.glyphPos = self.font.glyph_offsets
@@ -0,0 +1,216 @@
+"""
+Updates a PDF rendered earlier by appending an incremental update section to it instead of writing it again.
+
+An incremental update leaves every byte of the old file where it is and adds new versions of some of its objects after
+it, along with an xref section that points at them and back at the old one through /Prev. Here the update holds the
+pages that were rendered again, with their content and fonts, a new version of the page tree that lists them in place
+of the pages they replace and, when the first page was replaced, of the catalog, whose /OpenAction points at it.
+Pages that didn't change are kept as they are, so a booklet with a few changed meetings grows by a few pages.
+
+Replaced pages stay in the file, no longer reachable from the page tree, until fold_updates() writes the file again
+with only the objects its pages use.
+"""
+import json
+import re
+from .compact import (PDFObject, UnsupportedPDF, decode_stream, get_page_contents, get_reachable, get_references,
+                      get_trailer_reference, parse_pdf, remove_unused_fonts, rewrite_references)
+
+
+class UnsupportedUpdate(Exception):
+    pass
+
+
+def get_plan_key(value):
+    # Plans read from JSON hold lists where plans made by Booklet.get_plan hold tuples
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def get_kept_pages(previous_plan, plan):
+    """
+    Returns, for each PDF page of plan, the index of the PDF page of previous_plan it can be kept as, because
+    everything on it is drawn the same way at the same position, or None if it has to be rendered again.
+
+    A page is only compared with the page at the same index of previous_plan. A meeting added or removed early in the
+    booklet moves the meetings after it, so every page they're drawn on at a new position is rendered again, even if
+    nothing on it changed.
+
+    Raises UnsupportedUpdate if the plans were made with different options, which change every page, or the PDF of
+    previous_plan can't be updated because it was compacted or linearized.
+    """
+    for p in (previous_plan, plan):
+        if p['options'].get('compact') or p['options'].get('linearize'):
+            raise UnsupportedUpdate('Compact and linearized PDFs can not be updated')
+    if get_plan_key(previous_plan['options']) != get_plan_key(plan['options']):
+        raise UnsupportedUpdate('The booklet options changed')
+    if get_plan_key(previous_plan['meeting']) != get_plan_key(plan['meeting']):
+        raise UnsupportedUpdate('The meeting options changed')
+    previous_pages = [get_plan_key(page) for page in previous_plan['pages']]
+    ret = []
+    for i, page in enumerate(plan['pages']):
+        kept = i < len(previous_pages) and previous_pages[i] == get_plan_key(page)
+        ret.append(i if kept else None)
+    return ret
+
+
+def get_page_numbers(objects, number):
+    """Returns the numbers of the page objects under the page tree node number, in order."""
+    dictionary = objects[number].dictionary
+    if not re.search(rb'/Type\s*/Pages\b', dictionary):
+        return [number]
+    kids = re.search(rb'/Kids\s*\[([^\]]*)\]', dictionary)
+    if kids is None:
+        raise UnsupportedPDF('Page tree node {} has no /Kids'.format(number))
+    ret = []
+    for kid in get_references(kids.group(1)):
+        ret.extend(get_page_numbers(objects, kid))
+    return ret
+
+
+def get_pages_root(objects, trailer):
+    root = get_trailer_reference(trailer, b'Root')
+    if root is None or root not in objects or b'/Encrypt' in trailer:
+        raise UnsupportedPDF('Only unencrypted PDFs with a /Root can be updated')
+    match = re.search(rb'/Pages\s+(\d+) 0 R', objects[root].dictionary)
+    if match is None:
+        raise UnsupportedPDF('The catalog has no /Pages')
+    return root, int(match.group(1))
+
+
+def write_object(out, number, obj):
+    out += b'%d 0 obj\n' % number
+    out += obj.dictionary
+    if obj.stream is not None:
+        out += b'\nstream\n' + obj.stream + b'\nendstream'
+    out += b'\nendobj\n'
+
+
+def write_xref(out, offsets):
+    """Writes a classic xref table for offsets, by object number, in as few subsections as the numbers allow."""
+    out += b'xref\n'
+    numbers = sorted(offsets)
+    start = 0
+    while start < len(numbers):
+        end = start + 1
+        while end < len(numbers) and numbers[end] == numbers[end - 1] + 1:
+            end += 1
+        out += b'%d %d\n' % (numbers[start], end - start)
+        for number in numbers[start:end]:
+            if offsets[number] is None:
+                out += b'0000000000 65535 f \n'
+            else:
+                out += b'%010d 00000 n \n' % offsets[number]
+        start = end
+
+
+def write_trailer(out, size, root, info, previous=None):
+    out += b'trailer\n<<\n/Size %d\n/Root %d 0 R\n' % (size, root)
+    if info is not None:
+        out += b'/Info %d 0 R\n' % info
+    if previous is not None:
+        out += b'/Prev %d\n' % previous
+    out += b'>>\n'
+
+
+def append_pages(data, kept, rendered=None):
+    """
+    Returns data, a PDF written by FPDF or already updated by append_pages, with an incremental update section
+    appended that makes its pages the ones listed in kept: for each, the index of a page of data to keep, or None for
+    the next page of rendered, a PDF written by FPDF with the same page size holding the pages rendered again.
+
+    Returns data as it is if it already has those pages.
+    """
+    try:
+        objects, trailer = parse_pdf(data)
+        root, pages_root = get_pages_root(objects, trailer)
+        previous_pages = get_page_numbers(objects, pages_root)
+        if rendered is not None:
+            rendered_objects, rendered_trailer = parse_pdf(rendered)
+            rendered_pages = get_page_numbers(rendered_objects, get_pages_root(rendered_objects, rendered_trailer)[1])
+        else:
+            rendered_objects, rendered_pages = {}, []
+    except UnsupportedPDF as e:
+        raise UnsupportedUpdate(str(e))
+    if any(i is not None and i >= len(previous_pages) for i in kept):
+        raise UnsupportedUpdate('The PDF has {} pages, fewer than its plan'.format(len(previous_pages)))
+    if kept.count(None) != len(rendered_pages):
+        raise UnsupportedUpdate('{} pages were rendered for {} changed pages'.format(
+            len(rendered_pages), kept.count(None)))
+    if kept == list(range(len(previous_pages))):
+        return data
+
+    # FPDF embeds every font it was given, whether the rendered pages use it or not
+    remove_unused_fonts(rendered_objects, {number: decode_stream(rendered_objects[number])
+                                           for number in get_page_contents(rendered_objects)})
+
+    # The rendered pages and everything they use, except their own page tree, are numbered after the objects of data
+    parent_re = re.compile(rb'/Parent\s+\d+ 0 R')
+    orphaned = dict(rendered_objects)
+    for number in rendered_pages:
+        orphaned[number] = orphaned[number]._replace(dictionary=parent_re.sub(b'', orphaned[number].dictionary))
+    size = int(re.search(rb'/Size\s+(\d+)', trailer).group(1))
+    numbers = {}
+    for number in sorted(get_reachable(orphaned, rendered_pages)):
+        numbers[number] = size + len(numbers)
+    for number in rendered_pages:
+        numbers[get_trailer_reference(rendered_objects[number].dictionary, b'Parent')] = pages_root
+    update = {}
+    for number, new_number in numbers.items():
+        if new_number != pages_root:
+            obj = rendered_objects[number]
+            update[new_number] = obj._replace(dictionary=rewrite_references(obj.dictionary, numbers))
+
+    rendered_pages = iter(rendered_pages)
+    page_numbers = [previous_pages[i] if i is not None else numbers[next(rendered_pages)] for i in kept]
+    pages = objects[pages_root].dictionary
+    pages = re.sub(rb'/Kids\s*\[[^\]]*\]', b'/Kids [' + b''.join(b'%d 0 R ' % n for n in page_numbers) + b']', pages)
+    pages = re.sub(rb'/Count\s+\d+', b'/Count %d' % len(page_numbers), pages)
+    update[pages_root] = PDFObject(pages, None)
+    if page_numbers and previous_pages and page_numbers[0] != previous_pages[0]:
+        catalog = objects[root].dictionary
+        references = {number: number for number in get_references(catalog)}
+        references[previous_pages[0]] = page_numbers[0]
+        update[root] = PDFObject(rewrite_references(catalog, references), None)
+
+    out = bytearray(data)
+    if not out.endswith(b'\n'):
+        out += b'\n'
+    # Readers expect every xref section to start with the head of the free list
+    offsets = {0: None}
+    for number in sorted(update):
+        offsets[number] = len(out)
+        write_object(out, number, update[number])
+    startxref = data.rindex(b'startxref')
+    previous_xref = int(data[startxref + len(b'startxref'):].split()[0])
+    xref_offset = len(out)
+    write_xref(out, offsets)
+    write_trailer(out, max([size] + [number + 1 for number in update]), root,
+                  get_trailer_reference(trailer, b'Info'), previous=previous_xref)
+    out += b'startxref\n%d\n%%%%EOF\n' % xref_offset
+    return bytes(out)
+
+
+def fold_updates(data):
+    """
+    Returns data, a PDF updated by append_pages, written again as a single section: only the latest version of each
+    object is kept, objects nothing refers to any more, like replaced pages and their fonts, are left out, and the rest
+    are numbered from 1, in the order of their numbers in data.
+    """
+    objects, trailer = parse_pdf(data)
+    root = get_trailer_reference(trailer, b'Root')
+    info = get_trailer_reference(trailer, b'Info')
+    if root is None or b'/Encrypt' in trailer:
+        raise UnsupportedPDF('Only unencrypted PDFs with a /Root can be folded')
+    reachable = sorted(get_reachable(objects, [root, info]))
+    numbers = {old: new for new, old in enumerate(reachable, start=1)}
+
+    out = bytearray(data[:data.index(b'\n') + 1])
+    offsets = {0: None}
+    for number in reachable:
+        obj = objects[number]
+        offsets[numbers[number]] = len(out)
+        write_object(out, numbers[number], obj._replace(dictionary=rewrite_references(obj.dictionary, numbers)))
+    xref_offset = len(out)
+    write_xref(out, offsets)
+    write_trailer(out, len(reachable) + 1, numbers[root], numbers.get(info))
+    out += b'startxref\n%d\n%%%%EOF\n' % xref_offset
+    return bytes(out)
@@ -0,0 +1,47 @@
+import os
+import sys
+import pytest
+
+# scroll.py and the scroll package both live in src, and the package is found first
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+MEETING_NAMES = ['Just for Today', 'Serenity Seekers', 'Hope Group', 'Living Clean',
+                 'New Beginnings at the Old Fellowship Hall on the Corner']
+CITIES = ['Athens', 'Decatur', 'Marietta', 'Roswell', 'Stone Mountain']
+FORMATS = [
+    {'id': '1', 'key_string': 'O', 'name_string': 'Open', 'description': 'Open'},
+    {'id': '2', 'key_string': 'C', 'name_string': 'Closed', 'description': 'Closed'},
+    {'id': '3', 'key_string': 'D', 'name_string': 'Discussion', 'description': 'Discussion'},
+    {'id': '4', 'key_string': 'BT', 'name_string': 'Basic Text', 'description': 'Basic Text'},
+    {'id': '5', 'key_string': 'WC', 'name_string': 'Wheelchair accessible', 'description': 'Wheelchair accessible'},
+]
+
+
+def make_meeting(i):
+    """Returns the ith of a made up set of meeting dicts, as tomato returns them."""
+    return {
+        'id_bigint': str(i + 1),
+        'service_body_bigint': str(i % 3 + 1),
+        'meeting_name': '{} {}'.format(MEETING_NAMES[i % len(MEETING_NAMES)], i),
+        'start_time': '{:02}:{:02}:00'.format(6 + i * 7 % 16, i * 15 % 60),
+        'duration_time': '01:{:02}:00'.format(i % 2 * 30),
+        'weekday_tinyint': str(i % 7 + 1),
+        'location_text': 'Church of Somewhere' if i % 4 else '',
+        'location_street': '{} Main St'.format(i + 10),
+        'location_municipality': CITIES[i % len(CITIES)],
+        'location_province': 'GA',
+        'location_postal_code_1': '30303',
+        'formats': ','.join(f['key_string'] for f in FORMATS[:i % 4]),
+        'format_shared_id_list': ','.join(f['id'] for f in FORMATS[:i % 4]),
+    }
+
+
+@pytest.fixture
+def meetings():
+    return [make_meeting(i) for i in range(120)]
+
+
+@pytest.fixture
+def formats():
+    return [dict(f) for f in FORMATS]
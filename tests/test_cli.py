@@ -0,0 +1,53 @@
+import importlib.util
+import json
+import os
+import pytest
+
+# The command line script has the same name as the package, so it's loaded from its path
+spec = importlib.util.spec_from_file_location(
+    'scroll_cli', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'scroll.py'))
+cli = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cli)
+
+# Nothing listens here, so every request to it fails straight away
+UNREACHABLE_URL = 'http://127.0.0.1:9'
+
+
+def get_args(*argv):
+    args = cli.get_parser().parse_args([str(arg) for arg in argv])
+    cli.validate_args(args)
+    return args
+
+
+@pytest.fixture
+def input_file(tmp_path, meetings, formats):
+    path = tmp_path / 'meetings.json'
+    path.write_text(json.dumps({'meetings': meetings, 'formats': formats}))
+    return path
+
+
+def test_poll_returns_failed_jobs(tmp_path, input_file):
+    good = get_args('1,2,3', 'letter', tmp_path / 'good.pdf', '--input-file', input_file)
+    bad = get_args('1,2,3', 'letter', tmp_path / 'bad.pdf', '--input-file', tmp_path / 'missing.json')
+    state, failed = cli.poll([good, bad], {})
+    assert failed == [str(tmp_path / 'bad.pdf')]
+    assert list(state) == [str(tmp_path / 'good.pdf')]
+    assert (tmp_path / 'good.pdf').exists()
+
+
+def test_descendants_fail_without_the_hierarchy(tmp_path):
+    args = get_args('1', 'letter', tmp_path / '{service_body_id}.pdf', '--descendants', '--tomato-url',
+                    UNREACHABLE_URL, '--retries', 0)
+    state, failed = cli.poll([args], {})
+    assert state == {}
+    assert failed == [str(tmp_path / '{service_body_id}.pdf')]
+    assert cli.render_descendants(args) == 1
+
+
+def test_watch_once_exit_status(tmp_path, input_file):
+    jobs_file = tmp_path / 'jobs.txt'
+    jobs_file.write_text('1,2,3 letter {} --input-file {}\n'.format(tmp_path / 'good.pdf', input_file))
+    assert cli.watch([str(jobs_file), '--once']) == 0
+    with open(jobs_file, 'a') as f:
+        f.write('1,2,3 letter {} --input-file {}\n'.format(tmp_path / 'bad.pdf', tmp_path / 'missing.json'))
+    assert cli.watch([str(jobs_file), '--once']) == 1
@@ -0,0 +1,101 @@
+import io
+import pytest
+from scroll import Booklet
+from scroll.compact import UnsupportedPDF, compact_pdf, optimize_content
+from scroll.linearize import can_linearize
+
+pikepdf = pytest.importorskip('pikepdf')
+fitz = pytest.importorskip('fitz')
+
+
+def render(meetings, formats, **kwargs):
+    return Booklet(meetings, formats, None, **kwargs).get_pdf_bytes()
+
+
+def check_pdf(data):
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        assert pdf.check_pdf_syntax() == []
+        if pdf.is_linearized:
+            assert pdf.check_linearization()
+        return pdf.pdf_version, pdf.is_linearized, len(pdf.pages)
+
+
+def get_pages(data, dpi=50):
+    with fitz.open(stream=data, filetype='pdf') as doc:
+        return [(page.get_text(), page.get_pixmap(dpi=dpi).samples) for page in doc]
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'bookletize': True},
+    {'bookletize': True, 'paper_size': 'tabloid', 'second_header_field': 'city'},
+    {'main_header_field': 'city', 'meeting_font': 'dejavuserif', 'meeting_separator_color': '#FF0000'},
+])
+def test_compact_draws_the_same_pages(meetings, formats, kwargs):
+    original = render(meetings, formats, **kwargs)
+    booklet = Booklet(meetings, formats, None, compact=True, **kwargs)
+    compact = booklet.get_pdf_bytes()
+    assert booklet.compact_stats == (len(original), len(compact))
+    assert len(compact) < len(original)
+    version, linearized, page_count = check_pdf(compact)
+    assert version == '1.5' and not linearized
+    assert page_count == check_pdf(original)[2]
+    assert get_pages(compact) == get_pages(original)
+
+
+@pytest.mark.skipif(not can_linearize(), reason='needs pikepdf or qpdf')
+@pytest.mark.parametrize('bookletize', [False, True])
+def test_compact_and_linearize(meetings, formats, bookletize):
+    original = render(meetings, formats, bookletize=bookletize)
+    data = render(meetings, formats, bookletize=bookletize, compact=True, linearize=True)
+    version, linearized, page_count = check_pdf(data)
+    assert linearized
+    assert get_pages(data) == get_pages(original)
+    # Linearizing the same booklet gives the same bytes
+    assert render(meetings, formats, bookletize=bookletize, compact=True, linearize=True) == data
+
+
+def test_compact_shares_identical_objects_and_drops_unused_fonts(meetings, formats):
+    original = render(meetings, formats)
+    compact = compact_pdf(original)
+    with pikepdf.open(io.BytesIO(original)) as pdf:
+        original_fonts = {str(font.BaseFont) for page in pdf.pages for font in page.Resources.Font.values()}
+    with pikepdf.open(io.BytesIO(compact)) as pdf:
+        compact_fonts = {str(font.BaseFont) for page in pdf.pages for font in page.Resources.Font.values()}
+        to_unicode = {font.DescendantFonts[0].objgen and font.ToUnicode.objgen
+                      for page in pdf.pages for font in page.Resources.Font.values()}
+    assert compact_fonts < original_fonts
+    # Every font used to carry its own copy of the same CMap
+    assert len(to_unicode) == 1
+
+
+def test_compact_rejects_compact_output(meetings, formats):
+    # Only the classic xref tables FPDF writes are read
+    with pytest.raises(UnsupportedPDF):
+        compact_pdf(render(meetings, formats, compact=True))
+
+
+def test_optimize_content_drops_repeated_state():
+    content = b'0.5 w 1 0 0 RG 0 0 m 1 1 l S 0.5 w 1 0 0 RG 1 1 m 2 2 l S 0.6 w'
+    assert optimize_content(content) == b'0.5 w 1 0 0 RG 0 0 m 1 1 l S 1 1 m 2 2 l S 0.6 w'
+
+
+def test_optimize_content_restores_state():
+    # After Q the color is whatever it was before q, so setting it again isn't redundant
+    content = b'0 g q 1 g Q 1 g q 1 g Q'
+    assert optimize_content(content) == b'0 g q 1 g Q 1 g q Q'
+
+
+def test_optimize_content_removes_empty_text_objects():
+    content = b'BT /F1 10 Tf (a) Tj ET BT /F1 10 Tf ET 0 g'
+    assert optimize_content(content) == b'BT /F1 10 Tf (a) Tj ET 0 g'
+
+
+def test_optimize_content_leaves_strings_alone():
+    content = b'BT /F1 10 Tf (1 w 1 w) Tj ET 1 w 1 w'
+    assert optimize_content(content) == b'BT /F1 10 Tf (1 w 1 w) Tj ET 1 w '
+
+
+@pytest.mark.parametrize('content', [b'q 1 w', b'Q', b'BT (a) Tj', b'BI /W 1 ID x EI'])
+def test_optimize_content_gives_up(content):
+    assert optimize_content(content) is None
@@ -0,0 +1,53 @@
+import pytest
+from scroll import Booklet, fit_to_pages
+from scroll.pdf_objects import PDFFormatsTable
+
+
+LONG_NAME = 'Open to everyone, including family members, friends and anyone else interested in recovery'
+
+
+def get_formats_table(booklet):
+    return next(obj for obj in booklet.get_pdf_objects() if isinstance(obj, PDFFormatsTable))
+
+
+@pytest.mark.parametrize('font_size', [10, 14, 20])
+def test_long_format_name(meetings, formats, font_size):
+    formats[0]['name_string'] = LONG_NAME
+    booklet = Booklet(meetings, formats, None, meeting_font_size=font_size)
+    table = get_formats_table(booklet)
+    rows = list(zip(table.formats[::2], table.formats[1::2]))
+    # The long name takes up more lines than padding with spaces can add to the short name next to it
+    left, right = rows[0]
+    assert len(left.get_lines()) > len(right.get_lines()) + 1
+    assert right.format.name.rstrip() == 'Closed'
+    assert table.height > sum(max(left.height, right.height) for left, right in rows)
+    assert Booklet(meetings, formats, None, meeting_font_size=font_size).get_layout_stats().page_count % 4 == 0
+    assert b'%%EOF' in Booklet(meetings, formats, None, meeting_font_size=font_size).get_pdf_bytes()
+
+
+def test_long_format_name_next_to_blank(meetings, formats):
+    # An odd number of formats is padded with a blank one, which spaces can't make any taller
+    formats[4]['name_string'] = LONG_NAME
+    table = get_formats_table(Booklet(meetings, formats, None, meeting_font_size=14))
+    assert table.formats[-1].format.key == ''
+    assert table.height > 0
+
+
+def test_short_names_are_padded_to_their_row(meetings, formats):
+    formats[0]['name_string'] = 'Open to everyone who is interested'
+    table = get_formats_table(Booklet(meetings, formats, None))
+    # Measuring the table pads the names of each row
+    table.height
+    left, right = table.formats[:2]
+    assert len(left.get_lines()) == 2
+    assert left.height == right.height
+    assert right.format.name.startswith('Closed ')
+
+
+def test_auto_fit_with_long_format_name(meetings, formats):
+    formats[0]['name_string'] = LONG_NAME
+    pages = Booklet(meetings, formats, None, meeting_font_size=10).get_layout_stats().page_count
+    # The search tries font sizes up to 20, where the long name wraps onto many more lines
+    options, stats = fit_to_pages(meetings, formats, pages, max_font_size=20)
+    assert options['meeting_font_size'] >= 10
+    assert stats.page_count <= pages
@@ -0,0 +1,55 @@
+import random
+import pytest
+from scroll import Booklet
+from scroll import pdf_objects
+from scroll.metrics import get_string_units
+from scroll.pdf_objects import PDFMeeting, get_multi_cell_lines, get_multi_cell_lines_batch
+
+pytest.importorskip('numpy')
+
+WORDS = ['a', 'I', 'Meeting', 'Group', 'St.', 'été', 'Ünïcödé', '\U0001F600', '\t', '', ' ',
+         'Averyveryverylongwordthatdoesnotfitonalineofthemeetingcolumnatanyfontsizethebookletuses']
+
+
+def get_texts(count, seed=1):
+    r = random.Random(seed)
+    texts = [' '.join(r.choice(WORDS) for _ in range(r.randint(0, 30))) for _ in range(count)]
+    return texts + ['', ' ', 'a', 'a ', ' a', 'a  b', 'a\ud800b']
+
+
+def get_measurer(fontkey, size):
+    pdf = Booklet(None, None, None)._get_measure_func()()
+    pdf.set_font(fontkey, '', size)
+    return pdf
+
+
+@pytest.mark.parametrize('family', ['dejavusans', 'dejavuserif'])
+@pytest.mark.parametrize('style', ['', 'B', 'I', 'BI'])
+def test_chars_units(family, style):
+    pdf = get_measurer(family, 10)
+    pdf.set_font(family, style)
+    for text in get_texts(500):
+        assert int(pdf.get_chars_units(text).sum()) == get_string_units(pdf.current_font, text)
+
+
+@pytest.mark.parametrize('font_size', [6, 10, 14, 20])
+@pytest.mark.parametrize('max_line_length', [1, 5, 30, 63.5, 120])
+def test_multi_cell_lines_batch(font_size, max_line_length):
+    pdf = get_measurer('dejavusans', font_size)
+    texts = get_texts(2000)
+    expected = [get_multi_cell_lines(pdf, text, max_line_length) for text in texts]
+    assert get_multi_cell_lines_batch(pdf, texts, max_line_length) == expected
+
+
+def get_layout(booklet):
+    return [(type(obj).__name__, obj.height, obj.get_wrapped_lines() if isinstance(obj, PDFMeeting) else None)
+            for obj in booklet.get_pdf_objects() if hasattr(obj, 'height')]
+
+
+@pytest.mark.parametrize('font_size', [8, 10, 16])
+def test_layout_matches_measuring_one_meeting_at_a_time(meetings, formats, monkeypatch, font_size):
+    # Several batches, the last one partly full
+    monkeypatch.setattr(Booklet, 'MEASURE_BATCH_SIZE', 50)
+    layout = get_layout(Booklet(meetings, formats, None, meeting_font_size=font_size))
+    monkeypatch.setattr(pdf_objects, 'HAVE_NUMPY', False)
+    assert layout == get_layout(Booklet(meetings, formats, None, meeting_font_size=font_size))
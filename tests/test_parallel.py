@@ -0,0 +1,41 @@
+import pytest
+from scroll import Booklet, MeetingIndex
+from scroll.parallel import PARALLEL_MIN_MEETINGS, get_sections
+from conftest import make_meeting
+
+
+@pytest.fixture
+def many_meetings():
+    return [make_meeting(i) for i in range(PARALLEL_MIN_MEETINGS + 200)]
+
+
+def get_layout(booklet):
+    return [(type(obj).__name__, obj.height, obj.get_wrapped_lines() if hasattr(obj, 'get_wrapped_lines') else None)
+            for obj in booklet.get_pdf_objects() if hasattr(obj, 'height')]
+
+
+@pytest.mark.parametrize('main_header_field', ['weekday', 'city'])
+def test_workers_lay_out_the_same_booklet(many_meetings, formats, main_header_field):
+    index = MeetingIndex(many_meetings)
+    booklet = Booklet(index, formats, None, main_header_field=main_header_field, workers=2)
+    assert booklet._use_workers()
+    layout = get_layout(booklet)
+    assert layout == get_layout(Booklet(index, formats, None, main_header_field=main_header_field))
+    assert Booklet(index, formats, None, main_header_field=main_header_field, workers=3).get_pdf_bytes() == \
+        Booklet(index, formats, None, main_header_field=main_header_field).get_pdf_bytes()
+
+
+def test_workers_are_only_used_for_many_meetings(meetings, many_meetings, formats):
+    assert not Booklet(meetings, formats, None, workers=2)._use_workers()
+    assert not Booklet(iter(many_meetings), formats, None, workers=2)._use_workers()
+    assert Booklet(many_meetings, formats, None, workers=2)._use_workers()
+    assert not Booklet(many_meetings, formats, None, workers=1)._use_workers()
+    with pytest.raises(ValueError):
+        Booklet(many_meetings, formats, None, workers=0)
+
+
+def test_sections(many_meetings):
+    meetings = list(MeetingIndex(many_meetings).ordered('weekday', None))
+    sections = get_sections(meetings, 'weekday', 100)
+    assert [m for section in sections for m in section] == meetings
+    assert all(len(section) <= 100 and len({m.weekday for m in section}) == 1 for section in sections)
@@ -0,0 +1,51 @@
+import datetime
+import pytest
+from scroll import Booklet, read_plan, render_plan, write_plan
+from scroll import pdf_objects
+from scroll.pdf_objects import PDFMeeting
+from scroll.plan import load_placements
+
+CREATION_DATE = datetime.datetime(2020, 1, 1)
+
+
+def get_booklet(meetings, formats, **kwargs):
+    return Booklet(meetings, formats, None, creation_date=CREATION_DATE, **kwargs)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'bookletize': True, 'second_header_field': 'city'}])
+def test_plan_renders_the_same_pdf(tmp_path, meetings, formats, kwargs):
+    write_plan(get_booklet(meetings, formats, **kwargs).get_plan(), str(tmp_path / 'plan.json'))
+    plan = read_plan(str(tmp_path / 'plan.json'))
+    assert render_plan(plan) == get_booklet(meetings, formats, **kwargs).get_pdf_bytes()
+
+
+@pytest.mark.parametrize('batches', [True, False])
+def test_meetings_are_measured_once(meetings, formats, monkeypatch, batches):
+    if not batches:
+        monkeypatch.setattr(pdf_objects, 'HAVE_NUMPY', False)
+    measured = []
+    get_measured_texts = PDFMeeting.get_measured_texts
+
+    def counting_get_measured_texts(self):
+        measured.append(self)
+        return get_measured_texts(self)
+
+    monkeypatch.setattr(PDFMeeting, 'get_measured_texts', counting_get_measured_texts)
+    plan = get_booklet(meetings, formats).get_plan()
+    # Dumping the plan uses the lines layout wrapped
+    assert len(measured) == len(meetings)
+    assert sum(entry['type'] == 'meeting' for page in plan['pages'] for entry in page) == len(meetings)
+
+
+def test_loaded_meetings_keep_their_lines(meetings, formats, monkeypatch):
+    booklet = get_booklet(meetings, formats)
+    plan = booklet.get_plan()
+    entries = [entry for page in plan['pages'] for entry in page if entry['type'] == 'meeting']
+    placements = load_placements(plan, booklet._get_measure_func())
+    loaded = [obj for sheet in placements for _, obj, _, _ in sheet if isinstance(obj, PDFMeeting)]
+
+    def get_multi_cell_lines(*args):
+        raise AssertionError('a loaded meeting was measured')
+
+    monkeypatch.setattr(pdf_objects, 'get_multi_cell_lines', get_multi_cell_lines)
+    assert [(m.height, m.get_wrapped_lines()) for m in loaded] == [(e['height'], e['lines']) for e in entries]
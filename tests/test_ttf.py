@@ -0,0 +1,84 @@
+import glob
+import os
+import re
+import pytest
+from fpdf.ttfonts import TTFontFile
+from scroll import Booklet
+from scroll.metrics import FontMetrics
+from scroll.ttf import CHAR_WIDTHS_LENGTH, SubsetFontFile, TrueTypeFont
+
+
+FONT_PATHS = sorted(glob.glob(os.path.join(Booklet.FONT_DIR, '*.ttf')))
+
+# Latin text, some punctuation and symbols outside of it, and a character none of the faces have
+SUBSET_TEXT = ''.join(chr(c) for c in range(32, 127)) + 'àéîõüñßçÅØ—–’“”€…•∑√∞→♥\U0001F600'
+
+
+def get_fpdf_metrics(path):
+    ttf = TTFontFile()
+    ttf.getMetrics(path)
+    return ttf
+
+
+def get_fpdf_descriptor(ttf):
+    # What FPDF.add_font puts in the font dict for a TTF font
+    return {
+        'desc': {
+            'Ascent': int(round(ttf.ascent, 0)),
+            'Descent': int(round(ttf.descent, 0)),
+            'CapHeight': int(round(ttf.capHeight, 0)),
+            'Flags': ttf.flags,
+            'FontBBox': '[%s %s %s %s]' % tuple(int(round(v, 0)) for v in ttf.bbox),
+            'ItalicAngle': int(ttf.italicAngle),
+            'StemV': int(round(ttf.stemV, 0)),
+            'MissingWidth': int(round(ttf.defaultWidth, 0)),
+        },
+        'up': round(ttf.underlinePosition),
+        'ut': round(ttf.underlineThickness),
+    }
+
+
+@pytest.fixture(params=FONT_PATHS, ids=os.path.basename)
+def font_path(request):
+    return request.param
+
+
+def test_font_faces_are_bundled():
+    for family, style, filename in Booklet.FONT_FILES:
+        assert os.path.join(Booklet.FONT_DIR, filename) in FONT_PATHS
+
+
+def test_char_widths(font_path):
+    expected = get_fpdf_metrics(font_path).charWidths
+    char_widths = TrueTypeFont(font_path).char_widths
+    assert len(char_widths) == len(expected) == CHAR_WIDTHS_LENGTH
+    assert [char_widths[c] for c in range(CHAR_WIDTHS_LENGTH)] == expected
+
+
+def test_descriptor(font_path):
+    expected = get_fpdf_metrics(font_path)
+    ttf = TrueTypeFont(font_path)
+    assert ttf.descriptor == get_fpdf_descriptor(expected)
+    assert ttf.full_name == expected.fullName
+
+
+def test_font_metrics_match_add_font():
+    metrics = FontMetrics((family, style, os.path.join(Booklet.FONT_DIR, filename))
+                          for family, style, filename in Booklet.FONT_FILES)
+    for family, style, filename in Booklet.FONT_FILES:
+        expected = get_fpdf_metrics(os.path.join(Booklet.FONT_DIR, filename))
+        font = metrics.get_font(family + style)
+        assert {'desc': font['desc'], 'up': font['up'], 'ut': font['ut']} == get_fpdf_descriptor(expected)
+        assert font['name'] == re.sub('[ ()]', '', expected.fullName)
+        assert font['originalsize'] == os.path.getsize(os.path.join(Booklet.FONT_DIR, filename))
+
+
+@pytest.mark.parametrize('text', [SUBSET_TEXT, 'Meeting', ' '], ids=['mixed', 'word', 'space'])
+def test_subset(font_path, text):
+    subset = sorted(set(ord(c) for c in text))
+    expected = TTFontFile()
+    expected_stream = expected.makeSubset(font_path, list(subset))
+    ttf = SubsetFontFile(TrueTypeFont(font_path))
+    assert ttf.makeSubset(font_path, list(subset)) == expected_stream
+    assert ttf.codeToGlyph == expected.codeToGlyph
+    assert ttf.maxUni == expected.maxUni
@@ -0,0 +1,94 @@
+import datetime
+import io
+import pytest
+from scroll import Booklet, UnsupportedUpdate, fold_updates, render_plan, render_update
+from scroll.update import get_kept_pages
+from conftest import make_meeting
+
+pikepdf = pytest.importorskip('pikepdf')
+fitz = pytest.importorskip('fitz')
+
+CREATION_DATE = datetime.datetime(2020, 1, 1)
+
+
+def get_plan(meetings, formats, **kwargs):
+    return Booklet(meetings, formats, None, creation_date=CREATION_DATE, **kwargs).get_plan()
+
+
+def get_pages(data, dpi=40):
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        assert pdf.check_pdf_syntax() == []
+    with fitz.open(stream=data, filetype='pdf') as doc:
+        return [(page.get_text(), page.get_pixmap(dpi=dpi).samples) for page in doc]
+
+
+def check_update(previous_plan, plan):
+    """Updates the PDF of previous_plan to plan and checks the result, and the result folded, against rendering plan
+    in full. Returns the kept pages."""
+    previous_pdf = render_plan(previous_plan)
+    updated = render_update(previous_pdf, previous_plan, plan)
+    assert updated.startswith(previous_pdf)
+    expected = get_pages(render_plan(plan))
+    assert get_pages(updated) == expected
+    folded = fold_updates(updated)
+    assert get_pages(folded) == expected
+    assert len(folded) <= len(updated)
+    return get_kept_pages(previous_plan, plan)
+
+
+@pytest.mark.parametrize('bookletize', [False, True])
+def test_no_change(meetings, formats, bookletize):
+    plan = get_plan(meetings, formats, bookletize=bookletize)
+    pdf = render_plan(plan)
+    assert get_kept_pages(plan, plan) == list(range(len(plan['pages'])))
+    assert render_update(pdf, plan, plan) == pdf
+    # Nothing was replaced, so there's nothing to leave out
+    assert get_pages(fold_updates(pdf)) == get_pages(pdf)
+
+
+@pytest.mark.parametrize('bookletize', [False, True])
+def test_one_meeting_changed(meetings, formats, bookletize):
+    previous_plan = get_plan(meetings, formats, bookletize=bookletize)
+    meetings[60]['location_street'] = '61 Main Street'
+    kept = check_update(previous_plan, get_plan(meetings, formats, bookletize=bookletize))
+    assert kept.count(None) == 1
+
+
+def test_pages_added(meetings, formats):
+    previous_plan = get_plan(meetings, formats)
+    # Saturday meetings, which go at the end of the booklet
+    meetings += [make_meeting(i) for i in range(126, 126 + 7 * 60, 7)]
+    plan = get_plan(meetings, formats)
+    assert len(plan['pages']) > len(previous_plan['pages'])
+    kept = check_update(previous_plan, plan)
+    assert kept[:5] == list(range(5))
+
+
+def test_meeting_inserted_early(meetings, formats):
+    previous_plan = get_plan(meetings, formats)
+    meeting = make_meeting(1000)
+    meeting.update(weekday_tinyint='1', start_time='05:00:00')
+    kept = check_update(previous_plan, get_plan([meeting] + meetings, formats))
+    # Pages are only compared with the page at the same index, and the meetings after the new one all moved down
+    assert kept[0] == 0
+    assert kept[1] is None and kept[2] is None
+
+
+def test_repeated_updates(meetings, formats):
+    plans = [get_plan(meetings, formats)]
+    pdf = render_plan(plans[0])
+    for i in (10, 70):
+        meetings[i]['meeting_name'] += ' Again'
+        plans.append(get_plan(meetings, formats))
+        pdf = render_update(pdf, plans[-2], plans[-1])
+    expected = get_pages(render_plan(plans[-1]))
+    assert get_pages(pdf) == expected
+    assert get_pages(fold_updates(pdf)) == expected
+
+
+def test_unsupported_updates(meetings, formats):
+    plan = get_plan(meetings, formats)
+    with pytest.raises(UnsupportedUpdate):
+        get_kept_pages(plan, get_plan(meetings, formats, meeting_font_size=12))
+    with pytest.raises(UnsupportedUpdate):
+        get_kept_pages(plan, get_plan(meetings, formats, compact=True))